@@ -14,6 +14,8 @@
  * The server implements:
  *   POST /new/<username>/<agentName>   { "content": <systemPrompt> }
  *   POST /query/<username>/<agentName> { "prompt": <userPrompt> }
+ *   POST /query-stream/<username>/<agentName> { "prompt": <userPrompt> }
+ *        (same as /query, but the reply is streamed as Server-Sent Events)
  *   POST /delete/<username>/<agentName>
  *
  * We rely on the MMO plugin to get the current user's name:
@@ -27,6 +29,7 @@
  * If you prefer JavaScript calls:
  *   foi_agent.new(agentName, systemPrompt).then(...)
  *   foi_agent.ask(agentName, userPrompt).then(...)
+ *   foi_agent.askStream(agentName, userPrompt, textSoFar => ...).then(...)
  *   foi_agent.delete(agentName).then(...)
  *
  * Example usage in an Event:
@@ -124,6 +127,74 @@
       }
     },
 
+    /**
+     * Ask an existing agent and receive the reply while it is generated.
+     * POST /query-stream/<username>/<agentName>
+     * JSON body: { prompt: userPrompt }
+     * @param {string} agentName
+     * @param {string} prompt
+     * @param {function(string)} onText Called with the reply so far after every token
+     * @returns {Promise<string>} The complete assistant's text reply
+     */
+    askStream: async function(agentName, prompt, onText) {
+      const user = encodeURIComponent(currentPlayerName());
+      const name = encodeURIComponent(agentName);
+
+      const url = `${FoiServerUrl}/query-stream/${user}/${name}`;
+      try {
+        const response = await fetch(url, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ prompt })
+        });
+
+        // Errors before generation starts come back as plain JSON
+        const contentType = response.headers.get("Content-Type") || "";
+        if (!contentType.startsWith("text/event-stream")) {
+          const data = await response.json();
+          throw new Error(data.response || "Query error");
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let reply = "";
+
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          let boundary;
+          while ((boundary = buffer.indexOf("\n\n")) >= 0) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = "message";
+            let data = "";
+            block.split("\n").forEach(line => {
+              if (line.startsWith("event:")) event = line.slice(6).trim();
+              else if (line.startsWith("data:")) data += line.slice(5).trim();
+            });
+            const payload = data ? JSON.parse(data) : {};
+
+            if (event === "token") {
+              reply += payload.token;
+              if (onText) onText(reply);
+            } else if (event === "done") {
+              return payload.response;
+            } else if (event === "error") {
+              throw new Error(payload.response || "Query error");
+            }
+          }
+        }
+        return reply;
+      } catch (err) {
+        console.error(`FOI: Error querying agent "${agentName}":`, err);
+        throw err;
+      }
+    },
+
     /**
      * Delete an existing agent for the current user.
      * POST /delete/<username>/<agentName>
@@ -257,70 +328,51 @@
 
         interpreter.setWaitMode('message'); // Set to custom wait mode (blocking)
 
-        // Query the agent
-        window.foi_agent.ask(agentName, prompt)
+        // Query the agent, showing the reply page by page while it is generated
+        const pager = new StreamedMessage(agentName);
+
+        window.foi_agent.askStream(agentName, prompt, text => pager.update(text, false))
             .then(response => {
                 console.log(`[${agentName}] says: ${response}`);
 
                 if (variableIdToStore !== null) {
                     $gameVariables.setValue(variableIdToStore, response);
                 }
-                
-                if( !response.trim().startsWith('{') ){ // Check if the answer is a JSON object
 
-                    const npcData = $gameSystem.foi_agents?.[agentName];
-                    if (npcData) {
-                        $gameMessage.setFaceImage(npcData.faceImage, npcData.faceIndex);
-                        $gameMessage.add(`\\c[4]${npcData.name}:\\c[0]`);
-                    }
+                pager.update(response, true);
 
-                    const maxLineLength = 40;
-                    const responseLines = wrapText(response, maxLineLength);
-
-                    responseLines.forEach(line => {
-                        $gameMessage.add(line);
-                    });
+                if( !response.trim().startsWith('{') ){ // Check if the answer is a JSON object
 
                     if (answerVariableId !== null) {
-                        const _foi_waitForMessage = function() {
-                        
-                            if ($gameMessage.isBusy()) {
-                                requestAnimationFrame(_foi_waitForMessage);
-                            } else {
-                                const inputInterpreter = new Game_Interpreter();
-                                inputInterpreter.pluginCommand('InputDialog', ['variableID', String(answerVariableId)]);
-                                inputInterpreter.pluginCommand('InputDialog', ['text', 'Tvoj odgovor:']);
-                                inputInterpreter.pluginCommand('InputDialog', ['open']);
-
-                                // Wait for the InputDialog to finish
-                                const _waitForInputDialogClose = function() {
-                                    if (SceneManager._scene._inputDialog && SceneManager._scene._inputDialog._opened) {
-                                        requestAnimationFrame(_waitForInputDialogClose);
-                                    } else {
-                                        console.log( 'input unblock' );
-                                        interpreter.setWaitMode(''); // unblock event!
-                                    }
-                                };
-                                _waitForInputDialogClose();
-                            }
-                        };
-                        _foi_waitForMessage();
+                        pager.whenClosed(() => {
+                            const inputInterpreter = new Game_Interpreter();
+                            inputInterpreter.pluginCommand('InputDialog', ['variableID', String(answerVariableId)]);
+                            inputInterpreter.pluginCommand('InputDialog', ['text', 'Tvoj odgovor:']);
+                            inputInterpreter.pluginCommand('InputDialog', ['open']);
+
+                            // Wait for the InputDialog to finish
+                            const _waitForInputDialogClose = function() {
+                                if (SceneManager._scene._inputDialog && SceneManager._scene._inputDialog._opened) {
+                                    requestAnimationFrame(_waitForInputDialogClose);
+                                } else {
+                                    console.log( 'input unblock' );
+                                    interpreter.setWaitMode(''); // unblock event!
+                                }
+                            };
+                            _waitForInputDialogClose();
+                        });
                     } else {
-                        const _waitForMessageClose = function() {
-                            if ($gameMessage.isBusy()) {
-                                requestAnimationFrame(_waitForMessageClose);
-                            } else {
-                                console.log( 'message unblock' );
-                                interpreter.setWaitMode(''); // Unblock after message finished
-                            }
-                        };
-                        _waitForMessageClose();
+                        pager.whenClosed(() => {
+                            console.log( 'message unblock' );
+                            interpreter.setWaitMode(''); // Unblock after message finished
+                        });
                     }
                 }
 
             })
             .catch(err => {
                 console.error("Failed to query agent:", err);
+                pager.cancel();
                 interpreter.setWaitMode(''); // On error also unblock
             });
 
@@ -442,6 +494,74 @@
     }
   };
 
+  // --------------------------------------------------------------------------
+  // 3) Streamed replies in the message window
+  //    A page is handed to the message window as soon as its lines are
+  //    complete and the previous page was closed, so the player reads the
+  //    start of the reply while the rest is still being generated. Lines
+  //    are only added while the window is idle, because closing a page
+  //    clears every line queued in $gameMessage.
+  // --------------------------------------------------------------------------
+  const MESSAGE_LINES = 4;
+  const MAX_LINE_LENGTH = 40;
+
+  function StreamedMessage(agentName) {
+    this.npcData = $gameSystem.foi_agents?.[agentName];
+    this.lines = [];
+    this.shown = 0;
+    this.finished = false;
+    this.hidden = false;
+    this.cancelled = false;
+    this.callbacks = [];
+    this._pump = this._pump.bind(this);
+    requestAnimationFrame(this._pump);
+  }
+
+  StreamedMessage.prototype.update = function(text, finished) {
+    // JSON answers are meant for the event, not for the player
+    this.hidden = text.trim().startsWith('{');
+    const lines = wrapText(text, MAX_LINE_LENGTH);
+    // The last line may still grow until the reply is finished
+    this.lines = finished ? lines : lines.slice(0, -1);
+    this.finished = finished;
+  };
+
+  StreamedMessage.prototype.cancel = function() {
+    this.cancelled = true;
+  };
+
+  StreamedMessage.prototype.whenClosed = function(callback) {
+    this.callbacks.push(callback);
+  };
+
+  StreamedMessage.prototype._pump = function() {
+    if (this.cancelled) return;
+
+    if (!this.hidden && !$gameMessage.isBusy()) {
+      const header = this.shown === 0 && this.npcData;
+      const pageSize = header ? MESSAGE_LINES - 1 : MESSAGE_LINES;
+      const available = this.lines.length - this.shown;
+
+      if (available >= pageSize || (this.finished && available > 0)) {
+        if (this.npcData) {
+          $gameMessage.setFaceImage(this.npcData.faceImage, this.npcData.faceIndex);
+        }
+        if (header) {
+          $gameMessage.add(`\\c[4]${this.npcData.name}:\\c[0]`);
+        }
+        this.lines.slice(this.shown, this.shown + pageSize).forEach(line => $gameMessage.add(line));
+        this.shown += Math.min(pageSize, available);
+      }
+    }
+
+    const allShown = this.finished && (this.hidden || this.shown >= this.lines.length);
+    if (allShown && !$gameMessage.isBusy()) {
+      this.callbacks.forEach(callback => callback());
+      return;
+    }
+    requestAnimationFrame(this._pump);
+  };
+
   function wrapText(text, maxLineLength) {
     let words = text.split(" ");
     let lines = [];
@@ -0,0 +1,93 @@
+import time
+import threading
+import numpy as np
+import faiss
+
+# ----------------------------------------------------------------
+# Semantic answer cache
+#    One small inner product index of normalized question vectors
+#    per (teacher, agent). A question whose cosine similarity to a
+#    cached one reaches the threshold gets the cached answer.
+#    Entries expire after ttl seconds and the least recently used
+#    entries are evicted beyond max_entries per agent.
+# ----------------------------------------------------------------
+class AgentAnswers:
+    def __init__(self, dimension):
+        self.index = faiss.IndexFlatIP(dimension)
+        self.entries = []   # [question, answer, created, last_used], aligned with the index
+
+    def remove(self, positions):
+        if not positions:
+            return
+        self.index.remove_ids(np.array(positions, dtype=np.int64))
+        for position in sorted(positions, reverse=True):
+            del self.entries[position]
+
+
+class SemanticAnswerCache:
+    def __init__(self, dimension, threshold=0.95, ttl=3600, max_entries=200):
+        self.dimension = dimension
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.agents = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _expire(self, answers, now):
+        expired = [position for position, entry in enumerate(answers.entries) if now - entry[2] > self.ttl]
+        answers.remove(expired)
+
+    def lookup(self, key, embedding):
+        """Return the cached answer of the most similar question, or None."""
+        now = time.time()
+        with self.lock:
+            answers = self.agents.get(key)
+            if answers is not None:
+                self._expire(answers, now)
+            if answers is None or not answers.entries:
+                self.misses += 1
+                return None
+
+            D, I = answers.index.search(self.normalize(embedding), 1)
+            if I[0][0] < 0 or D[0][0] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry = answers.entries[I[0][0]]
+            entry[3] = now
+            self.hits += 1
+            return entry[1]
+
+    def store(self, key, embedding, question, answer):
+        now = time.time()
+        with self.lock:
+            answers = self.agents.setdefault(key, AgentAnswers(self.dimension))
+            answers.index.add(self.normalize(embedding))
+            answers.entries.append([question, answer, now, now])
+
+            if len(answers.entries) > self.max_entries:
+                by_use = sorted(range(len(answers.entries)), key=lambda position: answers.entries[position][3])
+                answers.remove(by_use[:len(answers.entries) - self.max_entries])
+
+    def invalidate(self, key):
+        with self.lock:
+            self.agents.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "agents": len(self.agents),
+                "entries": sum(len(answers.entries) for answers in self.agents.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import platform
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from memory_db import MemoryDB
+
+# ----------------------------------------------------------------
+# Offline benchmark of the query and upload paths
+#    Loads openai-server.py with the fake embedding and chat
+#    backends and the in-memory database, fills it with a corpus
+#    of generated chunks and drives startup, /login, /upload and
+#    /query through the Flask test client from several threads.
+#    Results (throughput, p50/p95/p99 per stage) are printed and
+#    written as JSON; --compare checks them against an earlier
+#    run and exits with status 1 when a stage got slower.
+#
+#    python3 benchmark.py --agents 20 --chunks 500 --concurrency 8
+#    python3 benchmark.py --output new.json --compare baseline.json
+# ----------------------------------------------------------------
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SCIENTISTS = ("Naesala", "Haryk", "Ayred", "Hagmar")
+WORDS = ("light", "motion", "tower", "lens", "comet", "orbit", "engine", "current", "magnet", "crystal",
+         "river", "harvest", "bridge", "furnace", "map", "storm", "clock", "mirror", "forge", "seed")
+
+def load_server(workdir):
+    """Import openai-server.py with fake backends, running in a scratch folder."""
+    os.environ["EMBEDDING_BACKEND"] = "fake"
+    os.environ["CHAT_BACKEND"] = "fake"
+    try:
+        import textract
+    except ImportError:
+        # Only .doc files need textract, the benchmark uploads .txt files
+        sys.modules["textract"] = types.ModuleType("textract")
+
+    os.chdir(workdir)
+    sys.path.insert(0, SERVER_FOLDER)
+    spec = importlib.util.spec_from_file_location("openai_server", os.path.join(SERVER_FOLDER, "openai-server.py"))
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+def sentence(rng, words=12):
+    return " ".join(WORDS[index] for index in rng.integers(0, len(WORDS), words)).capitalize() + "."
+
+def chunk_text(rng, number):
+    return f"Lecture note {number}. " + " ".join(sentence(rng) for _ in range(8))
+
+def percentile(values, fraction):
+    return float(np.percentile(values, fraction * 100)) if values else 0.0
+
+def summarize(latencies, elapsed, errors=0):
+    latencies = [1000 * latency for latency in latencies]
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": float(np.mean(latencies)) if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99)
+    }
+
+def drive(operation, requests, concurrency):
+    """Run operation(number) for every request number on concurrency threads, returns the stage summary."""
+    def timed(number):
+        start = time.perf_counter()
+        ok = operation(number)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+    return summarize([latency for latency, _ in results], elapsed, sum(1 for _, ok in results if not ok))
+
+def populate(server, db, args, rng):
+    """Teachers, students and a corpus of embedded chunks stored like uploads store them."""
+    db.create_table("users")
+    server.setup_database()
+
+    for teacher_number in range(args.teachers):
+        teacher = f"teacher{teacher_number}"
+        db.insert("users", [{"username": teacher, "password": "secret", "permission": 1}])
+        db.insert("users", [{"username": f"{teacher}-student{number}", "password": "secret",
+                             "teacher": teacher, "permission": 0} for number in range(args.students)])
+
+        for agent_name in SCIENTISTS[:args.agents]:
+            texts = [chunk_text(rng, number) for number in range(args.chunks)]
+            vectors = server.embedding_backend.embed(texts)
+            db.insert(server.db_embedding_table, [{
+                "id": server.document_id(teacher, agent_name, "corpus.txt", "seed", str(number)),
+                "teacher": teacher,
+                "agent_name": agent_name,
+                "source": "corpus.txt",
+                "content_hash": "seed",
+                "chunk": number,
+                "text": text,
+                "embedding": server.encode_vector(vector, server.VECTOR_FORMAT),
+                "vector_format": server.VECTOR_FORMAT
+            } for number, (text, vector) in enumerate(zip(texts, vectors))])
+
+def bench_startup(server, args):
+    results = {}
+    timings = {"startup_full_rebuild": server.load_embeddings_from_database, "startup_snapshots": server.load_indexes}
+    for stage, function in timings.items():
+        latencies = []
+        for _ in range(args.startup_runs):
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+        results[stage] = summarize(latencies, sum(latencies))
+    return results
+
+def bench_login(server, args):
+    def login(number):
+        client = server.app.test_client()
+        response = client.post("/login", json={"username": f"teacher{number % args.teachers}", "password": "secret"})
+        return response.status_code == 200
+    return drive(login, args.requests, args.concurrency)
+
+def bench_query(server, args):
+    def query(number):
+        rng = np.random.default_rng(number)
+        teacher = f"teacher{number % args.teachers}"
+        student = f"{teacher}-student{number % args.students}"
+        agent_name = SCIENTISTS[number % args.agents]
+        # Every question is new, so neither the embedding nor the answer cache hides the work
+        prompt = f"What does lecture {number} say about " + " and ".join(WORDS[i] for i in rng.integers(0, len(WORDS), 2)) + "?"
+        client = server.app.test_client()
+        response = client.post(f"/query/{student}/{agent_name}", json={"prompt": prompt})
+        return response.status_code == 200
+    return drive(query, args.requests, args.concurrency)
+
+def bench_upload(server, args):
+    request_latencies = []
+
+    def upload(number):
+        rng = np.random.default_rng(100000 + number)
+        teacher = f"teacher{number % args.teachers}"
+        agent_name = SCIENTISTS[number % args.agents]
+        text = "\n\n".join(chunk_text(rng, paragraph) for paragraph in range(args.upload_paragraphs))
+
+        client = server.app.test_client()
+        start = time.perf_counter()
+        response = client.post("/upload", data={
+            "file": (io.BytesIO(text.encode("utf-8")), f"upload{number}.txt"),
+            "username": teacher,
+            "scientist": agent_name
+        }, content_type="multipart/form-data")
+        request_latencies.append(time.perf_counter() - start)
+        if response.status_code != 202:
+            return False
+
+        # Wait for the background job, the stage measures the whole upload
+        job_id = response.get_json()["job_id"]
+        while server.ingestion_jobs.get(job_id).status not in ("done", "failed"):
+            time.sleep(0.005)
+        return server.ingestion_jobs.get(job_id).status == "done"
+
+    start = time.perf_counter()
+    job_stage = drive(upload, args.uploads, args.concurrency)
+    return {
+        "upload_request": summarize(request_latencies, time.perf_counter() - start),
+        "upload_ingested": job_stage
+    }
+
+def print_results(results):
+    print(f"{'stage':<22} {'count':>6} {'errors':>6} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, row in results.items():
+        print(f"{stage:<22} {row['count']:>6} {row['errors']:>6} {row['throughput']:>9.1f} "
+              f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for stage, row in results.items():
+        if stage not in baseline:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            before, after = baseline[stage][metric], row[metric]
+            ratio = after / before if before else 1.0
+            flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+            print(f"    {stage:<22} {metric:<7} {before:9.2f} -> {after:9.2f} ms ({ratio:5.2f}x){flag}")
+            if flag:
+                regressions.append((stage, metric))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OpenAI server offline with fake backends and an in-memory database.")
+    parser.add_argument("--teachers", type=int, default=2)
+    parser.add_argument("--agents", type=int, default=4, help="agents per teacher (at most 4)")
+    parser.add_argument("--students", type=int, default=10, help="students per teacher")
+    parser.add_argument("--chunks", type=int, default=200, help="stored chunks per agent")
+    parser.add_argument("--requests", type=int, default=200, help="requests per /query and /login stage")
+    parser.add_argument("--uploads", type=int, default=8)
+    parser.add_argument("--upload-paragraphs", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--startup-runs", type=int, default=3)
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="seconds before the first reply token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per reply token")
+    parser.add_argument("--db-latency", type=float, default=0.0005, help="seconds per database query")
+    parser.add_argument("--stages", default="startup,login,query,upload")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+    args.agents = min(args.agents, len(SCIENTISTS))
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        server = load_server(workdir)
+        db = MemoryDB(server.db_name, latency=args.db_latency)
+        server.db_pool = db
+        server.embedding_backend.latency = args.embedding_latency
+        server.chat_backend.latency = args.chat_latency
+        server.chat_backend.token_latency = args.token_latency
+
+        rng = np.random.default_rng(0)
+        populate(server, db, args, rng)
+        # Corpus embeddings are generated above, measured stages must not find them cached
+        server.embedding_cache.memory.clear()
+
+        stages = args.stages.split(",")
+        results = {}
+        if "startup" in stages:
+            results.update(bench_startup(server, args))
+        else:
+            server.load_indexes()
+        if "login" in stages:
+            results["login"] = bench_login(server, args)
+        if "query" in stages:
+            results["query"] = bench_query(server, args)
+        if "upload" in stages:
+            results.update(bench_upload(server, args))
+    finally:
+        os.chdir(SERVER_FOLDER)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "config": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if baseline and compare(results, baseline, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+from rethinkdb.errors import ReqlTimeoutError
+
+# ----------------------------------------------------------------
+# Changefeed follower
+#    Keeps a RethinkDB changefeed open on its own connection and
+#    hands the changes to apply() in batches of up to batch_size,
+#    or whatever arrived within batch_wait seconds. Changes are held
+#    back until resume() is called, so the caller can load its
+#    state after the feed is open without missing anything. When
+#    the connection drops the feed is reopened with backoff and
+#    on_reconnect() is called to catch up on what was missed;
+#    on_idle() runs whenever no change arrived for batch_wait.
+# ----------------------------------------------------------------
+class ChangefeedFollower:
+    def __init__(self, name, connect, query, apply, on_idle=None, on_reconnect=None,
+                 batch_size=256, batch_wait=0.2, retry_delay=1.0, max_retry_delay=30.0):
+        self.name = name
+        self.connect = connect
+        self.query = query
+        self.apply = apply
+        self.on_idle = on_idle
+        self.on_reconnect = on_reconnect
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.opened = threading.Event()
+        self.resumed = threading.Event()
+        self.changes = 0
+        self.reconnects = 0
+        self.errors = 0
+
+    def start(self):
+        threading.Thread(target=self.run, name=f"changefeed-{self.name}", daemon=True).start()
+
+    def resume(self):
+        self.resumed.set()
+
+    def run(self):
+        delay = self.retry_delay
+        while True:
+            connection = None
+            try:
+                connection = self.connect()
+                feed = self.query.run(connection)
+                if self.opened.is_set():
+                    self.reconnects += 1
+                    if self.on_reconnect:
+                        self.on_reconnect()
+                self.opened.set()
+                delay = self.retry_delay
+                self.follow(feed)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Changefeed {self.name} failed: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close(noreply_wait=False)
+                    except Exception:
+                        pass
+
+    def follow(self, feed):
+        batch = []
+        while True:
+            try:
+                batch.append(feed.next(wait=self.batch_wait))
+                if len(batch) < self.batch_size:
+                    continue
+            except ReqlTimeoutError:
+                pass
+
+            self.resumed.wait()
+            if batch:
+                self.apply(batch)
+                self.changes += len(batch)
+                batch = []
+            elif self.on_idle:
+                self.on_idle()
+
+    def stats(self):
+        return {
+            "open": self.opened.is_set(),
+            "changes": self.changes,
+            "reconnects": self.reconnects,
+            "errors": self.errors
+        }
@@ -0,0 +1,52 @@
+import time
+import hashlib
+import openai
+
+# ----------------------------------------------------------------
+# Chat backends
+#    complete() returns the whole reply and stream() yields it
+#    token by token. The fake backend answers with deterministic
+#    text derived from the question and can simulate the latency
+#    of the first token and of every following one, so queries can
+#    be tested and benchmarked without an API key.
+# ----------------------------------------------------------------
+class OpenAIChatBackend:
+    def __init__(self, model):
+        self.model = model
+
+    def complete(self, messages):
+        response = openai.chat.completions.create(model=self.model, messages=messages)
+        return response.choices[0].message.content
+
+    def stream(self, messages):
+        stream = openai.chat.completions.create(model=self.model, messages=messages, stream=True)
+        for chunk in stream:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if token:
+                yield token
+
+
+class FakeChatBackend:
+    WORDS = ("the", "scientist", "of", "Aetheris", "studied", "light", "and", "motion", "in", "his", "tower")
+
+    def __init__(self, latency=0.0, token_latency=0.0, reply_tokens=40):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+
+    def tokens(self, messages):
+        seed = hashlib.sha256(messages[-1]["content"].encode("utf-8")).digest()
+        return [self.WORDS[seed[number % len(seed)] % len(self.WORDS)] + " " for number in range(self.reply_tokens)]
+
+    def complete(self, messages):
+        self.requests += 1
+        time.sleep(self.latency + self.token_latency * self.reply_tokens)
+        return "".join(self.tokens(messages))
+
+    def stream(self, messages):
+        self.requests += 1
+        time.sleep(self.latency)
+        for token in self.tokens(messages):
+            time.sleep(self.token_latency)
+            yield token
@@ -0,0 +1,194 @@
+import time
+import threading
+from collections import OrderedDict
+
+# ----------------------------------------------------------------
+# Conversation store
+#    Sessions are keyed by (teacher, username, agent_name) and kept
+#    in memory in least recently used order. Sessions idle for
+#    longer than idle_ttl, or beyond max_sessions, are offloaded
+#    (written through the offload callback) and dropped from memory;
+#    the next access loads them back lazily. Each session is trimmed
+#    to session_tokens, oldest turns first, while the system prompt
+#    is always kept. Changed sessions are also written out by flush()
+#    so a restart loses at most one flush interval. With write_through
+#    every change is written at once, for processes that share the
+#    conversations; discard() then drops a copy changed elsewhere.
+# ----------------------------------------------------------------
+class Session:
+    def __init__(self, messages):
+        self.messages = messages
+        self.last_used = time.time()
+        self.dirty = False
+
+
+class ConversationStore:
+    def __init__(self, load=None, offload=None, count_tokens=None, max_sessions=2000,
+                 idle_ttl=1800, session_tokens=4000, write_through=False):
+        self.load = load
+        self.offload = offload
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.session_tokens = session_tokens
+        self.write_through = write_through
+        self.sessions = OrderedDict()
+        self.lock = threading.RLock()
+        self.loads = 0
+        self.offloads = 0
+        self.trimmed = 0
+
+    def __contains__(self, key):
+        return self._session(key) is not None
+
+    def _session(self, key):
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                session.last_used = time.time()
+                return session
+
+        messages = self.load(key) if self.load else None
+        if messages is None:
+            return None
+
+        with self.lock:
+            self.loads += 1
+            # Another thread may have loaded or created it in the meantime
+            session = self.sessions.setdefault(key, Session(messages))
+            self.sessions.move_to_end(key)
+        self.evict()
+        return session
+
+    def messages(self, key):
+        session = self._session(key)
+        with self.lock:
+            return list(session.messages) if session else []
+
+    def reset(self, key, messages):
+        with self.lock:
+            session = Session(list(messages))
+            session.dirty = True
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+        self._write(key, session)
+        self.evict()
+
+    def append(self, key, *messages):
+        session = self._session(key)
+        with self.lock:
+            if session is None:
+                session = self.sessions.setdefault(key, Session([]))
+                self.sessions.move_to_end(key)
+            session.messages.extend(messages)
+            session.dirty = True
+            self._trim(session)
+        self._write(key, session)
+        self.evict()
+
+    def _write(self, key, session):
+        if not self.write_through or not self.offload:
+            return
+        with self.lock:
+            messages = list(session.messages)
+            session.dirty = False
+        try:
+            self.offload(key, messages)
+        except Exception:
+            session.dirty = True
+            raise
+
+    def delete(self, key):
+        with self.lock:
+            return self.sessions.pop(key, None) is not None
+
+    def discard(self, key):
+        """Forget the in-memory copy unless it has unsaved changes; the next access loads it again."""
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or session.dirty:
+                return False
+            del self.sessions[key]
+            return True
+
+    def _tokens(self, message):
+        return self.count_tokens(message["content"] or "") + 4
+
+    def _trim(self, session):
+        system = [message for message in session.messages if message["role"] == "system"]
+        turns = [message for message in session.messages if message["role"] != "system"]
+        budget = self.session_tokens - sum(self._tokens(message) for message in system)
+
+        total = sum(self._tokens(message) for message in turns)
+        dropped = 0
+        while dropped < len(turns) and total > budget:
+            total -= self._tokens(turns[dropped])
+            dropped += 1
+        # Never keep an answer without the question it belongs to
+        while dropped < len(turns) and turns[dropped]["role"] != "user":
+            dropped += 1
+
+        if dropped:
+            self.trimmed += dropped
+            session.messages = system + turns[dropped:]
+
+    def window(self, key, max_tokens):
+        """System prompt plus the most recent turns that fit into max_tokens."""
+        messages = self.messages(key)
+        system = [message for message in messages if message["role"] == "system"]
+        turns = [message for message in messages if message["role"] != "system"]
+
+        budget = max_tokens - sum(self._tokens(message) for message in system)
+        recent = []
+        for message in reversed(turns):
+            budget -= self._tokens(message)
+            if budget < 0:
+                break
+            recent.append(message)
+        return system + list(reversed(recent))
+
+    def evict(self):
+        """Offload sessions that were idle too long or exceed max_sessions."""
+        now = time.time()
+        evicted = []
+        with self.lock:
+            while self.sessions:
+                key, session = next(iter(self.sessions.items()))
+                if len(self.sessions) <= self.max_sessions and now - session.last_used <= self.idle_ttl:
+                    break
+                del self.sessions[key]
+                evicted.append((key, session))
+
+        for key, session in evicted:
+            if session.dirty and self.offload:
+                self.offload(key, session.messages)
+                self.offloads += 1
+
+    def flush(self):
+        """Write every changed session through offload and drop idle ones."""
+        if not self.offload:
+            return self.evict()
+
+        with self.lock:
+            dirty = [(key, session, list(session.messages)) for key, session in self.sessions.items() if session.dirty]
+            for _, session, _ in dirty:
+                session.dirty = False
+
+        for key, session, messages in dirty:
+            try:
+                self.offload(key, messages)
+            except Exception:
+                session.dirty = True
+                raise
+        self.evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "loads": self.loads,
+                "offloads": self.offloads,
+                "trimmed_messages": self.trimmed
+            }
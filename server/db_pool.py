@@ -0,0 +1,152 @@
+import time
+import threading
+from contextlib import contextmanager
+from rethinkdb.net import Cursor
+from rethinkdb.errors import ReqlDriverError
+
+# ----------------------------------------------------------------
+# RethinkDB connection pool
+#    A RethinkDB connection must not be shared by threads running
+#    queries at the same time, so every query checks a connection
+#    out of the pool and returns it when the result is read.
+#    Connections are opened lazily up to max_size, pinged before
+#    reuse when they were idle for a while, and replaced when the
+#    driver reports them broken.
+# ----------------------------------------------------------------
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, ping_query, max_size=10, timeout=10.0, health_check_after=30.0):
+        self.connect = connect
+        self.ping_query = ping_query
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.idle = []          # [(connection, returned_at)]
+        self.size = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+        self.failures = 0
+
+    def _healthy(self, connection, returned_at):
+        if not connection.is_open():
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            self.ping_query.run(connection)
+            return True
+        except ReqlDriverError:
+            return False
+
+    def _replace(self, connection):
+        try:
+            connection.close(noreply_wait=False)
+        except Exception:
+            pass
+        self.reconnects += 1
+        return self.connect()
+
+    def checkout(self):
+        start = time.monotonic()
+        with self.condition:
+            if not self.idle and self.size >= self.max_size:
+                self.waiting += 1
+                self.waits += 1
+                try:
+                    if not self.condition.wait_for(lambda: self.idle or self.size < self.max_size, self.timeout):
+                        raise PoolTimeout(f"No database connection available after {self.timeout} s")
+                finally:
+                    self.waiting -= 1
+
+            waited = time.monotonic() - start
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.checkouts += 1
+            self.in_use += 1
+
+            if self.idle:
+                connection, returned_at = self.idle.pop()
+            else:
+                connection, returned_at = None, None
+                self.size += 1
+
+        # Connecting and health checks happen outside the lock
+        try:
+            if connection is None:
+                connection = self.connect()
+            elif not self._healthy(connection, returned_at):
+                connection = self._replace(connection)
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        return connection
+
+    def checkin(self, connection, broken=False):
+        with self.condition:
+            self.in_use -= 1
+            if broken:
+                self.failures += 1
+                self.size -= 1
+                try:
+                    connection.close(noreply_wait=False)
+                except Exception:
+                    pass
+            else:
+                self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        broken = False
+        try:
+            yield connection
+        except ReqlDriverError:
+            broken = True
+            raise
+        finally:
+            self.checkin(connection, broken)
+
+    def run(self, query, **kwargs):
+        """Run a query on a pooled connection; cursors are read completely before the connection is returned."""
+        with self.connection() as connection:
+            result = query.run(connection, **kwargs)
+            if isinstance(result, Cursor):
+                result = list(result)
+            return result
+
+    def close(self):
+        with self.condition:
+            for connection, _ in self.idle:
+                connection.close(noreply_wait=False)
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "total_wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+                "reconnects": self.reconnects,
+                "failures": self.failures
+            }
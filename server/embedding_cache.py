@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# ----------------------------------------------------------------
+# Embedding cache
+#    Keyed by a hash of (model, dimensions, text). Recently used
+#    vectors are kept in a bounded in-memory LRU, every vector is
+#    also written to a local SQLite file so the cache survives
+#    restarts. Vectors are stored as float32. The file is shared by
+#    the worker processes: it is in WAL mode, a batch of vectors is
+#    written in one transaction, and a write that still finds the
+#    file locked after timeout seconds is skipped, the vectors are
+#    only not cached.
+# ----------------------------------------------------------------
+class EmbeddingCache:
+    def __init__(self, path, model, dimensions, max_entries=5000, timeout=5.0):
+        self.model = model
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.write_errors = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT, dimensions INTEGER, vector BLOB)"
+        )
+        self.db.commit()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}\0{self.dimensions}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            try:
+                row = self.db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Error reading the embedding cache: {e}")
+                row = None
+            if row is not None:
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, text, embedding):
+        return self.put_many([(text, embedding)])[0]
+
+    def put_many(self, items):
+        """Cache (text, embedding) pairs, written to disk in one transaction; returns the float32 vectors."""
+        rows = []
+        vectors = []
+        for text, embedding in items:
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((self.key(text), self.model, self.dimensions, vector.tobytes()))
+            vectors.append(vector)
+
+        with self.lock:
+            for row, vector in zip(rows, vectors):
+                self._remember(row[0], vector)
+            try:
+                with self.db:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, model, dimensions, vector) VALUES (?, ?, ?, ?)", rows
+                    )
+            except sqlite3.Error as e:
+                # e.g. still locked by another worker: the vectors are only missing from the disk tier
+                self.write_errors += 1
+                logging.error(f"Error writing {len(rows)} vectors to the embedding cache: {e}")
+        return vectors
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "model": self.model,
+                "dimensions": self.dimensions,
+                "memory_entries": len(self.memory),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "write_errors": self.write_errors,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import openai
+
+# ----------------------------------------------------------------
+# Embedding backends
+#    A backend turns a list of texts into a list of vectors with a
+#    single request. The fake backend derives deterministic vectors
+#    from a hash of the text and can simulate network latency, so
+#    ingestion can be tested and benchmarked without an API key.
+# ----------------------------------------------------------------
+class OpenAIEmbeddingBackend:
+    def __init__(self, model, dimensions=None):
+        self.model = model
+        self.dimensions = dimensions
+
+    def embed(self, texts):
+        kwargs = {"input": texts, "model": self.model}
+        if self.dimensions:
+            kwargs["dimensions"] = self.dimensions
+        response = openai.embeddings.create(**kwargs)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class FakeEmbeddingBackend:
+    def __init__(self, dimensions, latency=0.0, per_item_latency=0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.requests = 0
+
+    def vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def embed(self, texts):
+        self.requests += 1
+        time.sleep(self.latency + self.per_item_latency * len(texts))
+        return [self.vector(text).tolist() for text in texts]
+
+
+def approximate_tokens(text):
+    return len(text) // 4 + 1
+
+# ----------------------------------------------------------------
+# Batching embedder
+#    Cached texts are answered locally, the rest are de-duplicated
+#    and packed into requests of at most max_batch_items texts and
+#    max_batch_tokens tokens. Up to max_concurrency requests run at
+#    the same time.
+# ----------------------------------------------------------------
+class BatchEmbedder:
+    def __init__(self, backend, cache=None, max_batch_items=256, max_batch_tokens=50000,
+                 max_concurrency=4, count_tokens=approximate_tokens):
+        self.backend = backend
+        self.cache = cache
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.count_tokens = count_tokens
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def batches(self, texts):
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_items or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def embed(self, texts):
+        """Return one vector per text, raises if any request fails."""
+        vectors = {}
+        missing = []
+        for text in texts:
+            if text in vectors:
+                continue
+            cached = self.cache.get(text) if self.cache is not None else None
+            if cached is not None:
+                vectors[text] = cached.tolist()
+            else:
+                vectors[text] = None
+                missing.append(text)
+
+        batches = list(self.batches(missing))
+        if len(batches) == 1:
+            results = [self.backend.embed(batches[0])]
+        else:
+            results = list(self.executor.map(self.backend.embed, batches))
+
+        for batch, embeddings in zip(batches, results):
+            for text, embedding in zip(batch, embeddings):
+                vectors[text] = embedding
+            if self.cache is not None:
+                self.cache.put_many(zip(batch, embeddings))
+
+        return [vectors[text] for text in texts]
+
+# ----------------------------------------------------------------
+# Offline throughput benchmark
+#    python3 embeddings.py --chunks 1000 --latency 0.2
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched embedding against the fake backend.")
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per request")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-sizes", default="1,16,64,256")
+    args = parser.parse_args()
+
+    texts = [f"Chunk {number} of a lecture about the scientists of Aetheris." for number in range(args.chunks)]
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        backend = FakeEmbeddingBackend(args.dimensions, latency=args.latency)
+        embedder = BatchEmbedder(backend, max_batch_items=batch_size, max_concurrency=args.concurrency)
+        start = time.perf_counter()
+        embedder.embed(texts)
+        elapsed = time.perf_counter() - start
+        print(f"batch size {batch_size:>5}: {backend.requests:>5} requests, "
+              f"{elapsed:7.2f} s, {args.chunks / elapsed:9.1f} chunks/s")
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from embeddings import FakeEmbeddingBackend
+from chat import FakeChatBackend
+
+# ----------------------------------------------------------------
+# Fake OpenAI API server
+#    Answers /v1/embeddings and /v1/chat/completions (streamed or
+#    not) like the real API, with the deterministic vectors and
+#    replies of the fake backends, so the real OpenAI backends and
+#    the upstream client layer can be tested locally. It simulates
+#    latency and the API's limits: requests above --max-concurrency
+#    in flight or --requests-per-second get a 429 with Retry-After,
+#    and --error-rate of the requests fail with a random 429 or 500.
+#    GET /stats returns the request counts.
+#
+#    python3 fake_openai.py --port 8100 --max-concurrency 4
+#    OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=fake python3 openai-server.py
+# ----------------------------------------------------------------
+class FakeOpenAI:
+    def __init__(self, dimensions=1536, latency=0.05, token_latency=0.0, max_concurrency=None,
+                 requests_per_second=None, error_rate=0.0, retry_after=0.2):
+        self.embeddings = FakeEmbeddingBackend(dimensions)
+        self.chat = FakeChatBackend()
+        self.latency = latency
+        self.token_latency = token_latency
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.window = (0, 0)    # (second, requests in it)
+        self.counts = {"embeddings": 0, "chat": 0, "rate_limited": 0, "errors": 0}
+
+    def admit(self):
+        """None when the request may run, otherwise the error status to answer with."""
+        with self.lock:
+            second = int(time.monotonic())
+            requests = self.window[1] + 1 if self.window[0] == second else 1
+            self.window = (second, requests)
+            if ((self.max_concurrency and self.in_flight >= self.max_concurrency)
+                    or (self.requests_per_second and requests > self.requests_per_second)):
+                self.counts["rate_limited"] += 1
+                return 429
+            if random.random() < self.error_rate:
+                status = random.choice((429, 500))
+                self.counts["rate_limited" if status == 429 else "errors"] += 1
+                return status
+            self.in_flight += 1
+            return None
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, in_flight=self.in_flight)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self.send_json(200, self.server.fake.stats())
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        kind = "embeddings" if self.path.endswith("/embeddings") else "chat" if self.path.endswith("/chat/completions") else None
+        if kind is None:
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        status = fake.admit()
+        if status is not None:
+            error = "rate_limit_exceeded" if status == 429 else "server_error"
+            self.send_json(status, {"error": {"message": f"Fake {error}", "type": error, "code": error}},
+                           headers=[("Retry-After", str(fake.retry_after))] if status == 429 else ())
+            return
+
+        try:
+            with fake.lock:
+                fake.counts[kind] += 1
+            time.sleep(fake.latency)
+            if kind == "embeddings":
+                self.embeddings(body)
+            elif body.get("stream"):
+                self.chat_stream(body)
+            else:
+                self.chat_completion(body)
+        finally:
+            fake.done()
+
+    def embeddings(self, body):
+        fake = self.server.fake
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or fake.embeddings.dimensions
+        data = [{
+            "object": "embedding",
+            "index": index,
+            "embedding": FakeEmbeddingBackend(dimensions).vector(text).tolist()
+        } for index, text in enumerate(texts)]
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        self.send_json(200, {"object": "list", "data": data, "model": body.get("model"),
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def chat_completion(self, body):
+        fake = self.server.fake
+        tokens = fake.chat.tokens(body["messages"])
+        time.sleep(fake.token_latency * len(tokens))
+        self.send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+        })
+
+    def chat_stream(self, body):
+        fake = self.server.fake
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None):
+            payload = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": body.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        for token in fake.chat.tokens(body["messages"]):
+            time.sleep(fake.token_latency)
+            chunk({"content": token})
+        chunk({}, "stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def serve(fake, host="127.0.0.1", port=8100):
+    """Start the fake API on a background thread, returns the HTTP server (port 0 picks a free port)."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI API for local tests of the upstream client layer.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per reply token")
+    parser.add_argument("--max-concurrency", type=int, help="requests in flight before answering 429")
+    parser.add_argument("--requests-per-second", type=int, help="requests per second before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 429 or 500")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="Retry-After seconds sent with 429")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.dimensions, args.latency, args.token_latency, args.max_concurrency,
+                      args.requests_per_second, args.error_rate, args.retry_after)
+    server = serve(fake, args.host, args.port)
+    print(f"Fake OpenAI API listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
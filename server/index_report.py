@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+from vector_index import VECTOR_DTYPES, decode_vector, index_bytes, make_index
+
+# ----------------------------------------------------------------
+# Recall vs memory report
+#    Compares vector formats against exact search over the stored
+#    chunk vectors. Each configuration is a shortened dimension, a
+#    stored format and a FAISS index type. Shortened dimensions are
+#    simulated by truncating and renormalizing the stored vectors,
+#    which matches the `dimensions` parameter of text-embedding-3
+#    models. Queries are held out from the indexed vectors.
+#
+#    python3 index_report.py                      (vectors from RethinkDB)
+#    python3 index_report.py --synthetic 20000    (no database needed)
+# ----------------------------------------------------------------
+def load_vectors(host, port, db, table, limit):
+    from rethinkdb import RethinkDB
+    r = RethinkDB()
+    connection = r.connect(host=host, port=port, db=db)
+    query = r.table(table).has_fields("agent_name").pluck("embedding", "vector_format")
+    if limit:
+        query = query.limit(limit)
+
+    vectors = [decode_vector(record["embedding"], record.get("vector_format")) for record in query.run(connection)]
+    connection.close()
+
+    dimension = max((len(vector) for vector in vectors), default=0)
+    return np.vstack([vector for vector in vectors if len(vector) == dimension]).astype(np.float32)
+
+def synthetic_vectors(count, dimension, clusters=200, seed=0):
+    # Clustered unit vectors with variance decaying along the dimensions,
+    # a rough stand-in for real embeddings when no database is available
+    rng = np.random.default_rng(seed)
+    scale = 1.0 / np.sqrt(np.arange(1, dimension + 1))
+    centers = rng.standard_normal((clusters, dimension)) * scale
+    vectors = centers[rng.integers(0, clusters, count)] + 0.5 * rng.standard_normal((count, dimension)) * scale
+    return normalized(vectors.astype(np.float32))
+
+def normalized(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def recall(found, expected):
+    k = expected.shape[1]
+    return np.mean([len(set(f) & set(e)) / k for f, e in zip(found, expected)])
+
+def measure(base, queries, expected, dimension, vector_format, index_type, k, ef_search):
+    base = normalized(base[:, :dimension])
+    queries = normalized(queries[:, :dimension])
+    if vector_format in VECTOR_DTYPES:
+        base = base.astype(VECTOR_DTYPES[vector_format]).astype(np.float32)
+        stored_bytes = dimension * np.dtype(VECTOR_DTYPES[vector_format]).itemsize
+    else:
+        stored_bytes = len(json.dumps(base[0].tolist()))
+
+    index = make_index(dimension, index_type)
+    if not index.is_trained:
+        index.train(base)
+    index.add(base)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "dimension": dimension,
+        "format": vector_format,
+        "index": index_type,
+        "recall": recall(found, expected),
+        "index_bytes_per_vector": index_bytes(index) / len(base),
+        "stored_bytes_per_vector": stored_bytes,
+        "query_ms": 1000 * elapsed / len(queries)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare recall and memory of vector formats against exact search.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=28015)
+    parser.add_argument("--db", default="mmorpg")
+    parser.add_argument("--table", default="embeddings")
+    parser.add_argument("--limit", type=int, default=0, help="read at most this many stored vectors")
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many synthetic vectors instead of the database")
+    parser.add_argument("--synthetic-dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--ef-search", type=int, default=16)
+    parser.add_argument("--dimensions", default="1536,768,512,256")
+    parser.add_argument("--formats", default="float32,float16")
+    parser.add_argument("--indexes", default="HNSW32,Flat;HNSW32,SQfp16;HNSW32,SQ8;HNSW32,PQ64")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic, args.synthetic_dimension)
+    else:
+        vectors = load_vectors(args.host, args.port, args.db, args.table, args.limit)
+
+    queries, base = vectors[:args.queries], vectors[args.queries:]
+    print(f"{len(base)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries, recall@{args.k}")
+
+    # Ground truth: exact search over the full, unquantized vectors
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(normalized(base))
+    _, expected = exact.search(normalized(queries), args.k)
+
+    print(f"{'dim':>5} {'format':>8} {'index':>16} {'recall':>7} {'index B/vec':>12} {'stored B/vec':>13} {'ms/query':>9}")
+    for dimension in [int(value) for value in args.dimensions.split(",")]:
+        if dimension > vectors.shape[1]:
+            continue
+        for vector_format in args.formats.split(","):
+            for index_type in args.indexes.split(";"):
+                try:
+                    row = measure(base, queries, expected, dimension, vector_format, index_type, args.k, args.ef_search)
+                except RuntimeError as e:
+                    print(f"{dimension:>5} {vector_format:>8} {index_type:>16} skipped: {str(e).splitlines()[0]}")
+                    continue
+                print(f"{row['dimension']:>5} {row['format']:>8} {row['index']:>16} {row['recall']:>7.3f} "
+                      f"{row['index_bytes_per_vector']:>12.0f} {row['stored_bytes_per_vector']:>13.0f} {row['query_ms']:>9.3f}")
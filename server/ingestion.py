@@ -0,0 +1,222 @@
+import os
+import re
+import hashlib
+import tempfile
+import fitz
+import textract
+from collections import deque
+from docx import Document
+
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    encoding = None
+
+SUPPORTED_EXTENSIONS = (".pdf", ".doc", ".docx", ".txt")
+
+# ----------------------------------------------------------------
+# Text extraction
+#    Every handler is a generator yielding the text of a document
+#    page by page (PDF) or paragraph by paragraph (DOCX, TXT), so a
+#    file is never held in memory as a whole. PDFs are opened from
+#    disk and large ones are split into page ranges that a process
+#    pool extracts in parallel, at most max_pending ranges ahead of
+#    the consumer.
+# ----------------------------------------------------------------
+PDF_PAGES_PER_TASK = 16
+TEXT_PART_SIZE = 1 << 16    # text files without blank lines are still read in parts
+
+def pdf_page_count(file_path):
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+def pdf_pages(file_path, start=0, stop=None):
+    """Texts of pages [start, stop) of a PDF; runs in the extraction processes."""
+    with fitz.open(file_path) as doc:
+        stop = doc.page_count if stop is None else min(stop, doc.page_count)
+        return [doc[number].get_text("text") for number in range(start, stop)]
+
+def handle_pdf(file_path, pool=None, max_pending=8):
+    page_count = pdf_page_count(file_path)
+    if pool is None or page_count <= PDF_PAGES_PER_TASK:
+        with fitz.open(file_path) as doc:
+            for page in doc:
+                yield page.get_text("text")
+        return
+
+    ranges = iter(range(0, page_count, PDF_PAGES_PER_TASK))
+    pending = deque()
+    for start in ranges:
+        pending.append(pool.submit(pdf_pages, file_path, start, start + PDF_PAGES_PER_TASK))
+        if len(pending) >= max_pending:
+            break
+
+    while pending:
+        pages = pending.popleft().result()
+        start = next(ranges, None)
+        if start is not None:
+            pending.append(pool.submit(pdf_pages, file_path, start, start + PDF_PAGES_PER_TASK))
+        yield from pages
+
+def handle_doc(file_path):
+    # textract converts the whole document at once, there is nothing to stream.
+    # Its errors are raised, so the file is marked failed instead of its text being the error
+    yield textract.process(file_path).decode("utf-8")
+
+def handle_docx(file_path):
+    doc = Document(file_path)
+    for para in doc.paragraphs:
+        yield para.text
+
+def handle_text(file):
+    """Paragraphs of a text file, read line by line."""
+    paragraph, size = [], 0
+    for line in file:
+        if line.strip():
+            paragraph.append(line)
+            size += len(line)
+        if paragraph and (not line.strip() or size >= TEXT_PART_SIZE):
+            yield "".join(paragraph)
+            paragraph, size = [], 0
+    if paragraph:
+        yield "".join(paragraph)
+
+def iter_text(filepath, pool=None):
+    """Yield the text of a document in parts; pool extracts large PDFs in parallel."""
+    filename = filepath.lower()
+    if filename.endswith(".pdf"):
+        yield from handle_pdf(filepath, pool)
+    elif filename.endswith(".docx"):
+        yield from handle_docx(filepath)
+    elif filename.endswith(".doc"):
+        yield from handle_doc(filepath)
+    elif filename.endswith(".txt"):
+        with open(filepath, 'r', encoding='utf-8') as f:
+            yield from handle_text(f)
+
+def file_hash(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+# ----------------------------------------------------------------
+# Extracted text cache
+#    Keyed by the content hash of the source file, so unchanged
+#    files are never parsed twice (even if renamed or re-uploaded).
+#    Text is written to and read from the cache part by part.
+# ----------------------------------------------------------------
+FAILED_EXTRACTION = "Error extracting text: "
+
+class ExtractionCache:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], content_hash + ".txt")
+
+    def write(self, content_hash, parts):
+        """Store the text of a file part by part, yielding each part once it is written.
+
+        Nothing is stored when extraction fails or the consumer stops early.
+        """
+        path = self.path(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file of our own first, so neither readers nor another
+        # job extracting the same content (another agent, another worker) see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + content_hash, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for number, part in enumerate(parts):
+                    # Parts are separated by a blank line so they are read back as paragraphs
+                    f.write("\n\n" + part if number else part)
+                    yield part
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def parts(self, filepath, content_hash=None, pool=None):
+        """Yield the text of a file in parts, from the cache or extracted (and cached) on the fly."""
+        content_hash = content_hash or file_hash(filepath)
+        path = self.path(content_hash)
+        if os.path.isfile(path) and not self.failed(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                yield from handle_text(f)
+        else:
+            yield from self.write(content_hash, iter_text(filepath, pool))
+
+    @staticmethod
+    def failed(path):
+        # Earlier versions cached the error message of a failed .doc extraction as its text
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read(len(FAILED_EXTRACTION)) == FAILED_EXTRACTION
+
+# ----------------------------------------------------------------
+# Chunking
+#    Paragraphs are packed into chunks of at most max_tokens tokens.
+#    Paragraphs longer than that are packed line by line, and lines
+#    longer than that are cut into overlapping token windows.
+# ----------------------------------------------------------------
+def tokenize(text):
+    if encoding is not None:
+        return encoding.encode(text)
+    # Rough fallback when tiktoken is missing: words and punctuation
+    return re.findall(r"\w+|[^\w\s]", text)
+
+def detokenize(tokens):
+    if encoding is not None:
+        return encoding.decode(tokens)
+    return " ".join(tokens)
+
+def count_tokens(text):
+    return len(tokenize(text))
+
+def text_units(text, max_tokens, overlap):
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+
+        tokens = count_tokens(paragraph)
+        if tokens <= max_tokens:
+            yield paragraph, tokens
+            continue
+
+        for line in paragraph.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+
+            tokens = tokenize(line)
+            if len(tokens) <= max_tokens:
+                yield line, len(tokens)
+                continue
+
+            step = max(1, max_tokens - overlap)
+            for start in range(0, len(tokens), step):
+                window = tokens[start:start + max_tokens]
+                yield detokenize(window), len(window)
+                if start + max_tokens >= len(tokens):
+                    break
+
+def chunk_text(texts, max_tokens=400, overlap=40):
+    """Yield chunks of at most max_tokens tokens from a string or an iterable of strings."""
+    if isinstance(texts, str):
+        texts = [texts]
+
+    current, current_tokens = [], 0
+    for text in texts:
+        for unit, tokens in text_units(text, max_tokens, overlap):
+            if current and current_tokens + tokens > max_tokens:
+                yield "\n".join(current)
+                current, current_tokens = [], 0
+
+            current.append(unit)
+            current_tokens += tokens
+
+    if current:
+        yield "\n".join(current)
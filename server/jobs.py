@@ -0,0 +1,123 @@
+import time
+import uuid
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+# ----------------------------------------------------------------
+# Background ingestion jobs
+#    Uploads are turned into jobs that a small pool of worker
+#    threads runs one after another. Jobs report their progress
+#    by file and by chunk; the last max_jobs jobs are kept for
+#    the status endpoint. on_change(job) is called when a job is
+#    queued, starts, finishes or reports progress through
+#    changed(), e.g. to publish it to other processes.
+# ----------------------------------------------------------------
+class IngestionJob:
+    def __init__(self, teacher, agent_name, filename):
+        self.id = uuid.uuid4().hex
+        self.teacher = teacher
+        self.agent_name = agent_name
+        self.filename = filename
+        self.status = "queued"
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.retries = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.chunks_total = 0
+        self.chunks_done = 0
+        self.current_file = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "teacher": self.teacher,
+            "agent_name": self.agent_name,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "retries": self.retries,
+            "progress": {
+                "files_total": self.files_total,
+                "files_done": self.files_done,
+                "chunks_total": self.chunks_total,
+                "chunks_done": self.chunks_done,
+                "current_file": self.current_file
+            }
+        }
+
+
+class JobQueue:
+    def __init__(self, handler, workers=2, max_jobs=1000, on_change=None):
+        self.handler = handler
+        self.on_change = on_change
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, teacher, agent_name, filename):
+        job = IngestionJob(teacher, agent_name, filename)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.start()
+        self.changed(job)
+        self.queue.put(job)
+        return job
+
+    def changed(self, job):
+        if self.on_change:
+            try:
+                self.on_change(job)
+            except Exception as e:
+                logging.error(f"Error while publishing job {job.id}: {e}")
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self, teacher=None):
+        with self.lock:
+            return [job for job in self.jobs.values() if teacher is None or job.teacher == teacher]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.status = "running"
+            job.started = time.time()
+            self.changed(job)
+            try:
+                self.handler(job)
+                job.status = "done"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished = time.time()
+                self.changed(job)
+                self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queue_depth": self.queue.qsize(), "jobs": counts}
@@ -0,0 +1,134 @@
+import re
+import math
+import threading
+from collections import Counter
+
+# ----------------------------------------------------------------
+# Per (teacher, agent) lexical index
+#    An in-memory inverted index over the stored chunks, scored
+#    with BM25. Besides the hits, search() returns a confidence:
+#    the share of the question's IDF weight that the best chunk
+#    matches, where terms that appear in no chunk count with the
+#    highest possible IDF. A question whose rare terms all occur
+#    in one chunk gets a confidence close to 1.
+# ----------------------------------------------------------------
+def terms(text):
+    return [term for term in re.findall(r"\w+", text.lower()) if len(term) > 1 and not term.isdigit()]
+
+
+class AgentLexicon:
+    def __init__(self):
+        self.postings = {}      # term -> {document id: term frequency}
+        self.lengths = {}       # document id -> number of terms
+        self.doc_terms = {}     # document id -> its distinct terms
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        counts = Counter(terms(text))
+        for term, frequency in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+        self.lengths[doc_id] = sum(counts.values())
+        self.doc_terms[doc_id] = list(counts)
+        self.total_length += self.lengths[doc_id]
+
+    def remove(self, doc_id):
+        length = self.lengths.pop(doc_id, None)
+        if length is None:
+            return False
+        self.total_length -= length
+        for term in self.doc_terms.pop(doc_id):
+            del self.postings[term][doc_id]
+            if not self.postings[term]:
+                del self.postings[term]
+        return True
+
+    def idf(self, term):
+        count = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.lengths) - count + 0.5) / (count + 0.5))
+
+
+class LexicalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lexicons = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.lexicons and len(self.lexicons[key]) > 0
+
+    def add_many(self, key, doc_ids, texts):
+        with self.lock:
+            lexicon = self.lexicons.setdefault(key, AgentLexicon())
+            for doc_id, text in zip(doc_ids, texts):
+                lexicon.add(doc_id, text)
+
+    def remove(self, key, doc_ids):
+        with self.lock:
+            lexicon = self.lexicons.get(key)
+            if lexicon is None:
+                return 0
+            removed = sum(lexicon.remove(doc_id) for doc_id in doc_ids)
+            if not lexicon:
+                del self.lexicons[key]
+            return removed
+
+    def rebuild(self, records):
+        """Replace every lexicon with the given {"id", "teacher", "agent_name", "text"} records."""
+        lexicons = {}
+        for record in records:
+            text = record.get("text")
+            if not text:
+                continue
+            lexicons.setdefault((record["teacher"], record["agent_name"]), AgentLexicon()).add(record["id"], text)
+
+        with self.lock:
+            self.lexicons = lexicons
+        return sum(len(lexicon) for lexicon in lexicons.values())
+
+    def search(self, key, text, k):
+        """Return ([(document id, BM25 score)], confidence) for the k best matching chunks."""
+        query_terms = set(terms(text))
+        with self.lock:
+            lexicon = self.lexicons.get(key)
+            if lexicon is None or not query_terms:
+                return [], 0.0
+
+            count = len(lexicon.lengths)
+            average_length = lexicon.total_length / count if count else 0
+            max_idf = math.log(1 + (count + 0.5) / 0.5)
+
+            scores = Counter()
+            matched = {}
+            weights = {}
+            for term in query_terms:
+                documents = lexicon.postings.get(term)
+                if not documents:
+                    weights[term] = max_idf
+                    continue
+
+                idf = weights[term] = lexicon.idf(term)
+                for doc_id, frequency in documents.items():
+                    norm = 1 - self.b + self.b * lexicon.lengths[doc_id] / average_length
+                    scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+                    matched.setdefault(doc_id, set()).add(term)
+
+        hits = scores.most_common(k)
+        if not hits:
+            return [], 0.0
+
+        confidence = sum(weights[term] for term in matched[hits[0][0]]) / sum(weights.values())
+        return hits, confidence
+
+    def stats(self):
+        with self.lock:
+            return {
+                "agents": len(self.lexicons),
+                "chunks": sum(len(lexicon) for lexicon in self.lexicons.values()),
+                "terms": sum(len(lexicon.postings) for lexicon in self.lexicons.values())
+            }
@@ -0,0 +1,191 @@
+import time
+import uuid
+import base64
+import threading
+from rethinkdb import ast
+
+# ----------------------------------------------------------------
+# In-memory stand-in for RethinkDB
+#    Runs the ReQL queries this server builds against Python dicts,
+#    with the same interface as ConnectionPool (run(), stats()), so
+#    the service can be benchmarked without a database. Secondary
+#    indexes are kept as hash maps like real ones; every query
+#    sleeps for latency seconds to simulate the network round trip.
+#    Only the terms used by openai-server.py are supported.
+# ----------------------------------------------------------------
+class Selection:
+    def __init__(self, table, docs, single=False):
+        self.table = table
+        self.docs = docs
+        self.single = single    # result of get(): one document or None
+
+
+class MemoryDB:
+    def __init__(self, db_name="mmorpg", latency=0.0):
+        self.db_name = db_name
+        self.latency = latency
+        self.tables = {}        # table -> {primary key: document}
+        self.indexes = {}       # table -> {index name: [fields]}
+        self.lookups = {}       # table -> {index name: {key: {primary key}}}
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def create_table(self, table):
+        self.tables.setdefault(table, {})
+        self.indexes.setdefault(table, {})
+        self.lookups.setdefault(table, {})
+
+    def create_index(self, table, name, fields=None):
+        self.create_table(table)
+        self.indexes[table][name] = fields or [name]
+        self.lookups[table][name] = {}
+        for key, doc in self.tables[table].items():
+            self._index(table, name, key, doc)
+
+    def _index_key(self, table, name, doc):
+        fields = self.indexes[table][name]
+        if any(field not in doc for field in fields):
+            return None
+        values = [doc[field] for field in fields]
+        return tuple(values) if len(values) > 1 else values[0]
+
+    def _index(self, table, name, key, doc):
+        index_key = self._index_key(table, name, doc)
+        if index_key is not None:
+            self.lookups[table][name].setdefault(index_key, set()).add(key)
+
+    def _unindex(self, table, key, doc):
+        for name in self.indexes[table]:
+            index_key = self._index_key(table, name, doc)
+            if index_key is not None:
+                self.lookups[table][name].get(index_key, set()).discard(key)
+
+    def insert(self, table, docs, conflict="error"):
+        inserted = replaced = errors = 0
+        keys = []
+        for doc in docs:
+            doc = dict(doc)
+            key = doc.setdefault("id", str(uuid.uuid4()))
+            keys.append(key)
+            old = self.tables[table].get(key)
+            if old is not None:
+                if conflict not in ("replace", "update"):
+                    errors += 1
+                    continue
+                self._unindex(table, key, old)
+                if conflict == "update":
+                    doc = dict(old, **doc)
+                replaced += 1
+            else:
+                inserted += 1
+            self.tables[table][key] = doc
+            for name in self.indexes[table]:
+                self._index(table, name, key, doc)
+        return {"inserted": inserted, "replaced": replaced, "errors": errors, "generated_keys": keys}
+
+    def delete(self, selection):
+        deleted = 0
+        for doc in selection.docs:
+            if self.tables[selection.table].pop(doc["id"], None) is not None:
+                self._unindex(selection.table, doc["id"], doc)
+                deleted += 1
+        return {"deleted": deleted}
+
+    def run(self, query, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.queries += 1
+            result = self.evaluate(query)
+        if isinstance(result, Selection) and result.single:
+            result = dict(result.docs[0]) if result.docs else None
+        elif isinstance(result, Selection):
+            result = [dict(doc) for doc in result.docs]
+        elif isinstance(result, dict):
+            result = dict(result)
+        return result
+
+    def evaluate(self, term):
+        args = term._args
+        if isinstance(term, ast.Datum):
+            return term.data
+        if isinstance(term, ast.Binary):
+            return base64.b64decode(term.base64_data)
+        if isinstance(term, ast.MakeArray):
+            return [self.evaluate(arg) for arg in args]
+        if isinstance(term, ast.MakeObj):
+            return {key: self.evaluate(value) for key, value in term.optargs.items()}
+        if isinstance(term, ast.Now):
+            return time.time()
+        if isinstance(term, ast.DbList):
+            return [self.db_name]
+        if isinstance(term, ast.DbCreate):
+            return {"dbs_created": 0}
+        if isinstance(term, (ast.TableList, ast.TableListTL)):
+            return list(self.tables)
+        if isinstance(term, (ast.TableCreate, ast.TableCreateTL)):
+            self.create_table(self.evaluate(args[-1]))
+            return {"tables_created": 1}
+
+        if isinstance(term, ast.Table):
+            table = self.evaluate(args[0])
+            if table not in self.tables:
+                raise KeyError(f"Table `{self.db_name}.{table}` does not exist.")
+            return Selection(table, list(self.tables[table].values()))
+        if isinstance(term, ast.IndexList):
+            return list(self.indexes[self.evaluate(args[0]).table])
+        if isinstance(term, ast.IndexCreate):
+            table, name = self.evaluate(args[0]).table, self.evaluate(args[1])
+            fields = None
+            if len(args) > 2:
+                # lambda row: [row[field], ...] arrives as Func(args, MakeArray(Bracket(row, field), ...))
+                body = args[2]._args[1]
+                fields = [self.evaluate(bracket._args[1]) for bracket in body._args]
+            self.create_index(table, name, fields)
+            return {"created": 1}
+        if isinstance(term, ast.IndexWait):
+            return [{"index": self.evaluate(args[1]), "ready": True}]
+
+        if isinstance(term, ast.Get):
+            table = self.evaluate(args[0]).table
+            doc = self.tables[table].get(self.evaluate(args[1]))
+            return Selection(table, [doc] if doc is not None else [], single=True)
+        if isinstance(term, ast.GetAll):
+            table = self.evaluate(args[0]).table
+            name = self.evaluate(term.optargs["index"]) if "index" in term.optargs else "id"
+            docs = []
+            for key in (self.evaluate(arg) for arg in args[1:]):
+                if name == "id":
+                    doc = self.tables[table].get(key)
+                    docs += [doc] if doc is not None else []
+                else:
+                    key = tuple(key) if isinstance(key, list) else key
+                    docs += [self.tables[table][primary] for primary in self.lookups[table][name].get(key, ())]
+            return Selection(table, docs)
+        if isinstance(term, ast.HasFields):
+            selection = self.evaluate(args[0])
+            fields = [self.evaluate(arg) for arg in args[1:]]
+            return Selection(selection.table, [doc for doc in selection.docs if all(field in doc for field in fields)])
+        if isinstance(term, ast.Filter):
+            selection = self.evaluate(args[0])
+            match = self.evaluate(args[1])
+            return Selection(selection.table, [
+                doc for doc in selection.docs if all(doc.get(key) == value for key, value in match.items())
+            ])
+        if isinstance(term, ast.Pluck):
+            selection = self.evaluate(args[0])
+            fields = [self.evaluate(arg) for arg in args[1:]]
+            return [{field: doc[field] for field in fields if field in doc} for doc in selection.docs]
+        if isinstance(term, ast.Insert):
+            table = self.evaluate(args[0]).table
+            docs = self.evaluate(args[1])
+            conflict = self.evaluate(term.optargs["conflict"]) if "conflict" in term.optargs else "error"
+            return self.insert(table, docs if isinstance(docs, list) else [docs], conflict)
+        if isinstance(term, ast.Delete):
+            return self.delete(self.evaluate(args[0]))
+
+        raise NotImplementedError(f"{type(term).__name__} is not supported by the in-memory database")
+
+    def stats(self):
+        with self.lock:
+            return {"queries": self.queries, "tables": {table: len(docs) for table, docs in self.tables.items()}}
@@ -0,0 +1,174 @@
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+# ----------------------------------------------------------------
+# Request metrics
+#    Counters and latency histograms with labels, kept in memory
+#    and rendered in the Prometheus text format or as JSON. A trace
+#    times the stages of one request or ingestion job; when it
+#    finishes, its total and every stage go into the histograms,
+#    and traces slower than slow_seconds are written to the slow
+#    log with their stage breakdown (a slow_sample_rate share of
+#    them, to keep the log small under load).
+# ----------------------------------------------------------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def render_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        position = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[position] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[position] if position < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+class Trace:
+    def __init__(self, metrics, kind, **labels):
+        self.metrics = metrics
+        self.kind = kind
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self, status="ok"):
+        total = time.perf_counter() - self.start
+        self.metrics.record(self, status, total)
+        return total
+
+
+class Metrics:
+    def __init__(self, slow_seconds=None, slow_sample_rate=1.0, slow_log=None):
+        self.slow_seconds = slow_seconds
+        self.slow_sample_rate = slow_sample_rate
+        self.slow_log = slow_log
+        self.counters = {}      # name -> {label key: value}
+        self.histograms = {}    # name -> {label key: Histogram}
+        self.slow_requests = 0
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def trace(self, kind, **labels):
+        return Trace(self, kind, **labels)
+
+    def record(self, trace, status, total):
+        # Stage histograms are labelled by stage only, per agent labels would multiply the series
+        self.observe(f"{trace.kind}_seconds", total, status=status)
+        self.increment(f"{trace.kind}_total", status=status)
+        for name, seconds in trace.stages.items():
+            self.observe(f"{trace.kind}_stage_seconds", seconds, stage=name)
+
+        if self.slow_seconds is None or total < self.slow_seconds or random.random() >= self.slow_sample_rate:
+            return
+        with self.lock:
+            self.slow_requests += 1
+        if self.slow_log:
+            self.slow_log.warning(json.dumps({
+                "kind": trace.kind,
+                "status": status,
+                "labels": trace.labels,
+                "total_ms": round(1000 * total, 2),
+                "stages_ms": {name: round(1000 * seconds, 2) for name, seconds in trace.stages.items()}
+            }, ensure_ascii=False))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.to_dict()} for key, histogram in series.items()]
+                    for name, series in self.histograms.items()
+                },
+                "slow_requests": self.slow_requests
+            }
+
+    def render(self, gauges=()):
+        """Prometheus text format; gauges is a list of (name, labels dict, value) read at scrape time."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{render_labels(key)} {value}")
+
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{render_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{render_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{render_labels(key)} {histogram.count}")
+
+        typed = set()
+        for name, labels, value in gauges:
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{render_labels(label_key(labels))} {value}")
+        return "\n".join(lines) + "\n"
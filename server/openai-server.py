@@ -1,19 +1,43 @@
 #!/usr/bin/env python3
 import os
+import sys
+import re
+import json
+import time
+import random
+import itertools
+import asyncio
 import openai
 import hashlib
 import hmac
+import fcntl
+import socket
 import numpy as np
-import faiss
-import fitz
 import logging
 from rethinkdb import RethinkDB
 from collections import defaultdict
-from flask import Flask, jsonify, request, send_from_directory
-from docx import Document
-from io import BytesIO
+from flask import Flask, Response, jsonify, request
+from a2wsgi import WSGIMiddleware
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from rethinkdb.net import Cursor
 import tempfile
-import textract
+import threading
+import atexit
+import uvicorn
+from vector_index import IndexManager, IndexPolicy, decode_vector, encode_vector
+from ingestion import ExtractionCache, SUPPORTED_EXTENSIONS, chunk_text, count_tokens, file_hash
+from embedding_cache import EmbeddingCache
+from embeddings import BatchEmbedder, FakeEmbeddingBackend, OpenAIEmbeddingBackend
+from chat import FakeChatBackend, OpenAIChatBackend
+from answer_cache import SemanticAnswerCache
+from db_pool import ConnectionPool
+from conversation_store import ConversationStore
+from jobs import JobQueue
+from changefeed import ChangefeedFollower
+from lexical_index import LexicalIndex
+from metrics import Metrics
+from static_assets import StaticAssets
+from upstream import LimitedChatBackend, LimitedEmbeddingBackend, UpstreamClient
 
 app = Flask(__name__)
 
@@ -26,138 +50,851 @@ openai.api_key = os.environ.get("OPENAI_API_KEY")
 # If you prefer to hardcode your key (not recommended):
 # openai.api_key = "sk-xxxx..."
 
-# ----------------------------------------------------------------
-# In-memory store of conversations
-#    Key: (username, agentName)
-#    Value: [ {"role":"system","content": ...}, {"role":"user","content": ...}, ... ]
-# ----------------------------------------------------------------
-conversations = {}
-
 # Data to connect to the local RethinkDB
 r = RethinkDB()
 db_host = "localhost"
 db_port = 28015
 db_embedding_table = "embeddings"
+db_conversation_table = "conversations"
+db_jobs_table = "ingestion_jobs"
+db_documents_table = "documents"
+db_summaries_table = "agent_summaries"
 db_name = "mmorpg"
 
-# Document store 
+# Document store
+#    dimension below 1536 asks text-embedding-3-small for shortened vectors;
+#    VECTOR_FORMAT is how vectors are stored in the database ("float32",
+#    "float16" or "json") and INDEX_STORAGE how the per-agent indexes keep
+#    them ("Flat", "SQfp16", "SQ8" or "PQ64"). Agents get exact search below
+#    INDEX_FLAT_BELOW chunks, HNSW up to INDEX_IVF_FROM chunks and IVF above.
+#    Run index_report.py to compare the recall and memory of these choices
+#    and tune_indexes.py to tune INDEX_EF_SEARCH / INDEX_NPROBE per agent.
+#    Changing the dimension needs the files to be uploaded again.
 dimension = 1536
-agent_document_indexes = defaultdict(lambda: faiss.IndexHNSWFlat(dimension, 32))
-agent_doc_map = defaultdict(list)
+embedding_model = "text-embedding-3-small"
+chat_model = "gpt-4o-mini"  # You can adjust the model
+VECTOR_FORMAT = "float32"
+INDEX_STORAGE = "Flat"
+INDEX_FLAT_BELOW = 1000
+INDEX_IVF_FROM = 50000
+INDEX_EF_SEARCH = 64
+INDEX_NPROBE = 16
+INDEX_TUNING_FILE = 'index_tuning.json'
+INDEX_SNAPSHOT_FOLDER = 'index_snapshots'
+index_policy = IndexPolicy(
+    storage=INDEX_STORAGE,
+    flat_below=INDEX_FLAT_BELOW,
+    ivf_from=INDEX_IVF_FROM,
+    ef_search=INDEX_EF_SEARCH,
+    nprobe=INDEX_NPROBE
+)
+index_policy.load_overrides(INDEX_TUNING_FILE)
+document_indexes = IndexManager(dimension, policy=index_policy, snapshot_folder=INDEX_SNAPSHOT_FOLDER)
+
+# RethinkDB connections, every query checks one out of the pool
+DB_POOL_SIZE = 16
+db_pool = ConnectionPool(
+    lambda: r.connect(host=db_host, port=db_port, db=db_name),
+    r.expr(1),
+    max_size=DB_POOL_SIZE
+)
 
-# RethinkDB connection
-conn = r.connect(host=db_host, port=db_port, db=db_name)
+# ----------------------------------------------------------------
+# Store of conversations
+#    Key: (teacher, username, agentName)
+#    Value: [ {"role":"system","content": ...}, {"role":"user","content": ...}, ... ]
+#    Idle sessions are offloaded to the conversations table and
+#    loaded back on their next use.
+# ----------------------------------------------------------------
+CONVERSATION_MAX_SESSIONS = 2000
+CONVERSATION_IDLE_TTL = 1800        # seconds before an idle session leaves memory
+CONVERSATION_SESSION_TOKENS = 4000  # history kept per session
+CONVERSATION_WINDOW_TOKENS = 1500   # history sent to the model with each question
+CONVERSATION_FLUSH_INTERVAL = 30    # seconds between writes of changed sessions
+
+def conversation_id(key):
+    return hashlib.sha1("/".join(key).encode("utf-8")).hexdigest()
+
+def load_conversation(key):
+    record = db_pool.run(r.table(db_conversation_table).get(conversation_id(key)))
+    return record["messages"] if record else None
+
+def save_conversation(key, messages):
+    teacher, username, agent_name = key
+    db_pool.run(r.table(db_conversation_table).insert({
+        "id": conversation_id(key),
+        "teacher": teacher,
+        "username": username,
+        "agent_name": agent_name,
+        "messages": messages,
+        "updated": r.now(),
+        "writer": WORKER_ID
+    }, conflict="replace"))
+
+conversations = ConversationStore(
+    load=load_conversation,
+    offload=save_conversation,
+    count_tokens=count_tokens,
+    max_sessions=CONVERSATION_MAX_SESSIONS,
+    idle_ttl=CONVERSATION_IDLE_TTL,
+    session_tokens=CONVERSATION_SESSION_TOKENS
+)
+
+def flush_conversations_periodically():
+    while True:
+        time.sleep(CONVERSATION_FLUSH_INTERVAL)
+        try:
+            conversations.flush()
+        except Exception as e:
+            logging.error(f"Error while saving conversations: {e}")
 
 # Folder to save uploaded files
 UPLOAD_FOLDER = 'lecture_materials'
 
+# Extracted text of uploaded files, keyed by file content hash
+extraction_cache = ExtractionCache('extracted_text')
+
+# Embeddings of already seen texts (document chunks and student questions)
+embedding_cache = EmbeddingCache(os.path.join('cache', 'embeddings.sqlite3'), embedding_model, dimension)
+
+# OpenAI calls go through one limited client per API: requests in flight,
+# requests per second and tokens per minute are capped, rate limits and
+# server errors are retried with jittered backoff, and identical requests
+# in flight (a class asking the same question) share one call.
+# The limits are for the whole server and are enforced in each process,
+# which gets 1/SERVER_WORKERS of them (--workers N sets it, set it by hand
+# when starting the workers another way, e.g. with gunicorn).
+# Set OPENAI_BASE_URL to point the server at fake_openai.py.
+TRANSIENT_OPENAI_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+OPENAI_RETRIES = 4
+EMBEDDING_MAX_CONCURRENCY = 8
+EMBEDDING_REQUESTS_PER_SECOND = 50
+EMBEDDING_TOKENS_PER_MINUTE = 1000000
+CHAT_MAX_CONCURRENCY = 32
+CHAT_REQUESTS_PER_SECOND = 50
+CHAT_TOKENS_PER_MINUTE = 2000000
+RATE_LIMIT_RETRY_AFTER = 5      # seconds, sent with 503 when the chat client gave up on a rate limit
+SERVER_WORKERS = max(1, int(os.environ.get("SERVER_WORKERS", "1")))
+openai.max_retries = 0          # retried by the upstream clients
+embedding_client = UpstreamClient(
+    "embeddings", max(1, EMBEDDING_MAX_CONCURRENCY // SERVER_WORKERS), EMBEDDING_REQUESTS_PER_SECOND / SERVER_WORKERS,
+    EMBEDDING_TOKENS_PER_MINUTE / SERVER_WORKERS, retries=OPENAI_RETRIES, retry_on=TRANSIENT_OPENAI_ERRORS
+)
+chat_client = UpstreamClient(
+    "chat", max(1, CHAT_MAX_CONCURRENCY // SERVER_WORKERS), CHAT_REQUESTS_PER_SECOND / SERVER_WORKERS,
+    CHAT_TOKENS_PER_MINUTE / SERVER_WORKERS, retries=OPENAI_RETRIES, retry_on=TRANSIENT_OPENAI_ERRORS
+)
+
+# Set EMBEDDING_BACKEND=fake to run without the OpenAI API (offline tests and benchmarks)
+if os.environ.get("EMBEDDING_BACKEND") == "fake":
+    embedding_backend = FakeEmbeddingBackend(dimension)
+else:
+    embedding_backend = OpenAIEmbeddingBackend(embedding_model, dimensions=dimension)
+embedder = BatchEmbedder(LimitedEmbeddingBackend(embedding_backend, embedding_client, count_tokens),
+                         cache=embedding_cache, count_tokens=count_tokens)
+
+# Set CHAT_BACKEND=fake to answer questions without the OpenAI API
+if os.environ.get("CHAT_BACKEND") == "fake":
+    chat_backend = FakeChatBackend()
+else:
+    chat_backend = OpenAIChatBackend(chat_model)
+limited_chat = LimitedChatBackend(chat_backend, chat_client, count_tokens)
+
+# Background ingestion of uploaded files
+INGESTION_WORKERS = 2
+EXTRACTION_PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+EMBEDDING_RETRIES = 2            # job level retries once the embedding client gave up
+EMBEDDING_PROGRESS_STEP = 256    # chunks extracted, embedded, stored and indexed at a time
+extraction_pool = None
+extraction_pool_lock = threading.Lock()
+INGESTION_LOCK_FOLDER = 'ingestion_locks'
+ingestion_locks = {}
+ingestion_locks_lock = threading.Lock()
+
+# Answers to near-duplicate questions, per (teacher, agent)
+ANSWER_CACHE_THRESHOLD = 0.95   # cosine similarity needed to reuse an answer
+ANSWER_CACHE_TTL = 3600         # seconds
+answer_cache = SemanticAnswerCache(dimension, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL)
+
+# Keyword (BM25) index of the same chunks. Questions whose terms are matched
+# confidently by one chunk skip the embeddings call, the others merge
+# lexical and vector hits by reciprocal rank.
+RETRIEVAL_TOP_K = 5             # chunks put into the prompt
+RETRIEVAL_CANDIDATES = 10       # hits taken from each index before merging
+LEXICAL_FAST_PATH_CONFIDENCE = 0.65   # share of the question's term weight matched by one chunk
+RRF_K = 60                      # rank offset of reciprocal rank fusion
+lexical_index = LexicalIndex()
+
+# Stage latencies of queries and ingestion jobs, served on /metrics.
+# Requests slower than SLOW_REQUEST_SECONDS are written to SLOW_REQUEST_LOG
+# with their stage breakdown; lower SLOW_REQUEST_SAMPLE_RATE to log only
+# a share of them.
+SLOW_REQUEST_SECONDS = 5.0
+SLOW_REQUEST_SAMPLE_RATE = 1.0
+SLOW_REQUEST_LOG = 'slow_requests.log'
+slow_request_log = logging.getLogger("slow_requests")
+slow_request_log.propagate = False
+slow_request_log.setLevel(logging.WARNING)
+slow_request_log.addHandler(logging.FileHandler(SLOW_REQUEST_LOG, delay=True))
+slow_request_log.handlers[-1].setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+metrics = Metrics(slow_seconds=SLOW_REQUEST_SECONDS, slow_sample_rate=SLOW_REQUEST_SAMPLE_RATE, slow_log=slow_request_log)
+
 def find_embedding_for_scientist(teacher, scientist):
-    record = list(r.table(db_embedding_table).filter({
-        "teacher": teacher,
-        "scientist": scientist
-    }).run(conn))
+    record = list(db_pool.run(r.table(db_embedding_table).get_all(
+        [teacher, scientist], index="teacher_scientist"
+    )))
     
     if record:
-        return np.array(record[0]['embedding'], dtype=np.float32)
+        return decode_vector(record[0]['embedding'], record[0].get('vector_format'))
     return None
 
 def load_embeddings_from_database():
-    documents = list(r.table(db_embedding_table).run(conn))
-    total_embeddings = 0
+    # Full rebuild of every index; uploads only apply deltas through document_indexes
+    documents = db_pool.run(r.table(db_embedding_table))
+    total_embeddings = document_indexes.rebuild(documents)
+    document_indexes.save_all_snapshots()
+    lexical_index.rebuild([doc for doc in documents if doc.get("agent_name")])
 
-    for doc in documents:
-        teacher = doc.get("teacher")
-        agent_name = doc.get("agent_name")
-        embedding = doc.get("embedding")
-        doc_id = doc.get("id")
+    print(f"Loaded {total_embeddings} document embeddings into FAISS.")
 
-        if not all([teacher, agent_name, embedding, doc_id]):
-            continue
+def load_indexes():
+    # Memory-map the saved snapshots and only rebuild the indexes that
+    # no longer match the document ids stored in the database
+    loaded = document_indexes.load_snapshots()
+    stale = sync_indexes()
+    print(f"Loaded {loaded} index snapshots, rebuilt {len(stale)} out of date indexes.")
+
+def sync_indexes():
+    """Rebuild the lexical index and every vector index that differs from the database, returns the rebuilt keys."""
+    # The lexical index is built from the same scan, it is not saved to disk
+    records = db_pool.run(r.table(db_embedding_table).has_fields("agent_name").pluck("id", "teacher", "agent_name", "text"))
+    lexical_index.rebuild(records)
+
+    db_doc_ids = defaultdict(set)
+    for record in records:
+        db_doc_ids[(record["teacher"], record["agent_name"])].add(record["id"])
+
+    stale = document_indexes.stale_keys(db_doc_ids)
+    for teacher, agent_name in stale:
+        documents = db_pool.run(r.table(db_embedding_table).get_all(
+            [teacher, agent_name], index="teacher_agent"
+        ))
+        document_indexes.rebuild_key((teacher, agent_name), documents)
+        document_indexes.save_snapshot((teacher, agent_name))
+    return stale
+
+def document_id(*parts):
+    # Stable primary key so re-uploads replace the previous record instead of piling up
+    return hashlib.sha1("/".join(parts).encode("utf-8")).hexdigest()
+
+
+def get_embeddings(texts):
+    try:
+        return embedder.embed(texts)
+    except Exception as e:
+        print(f"Error while retrieving embeddings: {e}")
 
-        index_key = (teacher, agent_name)
+    return None
 
-        if index_key not in agent_document_indexes:
-            agent_document_indexes[index_key] = faiss.IndexHNSWFlat(dimension, 32)
+def get_embedding(text: str):
+    embeddings = get_embeddings([text])
+    return embeddings[0] if embeddings else None
+
+def embed_with_retry(texts, job=None):
+    # The embedding client already retries, this only waits out longer outages of a job
+    for attempt in range(EMBEDDING_RETRIES + 1):
+        try:
+            return embedder.embed(texts)
+        except TRANSIENT_OPENAI_ERRORS as e:
+            if attempt == EMBEDDING_RETRIES:
+                raise
+            if job:
+                job.retries += 1
+            print(f"Retrying embeddings after error: {e}")
+            time.sleep(10 * 2 ** attempt + random.random())
+
+def store_chunks(teacher, agent_name, source, content_hash, chunks, trace, job=None, first=0):
+    """Embed, store and index a batch of chunks of one file numbered from first, returns their document ids."""
+    with trace.stage("embedding"):
+        embeddings = embed_with_retry(chunks, job) if chunks else []
+    if job:
+        job.chunks_done += len(chunks)
+
+    records = [{
+        "id": document_id(teacher, agent_name, source, content_hash, str(number)),
+        "teacher": teacher,
+        "agent_name": agent_name,
+        "source": source,
+        "content_hash": content_hash,
+        "chunk": number,
+        "text": chunk,
+        "embedding": encode_vector(embedding, VECTOR_FORMAT),
+        "vector_format": VECTOR_FORMAT
+    } for number, (chunk, embedding) in enumerate(zip(chunks, embeddings), first)]
+
+    if records:
+        with trace.stage("store"):
+            db_pool.run(r.table(db_embedding_table).insert(records, conflict="replace"))
+        with trace.stage("index"):
+            document_indexes.add_many((teacher, agent_name), [rec["id"] for rec in records], embeddings)
+            lexical_index.add_many((teacher, agent_name), [rec["id"] for rec in records], chunks)
+        answer_cache.invalidate((teacher, agent_name))
+        drop_agent_summary(teacher, agent_name)
+        metrics.increment("ingested_chunks_total", len(records), teacher=teacher, agent=agent_name)
+
+    return [rec["id"] for rec in records]
+
+def remove_documents(teacher, agent_name, doc_ids):
+    if doc_ids:
+        db_pool.run(r.table(db_embedding_table).get_all(*doc_ids).delete())
+        document_indexes.remove((teacher, agent_name), doc_ids)
+        lexical_index.remove((teacher, agent_name), doc_ids)
+        answer_cache.invalidate((teacher, agent_name))
+        drop_agent_summary(teacher, agent_name)
+
+def fetch_chunk_texts(doc_ids):
+    """Texts of the given chunks in the same order, fetched with a single query."""
+    if not doc_ids:
+        return []
+    records = db_pool.run(r.table(db_embedding_table).get_all(*doc_ids).pluck("id", "text"))
+    texts = {record["id"]: record["text"] for record in records}
+    return [texts[doc_id] for doc_id in doc_ids if doc_id in texts]
+
+def ingested_sources(teacher, agent_name):
+    """Map each ingested file of an agent to (content hash, chunk ids); key None holds pre-chunking records."""
+    records = db_pool.run(r.table(db_embedding_table).get_all(
+        [teacher, agent_name], index="teacher_agent"
+    ).pluck("id", "source", "content_hash"))
+
+    sources = {}
+    for record in records:
+        content_hash, doc_ids = sources.setdefault(record.get("source"), (record.get("content_hash"), []))
+        doc_ids.append(record["id"])
+    return sources
+
+def get_extraction_pool():
+    # Page ranges of large PDFs are extracted in a pool of processes, created on first use
+    global extraction_pool
+    with extraction_pool_lock:
+        if extraction_pool is None:
+            extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_PROCESSES)
+        return extraction_pool
+
+def ingest_file(teacher, agent_name, filename, sources, trace, job=None):
+    """Extract, chunk and index one file, skipping it when its content is already ingested."""
+    filepath = os.path.join(UPLOAD_FOLDER, teacher, agent_name, filename)
+    content_hash = file_hash(filepath)
+
+    old_hash, old_ids = sources.get(filename, (None, []))
+    # The catalog has the chunks of the last complete ingestion, an interrupted one leaves more in the table
+    record = db_pool.run(r.table(db_documents_table).get(catalog_id(teacher, agent_name, filename)))
+    ready_hash, ready_ids = (record.get("content_hash"), record.get("chunk_ids", [])) if record else (old_hash, old_ids)
+    if ready_hash == content_hash:
+        with trace.stage("cleanup"):
+            remove_documents(teacher, agent_name, [doc_id for doc_id in old_ids if doc_id not in ready_ids])
+        catalog_document(teacher, agent_name, filename, status="ready", content_hash=content_hash, chunk_ids=ready_ids)
+        return
+
+    # Pages and paragraphs go straight from the extractor into chunking, and every
+    # EMBEDDING_PROGRESS_STEP chunks are embedded, stored and indexed before the next are read
+    chunks = chunk_text(extraction_cache.parts(filepath, content_hash, pool=get_extraction_pool()))
+    doc_ids = []
+    extraction_seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            with trace.stage("extraction"):
+                batch = list(itertools.islice(chunks, EMBEDDING_PROGRESS_STEP))
+            extraction_seconds += time.perf_counter() - start
+            if not batch:
+                break
+            if job:
+                job.chunks_total += len(batch)
+            doc_ids += store_chunks(teacher, agent_name, filename, content_hash, batch, trace, job, first=len(doc_ids))
+    except BaseException:
+        # The catalog still lists the previous version, drop what was stored of this one
+        remove_documents(teacher, agent_name, [doc_id for doc_id in doc_ids if doc_id not in ready_ids])
+        raise
+
+    with trace.stage("cleanup"):
+        remove_documents(teacher, agent_name, [doc_id for doc_id in old_ids if doc_id not in doc_ids])
+    sources[filename] = (content_hash, doc_ids)
+    catalog_document(
+        teacher, agent_name, filename, status="ready", content_hash=content_hash, chunk_ids=doc_ids,
+        extraction_seconds=extraction_seconds, ingested=time.time(), error=None
+    )
+
+def acquire_agent_lock(key):
+    """Exclusive ingestion for the (teacher, agent) among threads and worker processes, returns the release function."""
+    with ingestion_locks_lock:
+        thread_lock = ingestion_locks.setdefault(key, threading.Lock())
+    thread_lock.acquire()
+
+    os.makedirs(INGESTION_LOCK_FOLDER, exist_ok=True)
+    lock_file = open(os.path.join(INGESTION_LOCK_FOLDER, document_id(*key) + ".lock"), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    def release():
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+        thread_lock.release()
+    return release
+
+def run_ingestion_job(job):
+    metrics.observe("ingestion_queue_seconds", job.started - job.created)
+    trace = metrics.trace("ingestion", teacher=job.teacher, agent=job.agent_name, filename=job.filename)
+    try:
+        ingest_job_files(job, trace)
+    except Exception:
+        trace.finish("failed")
+        raise
+    trace.finish()
+
+def ingest_job_files(job, trace):
+    teacher, agent_name = job.teacher, job.agent_name
+    subfolder = os.path.join(UPLOAD_FOLDER, teacher, agent_name)
+
+    # Jobs of the same agent must not interleave their bookkeeping
+    with trace.stage("lock_wait"):
+        release_agent_lock = acquire_agent_lock((teacher, agent_name))
+    try:
+        # Only the uploaded file is processed, plus any file of the folder
+        # that was never ingested chunk by chunk (uploaded before chunking)
+        sources = ingested_sources(teacher, agent_name)
+        uploaded_before = job.filename in sources
+        # Files that failed before are only tried again when uploaded again
+        failed = {record["filename"] for record in catalog_documents(teacher)
+                  if record["agent_name"] == agent_name and record.get("status") == "failed"}
+        pending = [job.filename] + [
+            filename for filename in os.listdir(subfolder)
+            if filename != job.filename and filename not in sources and filename not in failed
+            and filename.lower().endswith(SUPPORTED_EXTENSIONS)
+        ]
+        job.files_total = len(pending)
+
+        # Only a failure of the uploaded file fails the job, the other files are marked failed in the catalog
+        job_error = None
+        errors = 0
+        try:
+            for filename in pending:
+                job.current_file = filename
+                if not os.path.exists(os.path.join(subfolder, filename)):
+                    # Deleted while the job was waiting
+                    job.files_done += 1
+                    continue
+                try:
+                    ingest_file(teacher, agent_name, filename, sources, trace, job)
+                except Exception as e:
+                    logging.error(f"Ingestion of {teacher}/{agent_name}/{filename} failed: {e}")
+                    errors += 1
+                    if filename == job.filename:
+                        job_error = e
+                    if filename == job.filename and not uploaded_before:
+                        os.remove(os.path.join(subfolder, job.filename))
+                        uncatalog_document(teacher, agent_name, filename)
+                    else:
+                        catalog_document(teacher, agent_name, filename, status="failed", error=str(e))
+                job.files_done += 1
+                ingestion_jobs.changed(job)
+            job.current_file = None
+
+            # Drop the whole-folder records stored before documents were chunked, once every file has its chunks
+            if not errors:
+                legacy_hash, legacy_ids = sources.pop(None, (None, []))
+                with trace.stage("cleanup"):
+                    remove_documents(teacher, agent_name, legacy_ids)
+        finally:
+            # Whatever was ingested is saved and summarized, even when the job fails
+            with trace.stage("snapshot"):
+                document_indexes.save_snapshot((teacher, agent_name))
+            with trace.stage("centroid"):
+                update_centroid(teacher, agent_name)
+    finally:
+        release_agent_lock()
+    schedule_agent_summary(teacher, agent_name)
+    if job_error is not None:
+        raise job_error
+
+def update_centroid(teacher, agent_name):
+    embedding = document_indexes.centroid((teacher, agent_name))
+
+    # Delete old embedding
+    db_pool.run(r.table(db_embedding_table).get_all(
+        [teacher, agent_name], index="teacher_scientist"
+    ).delete())
+
+    # Insert new one
+    if embedding is not None:
+        db_pool.run(r.table(db_embedding_table).insert({
+            "teacher": teacher,
+            "scientist": agent_name,
+            "embedding": encode_vector(embedding, VECTOR_FORMAT),
+            "vector_format": VECTOR_FORMAT
+        }))
 
-        agent_document_indexes[index_key].add(np.array([embedding], dtype=np.float32))
-        agent_doc_map[index_key].append(doc_id)
-        total_embeddings += 1
+def publish_job(job):
+    # Any worker process can answer the status requests of the job
+    db_pool.run(r.table(db_jobs_table).insert(dict(job.to_dict(), worker=WORKER_ID), conflict="replace"))
 
-    print(f"Loaded {total_embeddings} document embeddings into FAISS.")
+ingestion_jobs = JobQueue(run_ingestion_job, workers=INGESTION_WORKERS, on_change=publish_job)
+
+# ----------------------------------------------------------------
+# Document catalog
+#    One record per uploaded file: teacher, agent, file name and
+#    path, size, content hash, status (queued, ready or failed),
+#    upload and ingestion times, extraction time and the ids of
+#    its chunks, which are also its ids in the vector index.
+#    Deleting a file removes exactly those chunks; folder listings
+#    are read from the catalog instead of the upload folder.
+# ----------------------------------------------------------------
+def catalog_id(teacher, agent_name, filename):
+    return document_id(teacher, agent_name, filename)
+
+def catalog_document(teacher, agent_name, filename, **fields):
+    """Create or update the catalog record of a file with the given fields."""
+    db_pool.run(r.table(db_documents_table).insert(dict(fields,
+        id=catalog_id(teacher, agent_name, filename),
+        teacher=teacher,
+        agent_name=agent_name,
+        filename=filename,
+        path=os.path.join(UPLOAD_FOLDER, teacher, agent_name, filename)
+    ), conflict="update"))
+
+def uncatalog_document(teacher, agent_name, filename):
+    db_pool.run(r.table(db_documents_table).get(catalog_id(teacher, agent_name, filename)).delete())
+
+def catalog_documents(teacher):
+    return db_pool.run(r.table(db_documents_table).get_all(teacher, index="teacher"))
+
+def backfill_catalog():
+    """Add catalog records for files uploaded before the catalog existed."""
+    catalogued = {record["id"] for record in db_pool.run(r.table(db_documents_table).pluck("id"))}
+
+    records = db_pool.run(r.table(db_embedding_table).has_fields("source").pluck("id", "teacher", "agent_name", "source", "content_hash"))
+    documents = {}
+    for record in records:
+        key = (record["teacher"], record["agent_name"], record["source"])
+        documents.setdefault(key, {"content_hash": record.get("content_hash"), "chunk_ids": []})["chunk_ids"].append(record["id"])
+
+    # Files never ingested chunk by chunk are picked up with the next upload of their agent
+    if os.path.isdir(UPLOAD_FOLDER):
+        for teacher in os.listdir(UPLOAD_FOLDER):
+            teacher_folder = os.path.join(UPLOAD_FOLDER, teacher)
+            for agent_name in (os.listdir(teacher_folder) if os.path.isdir(teacher_folder) else []):
+                agent_folder = os.path.join(teacher_folder, agent_name)
+                for filename in (os.listdir(agent_folder) if os.path.isdir(agent_folder) else []):
+                    documents.setdefault((teacher, agent_name, filename), {"status": "queued", "chunk_ids": []})
+
+    added = 0
+    for (teacher, agent_name, filename), fields in documents.items():
+        if catalog_id(teacher, agent_name, filename) in catalogued:
+            continue
+        path = os.path.join(UPLOAD_FOLDER, teacher, agent_name, filename)
+        fields.setdefault("status", "ready")
+        fields["size"] = os.path.getsize(path) if os.path.exists(path) else None
+        catalog_document(teacher, agent_name, filename, **fields)
+        added += 1
 
+    if added:
+        print(f"Added {added} files uploaded earlier to the document catalog.")
 
-def get_embedding(text: str):
+# ----------------------------------------------------------------
+# Jobs interrupted by a restart
+#    Jobs live only in the memory of the process running them, so
+#    the rows of a process that stopped stay queued or running and
+#    the catalog records of their files stay queued. At startup
+#    every process marks the rows of dead processes on its host as
+#    failed and queues their files again; the snapshot writer also
+#    queues every catalog record still queued that no live job is
+#    working on, e.g. the files added by backfill_catalog. A file
+#    queued twice is ingested once, the second job finds its hash.
+# ----------------------------------------------------------------
+def worker_alive(worker):
+    host, _, pid = (worker or "").rpartition(":")
+    if not worker or not pid.isdigit():
+        return False
+    if host != socket.gethostname():
+        return True     # recovered when a process on its own host starts
+    if int(pid) == os.getpid():
+        return False    # an earlier process with the same pid
     try:
-        response = openai.embeddings.create(
-            input=text,
-            model="text-embedding-3-small"
-        )
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def recover_ingestion_jobs(requeue_catalog=False):
+    """Mark jobs of dead processes failed and queue their files again, returns the number of files queued."""
+    rows = [row for status in ("queued", "running")
+            for row in db_pool.run(r.table(db_jobs_table).filter({"status": status}))]
+    interrupted = [row for row in rows if not worker_alive(row.get("worker"))]
+    for row in interrupted:
+        db_pool.run(r.table(db_jobs_table).insert({
+            "id": row["id"], "status": "failed", "error": "Interrupted by a server restart", "finished": time.time()
+        }, conflict="update"))
+
+    files = {(row["teacher"], row["agent_name"], row["filename"]) for row in interrupted}
+    if requeue_catalog:
+        interrupted_ids = {row["id"] for row in interrupted}
+        claimed = {(row["teacher"], row["agent_name"], row["filename"]) for row in rows if row["id"] not in interrupted_ids}
+        files |= {(record["teacher"], record["agent_name"], record["filename"])
+                  for record in db_pool.run(r.table(db_documents_table).filter({"status": "queued"}))} - claimed
+
+    queued = 0
+    for teacher, agent_name, filename in sorted(files):
+        record = db_pool.run(r.table(db_documents_table).get(catalog_id(teacher, agent_name, filename)))
+        if record is None or record.get("status") != "queued":
+            continue
+        if not os.path.exists(os.path.join(UPLOAD_FOLDER, teacher, agent_name, filename)):
+            uncatalog_document(teacher, agent_name, filename)
+            continue
+        ingestion_jobs.submit(teacher, agent_name, filename)
+        queued += 1
 
-        return response.data[0].embedding 
-    except Exception as e:
-        print(f"Error while retrieving embeddings: {e}")
+    if interrupted or queued:
+        print(f"Marked {len(interrupted)} interrupted ingestion jobs failed, queued {queued} files again.")
+    return queued
 
-    return None
+def delete_document(teacher, agent_name, filename):
+    """Remove an uploaded file with its chunks and vectors, returns False when there is no such file."""
+    key = (teacher, agent_name)
+    file_path = os.path.join(UPLOAD_FOLDER, teacher, agent_name, filename)
 
-def store_document(text, teacher, agent_name):
-    embedding = get_embedding(text)
-    
-    if embedding:
-        insert_result = r.table(db_embedding_table).insert({
-            "teacher": teacher,
-            "agent_name": agent_name,
-            "text": text,
-            "embedding": embedding
-        }).run(conn)
+    # Waits for a running ingestion of the agent, a queued one skips the deleted file
+    release_agent_lock = acquire_agent_lock(key)
+    try:
+        record = db_pool.run(r.table(db_documents_table).get(catalog_id(teacher, agent_name, filename)))
+        if record is None and not os.path.exists(file_path):
+            return False
+
+        if record is not None:
+            doc_ids = record.get("chunk_ids", [])
+        else:
+            doc_ids = ingested_sources(teacher, agent_name).get(filename, (None, []))[1]
 
-        doc_id = insert_result.get("generated_keys", [None])[0]
+        remove_documents(teacher, agent_name, doc_ids)
+        uncatalog_document(teacher, agent_name, filename)
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
-        if doc_id:
-            index_key = (teacher, agent_name)
-            agent_document_indexes[index_key].add(np.array([embedding], dtype=np.float32))
-            agent_doc_map[index_key].append(doc_id)
-            load_embeddings_from_database()
-            return True
+        document_indexes.save_snapshot(key)
+        update_centroid(teacher, agent_name)
+    finally:
+        release_agent_lock()
+    schedule_agent_summary(teacher, agent_name)
+    return True
 
-    return False
+
+# ----------------------------------------------------------------
+# Agent summaries
+#    What an agent knows is summarized once per (teacher, agent),
+#    together with its answers to the usual opening questions, and
+#    stored in the agent_summaries table. A student asking one of
+#    those questions gets the stored answer with a single database
+#    read, without retrieval or a chat completion. The record is
+#    dropped whenever the agent's chunks change and generated again
+#    in the background once the upload or deletion is done.
+# ----------------------------------------------------------------
+OPENING_QUESTIONS = (
+    "Što znaš?",
+    "O čemu znaš najviše?",
+    "Što si zadnje proučio?",
+    "Koji je zadnji svitak koji si proučio?"
+)
+SUMMARY_QUESTION = "Ukratko, u nekoliko rečenica, ispričaj sve o čemu piše u svitku."
+SUMMARY_CHUNKS = 8                  # chunks of the latest document and nearest to the centroid
+OPENING_QUESTION_THRESHOLD = 0.92   # cosine similarity to an opening question to use its answer
+summary_executor = ThreadPoolExecutor(max_workers=1)
+pending_summaries = set()
+pending_summaries_lock = threading.Lock()
+opening_vectors = None
+
+def normalize_question(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+OPENING_KEYS = {normalize_question(question): question for question in OPENING_QUESTIONS}
+
+def summary_id(teacher, agent_name):
+    return document_id(teacher, agent_name)
+
+def drop_agent_summary(teacher, agent_name):
+    db_pool.run(r.table(db_summaries_table).get(summary_id(teacher, agent_name)).delete())
+
+def schedule_agent_summary(teacher, agent_name):
+    # A refresh that is already queued will see this change as well
+    key = (teacher, agent_name)
+    with pending_summaries_lock:
+        if key in pending_summaries:
+            return
+        pending_summaries.add(key)
+    summary_executor.submit(run_summary_refresh, key)
+
+def run_summary_refresh(key):
+    with pending_summaries_lock:
+        pending_summaries.discard(key)
+    try:
+        refresh_agent_summary(*key)
+    except Exception as e:
+        logging.error(f"Summary of {key[0]}/{key[1]} failed: {e}")
+
+def summary_chunks(teacher, agent_name):
+    """The first chunks of the latest document, then the chunks nearest to the agent's centroid."""
+    key = (teacher, agent_name)
+    ready = [record for record in catalog_documents(teacher)
+             if record["agent_name"] == agent_name and record.get("status") == "ready"]
+    latest = max(ready, key=lambda record: record.get("ingested") or 0, default=None)
+    doc_ids = list(latest.get("chunk_ids", []))[:SUMMARY_CHUNKS // 2] if latest else []
+
+    centroid = document_indexes.centroid(key)
+    if centroid is not None:
+        doc_ids += [doc_id for doc_id, _ in document_indexes.search(key, centroid, SUMMARY_CHUNKS) if doc_id not in doc_ids]
+    return fetch_chunk_texts(doc_ids[:SUMMARY_CHUNKS])
+
+def refresh_agent_summary(teacher, agent_name, force=False):
+    """Generate the summary and opening answers unless they are stored already, returns True when generated."""
+    if not force and db_pool.run(r.table(db_summaries_table).get(summary_id(teacher, agent_name))) is not None:
+        return False
+    chunks = summary_chunks(teacher, agent_name)
+    if not chunks:
+        drop_agent_summary(teacher, agent_name)
+        return False
+
+    def ask(question):
+        return limited_chat.complete([{"role": "user", "content": build_prompt(teacher, agent_name, chunks, question)}])
+
+    summary = ask(SUMMARY_QUESTION)
+    answers = {normalize_question(question): ask(question) for question in OPENING_QUESTIONS}
+    db_pool.run(r.table(db_summaries_table).insert({
+        "id": summary_id(teacher, agent_name),
+        "teacher": teacher,
+        "agent_name": agent_name,
+        "summary": summary,
+        "answers": answers,
+        "updated": time.time()
+    }, conflict="replace"))
+    metrics.increment("agent_summaries_total", teacher=teacher, agent=agent_name)
+    return True
+
+def opening_question_vectors():
+    """Normalized embeddings of the opening questions, computed on first use."""
+    global opening_vectors
+    if opening_vectors is None:
+        embeddings = get_embeddings(list(OPENING_QUESTIONS))
+        if embeddings:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            opening_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return opening_vectors
+
+def opening_question(user_prompt, query_embedding=None, vectors=None):
+    """The opening question the student asked, matched by its words or else by its embedding."""
+    question = OPENING_KEYS.get(normalize_question(user_prompt))
+    if question is not None or query_embedding is None or vectors is None:
+        return question
+    query = np.asarray(query_embedding, dtype=np.float32)
+    scores = vectors @ (query / np.linalg.norm(query))
+    best = int(np.argmax(scores))
+    return OPENING_QUESTIONS[best] if scores[best] >= OPENING_QUESTION_THRESHOLD else None
+
+def stored_answer(record, question):
+    return record.get("answers", {}).get(normalize_question(question)) if record else None
+
+def precomputed_reply(index_key, user_prompt, query_embedding, trace):
+    vectors = opening_question_vectors() if query_embedding is not None else None
+    question = opening_question(user_prompt, query_embedding, vectors)
+    if question is None:
+        return None
+    with trace.stage("precomputed"):
+        record = db_pool.run(r.table(db_summaries_table).get(summary_id(*index_key)))
+    return stored_answer(record, question)
+
+def warm_up(teachers):
+    """Load what the first questions of a class need: index pages, agent summaries and conversations."""
+    counts = {"agents": 0, "summaries": 0, "conversations": 0}
+    opening_question_vectors()
+    for teacher in teachers:
+        for agent_name in sorted({record["agent_name"] for record in catalog_documents(teacher)}):
+            key = (teacher, agent_name)
+            # Reading every vector brings memory-mapped snapshots into the page cache
+            centroid = document_indexes.centroid(key)
+            if centroid is not None:
+                document_indexes.search(key, centroid, RETRIEVAL_CANDIDATES)
+            if refresh_agent_summary(teacher, agent_name):
+                counts["summaries"] += 1
+            counts["agents"] += 1
+
+        records = list(db_pool.run(r.table(db_conversation_table).filter({"teacher": teacher}).pluck("username", "agent_name")))
+        for record in records[:CONVERSATION_MAX_SESSIONS]:
+            conversations.messages((teacher, record["username"], record["agent_name"]))
+            counts["conversations"] += 1
+    return counts
 
 
 def setup_database():
     try:
-        if db_name not in r.db_list().run(conn):
-            r.db_create(db_name).run(conn)
+        if db_name not in db_pool.run(r.db_list()):
+            db_pool.run(r.db_create(db_name))
             print(f"Created database: {db_name}")
 
-        conn.use(db_name)
-        if db_embedding_table not in r.table_list().run(conn):
-            r.table_create(db_embedding_table).run(conn)
-            print(f"Created table: {db_embedding_table}")
+        tables = db_pool.run(r.table_list())
+        for table in (db_embedding_table, db_conversation_table, db_jobs_table, db_documents_table, db_summaries_table):
+            if table not in tables:
+                db_pool.run(r.table_create(table))
+                print(f"Created table: {table}")
+
+        create_index(db_embedding_table, "teacher_agent", ["teacher", "agent_name"])
+        create_index(db_embedding_table, "teacher_scientist", ["teacher", "scientist"])
+        create_index(db_documents_table, "teacher")
+
+        if not ensure_users_index():
+            print("Table users does not exist yet, the index on it is created once the MMO server creates it.")
+            threading.Thread(target=wait_for_users_table, name="users-index", daemon=True).start()
 
     except Exception as e:
         print(f"Error setting up RethinkDB: {e}")
 
-def handle_pdf(file):
-    file_stream = BytesIO(file.read())
-    doc = fitz.open(stream=file_stream, filetype="pdf")
-    full_text = "\n".join([page.get_text("text") for page in doc])
-    return full_text
+def create_index(table, index_name, fields=None):
+    # Secondary index, compound when several fields are given
+    if index_name in db_pool.run(r.table(table).index_list()):
+        return
+
+    if fields:
+        db_pool.run(r.table(table).index_create(index_name, [r.row[field] for field in fields]))
+    else:
+        db_pool.run(r.table(table).index_create(index_name))
+    db_pool.run(r.table(table).index_wait(index_name))
+    print(f"Created index {index_name} on table {table}")
 
-def handle_doc(file_path):
+# ----------------------------------------------------------------
+# Index on users.username
+#    The users table belongs to the MMO server (server/core/database.js),
+#    which sets up its database, tables and admin account only when
+#    the database does not exist yet, so the table is not created
+#    here. Until it exists a background thread keeps retrying, and
+#    the handlers that look students up by name try again first.
+# ----------------------------------------------------------------
+USERS_INDEX_RETRY_SECONDS = 5
+users_index_ready = threading.Event()
+
+def ensure_users_index():
+    if users_index_ready.is_set():
+        return True
     try:
-        extracted_text = textract.process(file_path).decode("utf-8")
+        if "users" not in db_pool.run(r.table_list()):
+            return False
+        create_index("users", "username")
     except Exception as e:
-        extracted_text = f"Error extracting text: {str(e)}"
-    return extracted_text
+        # e.g. another worker created the index at the same moment, the next call finds it
+        logging.error(f"Error creating index username on table users: {e}")
+        return False
+    users_index_ready.set()
+    return True
 
-    
-def handle_docx(file_path):
-    doc = Document(file_path)
-    text = "\n".join([para.text for para in doc.paragraphs])
-    return text
+def wait_for_users_table():
+    while not ensure_users_index():
+        time.sleep(USERS_INDEX_RETRY_SECONDS)
 
-def handle_text(file):
-    return file.read()
-    
 # ----------------------------------------------------------------
 # Create a new agent (POST)
 #    Endpoint: /new/<username>/<agent_name>
@@ -170,11 +907,10 @@ def create_agent(teacher, username, agent_name):
         data = request.get_json(force=True)
         system_prompt = data.get("content", "")
 
-        # TODO: added teacher here in key bellow, now integrate with the rest
         # Initialize conversation with a system message
-        conversations[(teacher, username, agent_name)] = [
+        conversations.reset((teacher, username, agent_name), [
             {"role": "system", "content": system_prompt}
-        ]
+        ])
 
         return jsonify({
             "status": "success",
@@ -188,104 +924,232 @@ def create_agent(teacher, username, agent_name):
 #    Endpoint: /query/<username>/<agent_name>
 #    JSON Body: { "prompt": <userPrompt> }
 # ----------------------------------------------------------------
+def prepare_query(username, agent_name, data, trace):
+    """Everything before the chat completion: returns (status, error payload) or (None, query)."""
+    # 1. Look up the student's teacher
+    with trace.stage("teacher_lookup"):
+        ensure_users_index()
+        user_record = db_pool.run(r.table("users").get_all(username, index="username"))
+    if not user_record:
+        return 404, {"status": "error", "response": "Student user not found."}
+
+    teacher = user_record[0].get("teacher")
+    if not teacher:
+        return 400, {"status": "error", "response": "Teacher not assigned to student."}
+
+    # 2. Retrieve the student's question
+    user_prompt = data.get("prompt", "").strip()
+    if not user_prompt:
+        return 400, {"status": "error", "response": "Prompt is required."}
+
+    index_key = (teacher, agent_name)
+    if index_key not in document_indexes:
+        return 404, {"status": "error", "response": "No documents found for this agent."}
+
+    query = {
+        "teacher": teacher,
+        "index_key": index_key,
+        "conv_key": (teacher, username, agent_name),
+        "user_prompt": user_prompt,
+        "embedding": None,
+        "cached_reply": None,
+        "prompt": None,
+        "trace": trace
+    }
+
+    # Opening questions ("what do you know?") are answered from the agent summary
+    query["cached_reply"] = precomputed_reply(index_key, user_prompt, None, trace)
+    if query["cached_reply"] is not None:
+        metrics.increment("retrieval_total", path="precomputed")
+        return None, query
+
+    # 3. Keyword search first, a confident match needs no embedding
+    with trace.stage("lexical_search"):
+        lexical_hits, confidence = lexical_index.search(index_key, user_prompt, RETRIEVAL_CANDIDATES)
+    query_embedding = None
+    if confidence < LEXICAL_FAST_PATH_CONFIDENCE:
+        with trace.stage("embedding"):
+            query_embedding = get_embedding(user_prompt)
+        if query_embedding is None and not lexical_hits:
+            return 500, {"status": "error", "response": "Failed to get embedding."}
+    metrics.increment("retrieval_total", path=retrieval_path(confidence, query_embedding))
+    query["embedding"] = query_embedding
+
+    # Rephrased opening questions, then near-duplicate questions get the answer given before
+    if query_embedding is not None:
+        query["cached_reply"] = precomputed_reply(index_key, user_prompt, query_embedding, trace)
+        if query["cached_reply"] is None:
+            with trace.stage("answer_cache"):
+                query["cached_reply"] = answer_cache.lookup(index_key, query_embedding)
+    if query["cached_reply"] is not None:
+        return None, query
+
+    # 4. Retrieve relevant document chunks for this (teacher, agent)
+    vector_hits = []
+    if query_embedding is not None:
+        with trace.stage("vector_search"):
+            vector_hits = document_indexes.search(index_key, query_embedding, RETRIEVAL_CANDIDATES)
+    hits = merge_hits(vector_hits, lexical_hits, RETRIEVAL_TOP_K)
+
+    # Retrieve corresponding document texts from DB in one round trip
+    with trace.stage("chunk_fetch"):
+        context_chunks = fetch_chunk_texts([doc_id for doc_id, _ in hits])
+    if not context_chunks:
+        return 404, {"status": "error", "response": "No relevant document chunks found."}
+
+    with trace.stage("prompt_assembly"):
+        query["prompt"] = build_prompt(teacher, agent_name, context_chunks, user_prompt)
+
+        # Earlier turns of this conversation, within a fixed token window
+        history = conversations.window(query["conv_key"], CONVERSATION_WINDOW_TOKENS)
+        query["messages"] = history + [{"role": "user", "content": query["prompt"]}]
+    return None, query
+
+def retrieval_path(confidence, query_embedding):
+    if confidence >= LEXICAL_FAST_PATH_CONFIDENCE:
+        return "lexical"
+    return "hybrid" if query_embedding is not None else "lexical_fallback"
+
+def merge_hits(vector_hits, lexical_hits, k):
+    """Reciprocal rank fusion of FAISS and BM25 hits, returns the k best (document id, score) pairs."""
+    scores = defaultdict(float)
+    for hits in (vector_hits, lexical_hits):
+        for rank, (doc_id, _) in enumerate(hits):
+            scores[doc_id] += 1.0 / (RRF_K + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+def finish_query(query, assistant_reply):
+    # Record the exchange in the conversation state
+    remember_exchange(query["conv_key"], query["user_prompt"], assistant_reply)
+    if query["cached_reply"] is None and query["embedding"] is not None:
+        answer_cache.store(query["index_key"], query["embedding"], query["user_prompt"], assistant_reply)
+
+    teacher, agent_name = query["index_key"]
+    metrics.increment("agent_queries_total", teacher=teacher, agent=agent_name)
+    if query["cached_reply"] is not None:
+        metrics.increment("agent_cached_answers_total", teacher=teacher, agent=agent_name)
+    else:
+        prompt_tokens = sum(count_tokens(message["content"]) for message in query["messages"])
+        metrics.increment("agent_prompt_tokens_total", prompt_tokens, teacher=teacher, agent=agent_name)
+        metrics.increment("agent_completion_tokens_total", count_tokens(assistant_reply), teacher=teacher, agent=agent_name)
+
+def query_trace(username, agent_name):
+    return metrics.trace("query", username=username, agent=agent_name)
+
 @app.route("/query/<path:username>/<path:agent_name>", methods=["POST"])
 def query_agent(username, agent_name):
+    trace = query_trace(username, agent_name)
     try:
-        # 1. Look up the student's teacher
-        user_record = list(r.table("users").filter({"username": username}).run(conn))
-        if not user_record:
-            return jsonify({"status": "error", "response": "Student user not found."}), 404
+        status, query = prepare_query(username, agent_name, request.get_json(force=True), trace)
+        if status is not None:
+            trace.finish(str(status))
+            return jsonify(query), status
 
-        teacher = user_record[0].get("teacher")
-        if not teacher:
-            return jsonify({"status": "error", "response": "Teacher not assigned to student."}), 400
+        assistant_reply = query["cached_reply"]
+        if assistant_reply is None:
+            # 5. Call OpenAI with context and question
+            with trace.stage("llm"):
+                assistant_reply = limited_chat.complete(query["messages"])
 
-        # 2. Retrieve the student's question
-        data = request.get_json(force=True)
-        user_prompt = data.get("prompt", "").strip()
-        if not user_prompt:
-            return jsonify({"status": "error", "response": "Prompt is required."}), 400
-
-        # 3. Get the embedding of the user prompt
-        query_embedding = get_embedding(user_prompt)
-        if query_embedding is None:
-            return jsonify({"status": "error", "response": "Failed to get embedding."}), 500
-
-        # 4. Retrieve relevant document chunks for this (teacher, agent)
-        index_key = (teacher, agent_name)
-        if index_key not in agent_document_indexes:
-            return jsonify({"status": "error", "response": "No documents found for this agent."}), 404
-            
-        
-
-        faiss_index = agent_document_indexes[index_key]
-        doc_ids = agent_doc_map[index_key]
-
-        k = 5  # top-k chunks to use
-        D, I = faiss_index.search(np.array([query_embedding], dtype=np.float32), k)
-        
-        
-        # Retrieve corresponding document texts from DB
-        context_chunks = []
-        for idx in I[0]:
-            if 0 <= idx < len(doc_ids):
-                doc_id = doc_ids[idx]
-                record = r.table(db_embedding_table).get(doc_id).run(conn)
-                if record:
-                    context_chunks.append(record["text"])
-
-        if not context_chunks:
-            return jsonify({"status": "error", "response": "No relevant document chunks found."}), 404
-
-        context = "\n\n".join(context_chunks)
-
-        # 5. Build or retrieve conversation state
-        conv_key = (teacher, username, agent_name)
-        if conv_key not in conversations:
-            conversations[conv_key] = []
-
-        messages = conversations[conv_key]
-
-        # Append current user question
-        messages.append({"role": "user", "content": user_prompt})
-
-        # 6. Call OpenAI with context and question
-        system_instruction = (
-            "Odgovori na pitanje koristeći sljedeći kontekst iz dokumenata "
-            f"koje je učitelj '{teacher}' priložio za agenta '{agent_name}'. "
-            "Ako pitanje nije vezan uz kontekst, reci da ne znaš, a ako je "
-            "pitanje vezano uz kontekst, možeš ponuditi i odgovor temeljem drugih znanja."
-            "Ako te učenik pita što znaš ili o čemu znaš najviše daj kratki "
-            "sažetak konteksta na način da kažeš da je zadnji svitak koji si"
-            "proučio je [tema koja je opisana u kontekstu] jer ti si lik znanstvenika "
-            "u fantasy RPG igri. Nemoj spominjati riječ kontekst, nego samo govori "
-            "o svitku kao da je on opisao sve što je u kontekstu."
-        )
-
-        prompt_with_context = (
-            f"{system_instruction}\n\n"
-            f"Kontekst:\n{context}\n\n"
-            f"Pitanje: {user_prompt}\n\nOdgovor:"
-        )
-        
-        print( prompt_with_context )
-
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",  # You can adjust the model
-            messages=[{"role": "user", "content": prompt_with_context}]
-        )
-
-        assistant_reply = response.choices[0].message.content
-        messages.append({"role": "assistant", "content": assistant_reply})
+        finish_query(query, assistant_reply)
+        trace.finish()
 
         return jsonify({
             "status": "success",
             "response": assistant_reply
         })
 
+    except openai.RateLimitError as e:
+        # Still rate limited after the chat client's retries, the game may ask again later
+        trace.finish("503")
+        return jsonify({"status": "error", "response": str(e)}), 503, {"Retry-After": str(RATE_LIMIT_RETRY_AFTER)}
+
     except Exception as e:
+        trace.finish("500")
         return jsonify({"status": "error", "response": str(e)}), 500
 
+# ----------------------------------------------------------------
+# Query an existing agent, streaming the reply (POST)
+#    Endpoint: /query-stream/<username>/<agent_name>
+#    JSON Body: { "prompt": <userPrompt> }
+#    Errors before generation starts are plain JSON like /query,
+#    otherwise the reply is sent as Server-Sent Events:
+#      event: token   data: {"token": <text>}
+#      event: done    data: {"status": "success", "response": <full reply>}
+#      event: error   data: {"status": "error", "response": <message>}
+# ----------------------------------------------------------------
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_reply(query):
+    trace = query["trace"]
+    try:
+        if query["cached_reply"] is not None:
+            yield sse_event("token", {"token": query["cached_reply"]})
+            assistant_reply = query["cached_reply"]
+        else:
+            parts = []
+            with trace.stage("llm"):
+                for token in limited_chat.stream(query["messages"]):
+                    if not parts:
+                        metrics.observe("query_first_token_seconds", time.perf_counter() - trace.start)
+                    parts.append(token)
+                    yield sse_event("token", {"token": token})
+            assistant_reply = "".join(parts)
+
+        finish_query(query, assistant_reply)
+        trace.finish()
+        yield sse_event("done", {"status": "success", "response": assistant_reply})
+
+    except Exception as e:
+        logging.error(f"Error while streaming reply: {e}")
+        trace.finish("500")
+        yield sse_event("error", {"status": "error", "response": str(e)})
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.route("/query-stream/<path:username>/<path:agent_name>", methods=["POST"])
+def query_agent_stream(username, agent_name):
+    trace = query_trace(username, agent_name)
+    try:
+        status, query = prepare_query(username, agent_name, request.get_json(force=True), trace)
+        if status is not None:
+            trace.finish(str(status))
+            return jsonify(query), status
+    except Exception as e:
+        trace.finish("500")
+        return jsonify({"status": "error", "response": str(e)}), 500
+
+    return Response(stream_reply(query), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+def build_prompt(teacher, agent_name, context_chunks, user_prompt):
+    context = "\n\n".join(context_chunks)
+
+    system_instruction = (
+        "Odgovori na pitanje koristeći sljedeći kontekst iz dokumenata "
+        f"koje je učitelj '{teacher}' priložio za agenta '{agent_name}'. "
+        "Ako pitanje nije vezan uz kontekst, reci da ne znaš, a ako je "
+        "pitanje vezano uz kontekst, možeš ponuditi i odgovor temeljem drugih znanja."
+        "Ako te učenik pita što znaš ili o čemu znaš najviše daj kratki "
+        "sažetak konteksta na način da kažeš da je zadnji svitak koji si"
+        "proučio je [tema koja je opisana u kontekstu] jer ti si lik znanstvenika "
+        "u fantasy RPG igri. Nemoj spominjati riječ kontekst, nego samo govori "
+        "o svitku kao da je on opisao sve što je u kontekstu."
+    )
+
+    return (
+        f"{system_instruction}\n\n"
+        f"Kontekst:\n{context}\n\n"
+        f"Pitanje: {user_prompt}\n\nOdgovor:"
+    )
+
+def remember_exchange(conv_key, user_prompt, assistant_reply):
+    conversations.append(
+        conv_key,
+        {"role": "user", "content": user_prompt},
+        {"role": "assistant", "content": assistant_reply}
+    )
+
 
 
 # ----------------------------------------------------------------
@@ -295,14 +1159,20 @@ def query_agent(username, agent_name):
 # ----------------------------------------------------------------
 @app.route("/delete/<path:username>/<path:agent_name>", methods=["POST"])
 def delete_agent(username, agent_name):
-    key = (username, agent_name)
-    if key not in conversations:
+    # Conversations are keyed by teacher as well, look it up like /query does
+    ensure_users_index()
+    user_record = db_pool.run(r.table("users").get_all(username, index="username"))
+    teacher = user_record[0].get("teacher") if user_record else None
+    key = (teacher or "", username, agent_name)
+
+    in_memory = conversations.delete(key)
+    stored = db_pool.run(r.table(db_conversation_table).get(conversation_id(key)).delete())
+    if not in_memory and not stored.get("deleted"):
         return jsonify({
             "status": "error",
             "message": f"No such agent '{agent_name}' for user '{username}'."
         }), 404
 
-    del conversations[key]
     return jsonify({
         "status": "success",
         "message": f"Deleted agent '{agent_name}' for user '{username}'."
@@ -310,8 +1180,28 @@ def delete_agent(username, agent_name):
 
 # ----------------------------------------------------------------
 # Serve static files
-#    
+#    Game files are served with ETags, byte ranges, precompressed
+#    variants and long cache lifetimes, see static_assets.py.
+#    The manifest is built at startup and compression runs in the
+#    background; files added later are picked up on first request.
 # ----------------------------------------------------------------
+STATIC_ROOT = '..'
+STATIC_MANIFEST = 'static_manifest.json'
+STATIC_CACHE_FOLDER = 'static_cache'
+STATIC_MAX_AGE = 3600                   # seconds before unversioned files are revalidated
+STATIC_HOT_CACHE_BYTES = 128 << 20      # memory for small files and compressed variants
+STATIC_HOT_FILE_LIMIT = 2 << 20         # larger files are streamed from disk
+static_assets = StaticAssets(
+    STATIC_ROOT, STATIC_MANIFEST, STATIC_CACHE_FOLDER, max_age=STATIC_MAX_AGE,
+    hot_cache_bytes=STATIC_HOT_CACHE_BYTES, hot_file_limit=STATIC_HOT_FILE_LIMIT
+)
+
+def prepare_static_assets():
+    files, hashed = static_assets.build()
+    print(f"Static manifest: {files} files, {hashed} hashed.")
+    written = static_assets.precompress()
+    print(f"Static assets: {written} compressed variants written.")
+
 @app.route('/<path:filename>', methods=['GET'])
 def serve_static(filename):
     # Prevent access to the server directory
@@ -319,19 +1209,112 @@ def serve_static(filename):
         return jsonify({"status": "error", "message": "Access denied."}), 403
 
     # Serve the file if it exists
-    file_path = os.path.join('..', filename)
-    if os.path.isfile(file_path):
-        directory = os.path.dirname(file_path)
-        file_name = os.path.basename(file_path)
-        return send_from_directory(directory, file_name)
-    else:
+    response = static_assets.serve(filename, request)
+    if response is None:
         return jsonify({"status": "error", "message": "File not found."}), 404
+    return response
 
 
 @app.route('/', methods=['GET'])
 def serve_index():
     return serve_static( 'teacher_login.html' )
 
+# ----------------------------------------------------------------
+# Embedding cache, answer cache and connection pool statistics (GET)
+#    Endpoint: /cache-stats
+# ----------------------------------------------------------------
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(success=True, embeddings=embedding_cache.stats(), answers=answer_cache.stats(), db_pool=db_pool.stats(), conversations=conversations.stats(), jobs=ingestion_jobs.stats(), indexes=document_indexes.stats(), lexical=lexical_index.stats(), static=static_assets.stats(), upstream={"embeddings": embedding_client.stats(), "chat": chat_client.stats()}, worker=WORKER_ID, changefeeds={"embeddings": embedding_feed.stats(), "conversations": conversation_feed.stats()}), 200
+
+# ----------------------------------------------------------------
+# Metrics (GET)
+#    Endpoint: /metrics              Prometheus text format
+#              /metrics?format=json
+#    Request counters and stage latency histograms, plus index
+#    sizes, cache hit rates and job counts read at scrape time.
+# ----------------------------------------------------------------
+def metric_gauges():
+    gauges = [
+        ("document_index_vectors", {"teacher": teacher, "agent": agent_name}, size)
+        for (teacher, agent_name), size in sorted(document_indexes.sizes().items())
+    ]
+    lexical = lexical_index.stats()
+    gauges += [("lexical_index_chunks", {}, lexical["chunks"]), ("lexical_index_terms", {}, lexical["terms"])]
+
+    for name, stats in (("embedding_cache", embedding_cache.stats()), ("answer_cache", answer_cache.stats())):
+        gauges += [(f"{name}_hit_rate", {}, stats["hit_rate"]), (f"{name}_hits", {}, stats["hits"]), (f"{name}_misses", {}, stats["misses"])]
+
+    pool = db_pool.stats()
+    gauges += [("db_pool_in_use", {}, pool.get("in_use", 0)), ("db_pool_waiting", {}, pool.get("waiting", 0))]
+    gauges.append(("conversation_sessions", {}, conversations.stats()["sessions"]))
+
+    for name, client in (("embeddings", embedding_client), ("chat", chat_client)):
+        upstream = client.stats()
+        gauges += [(f"upstream_{stat}", {"api": name}, upstream[stat])
+                   for stat in ("in_flight", "waiting", "calls", "coalesced", "retries", "rate_limited", "failures")]
+
+    jobs = ingestion_jobs.stats()
+    gauges.append(("ingestion_queue_depth", {}, jobs["queue_depth"]))
+    gauges += [("ingestion_jobs", {"status": status}, count) for status, count in sorted(jobs["jobs"].items())]
+    return gauges
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    gauges = metric_gauges()
+    if request.args.get('format') == 'json':
+        gauge_values = [{"name": name, "labels": labels, "value": value} for name, labels, value in gauges]
+        return jsonify(success=True, gauges=gauge_values, **metrics.to_dict()), 200
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+# ----------------------------------------------------------------
+# Rebuild all document indexes from the database (POST)
+#    Endpoint: /rebuild-indexes
+#    Uploads update the indexes incrementally, this is only needed
+#    after the embeddings table was changed by hand.
+# ----------------------------------------------------------------
+@app.route('/rebuild-indexes', methods=['POST'])
+def rebuild_indexes():
+    try:
+        load_embeddings_from_database()
+        return jsonify(success=True, indexes=len(document_indexes.keys())), 200
+    except Exception as e:
+        logging.error(f"Error while rebuilding indexes: {e}")
+        return jsonify(success=False, message=str(e)), 500
+
+# ----------------------------------------------------------------
+# Agent summary (GET)
+#    Endpoint: /agent-summary/<teacher>/<agent_name>
+#    The stored summary and opening answers, see Agent summaries.
+# ----------------------------------------------------------------
+@app.route('/agent-summary/<path:teacher>/<path:agent_name>', methods=['GET'])
+def get_agent_summary(teacher, agent_name):
+    record = db_pool.run(r.table(db_summaries_table).get(summary_id(teacher, agent_name)))
+    if record is None:
+        return jsonify(success=False, message='No summary for this agent yet.'), 404
+    answers = [{"question": question, "answer": stored_answer(record, question)} for question in OPENING_QUESTIONS]
+    return jsonify(success=True, summary=record["summary"], answers=answers, updated=record["updated"]), 200
+
+# ----------------------------------------------------------------
+# Warm up before a class (POST)
+#    Endpoint: /warm-up
+#    JSON Body: { "teachers": [<teacher>, ...] }
+#    Touches the agents' index pages, generates missing summaries and
+#    loads stored conversations, see warm_up.py.
+# ----------------------------------------------------------------
+@app.route('/warm-up', methods=['POST'])
+def warm_up_teachers():
+    teachers = (request.get_json(silent=True) or {}).get('teachers') or []
+    if not isinstance(teachers, list) or not teachers:
+        return jsonify(success=False, message='A list of teachers is required'), 400
+    try:
+        start = time.perf_counter()
+        counts = warm_up(teachers)
+        return jsonify(success=True, seconds=round(time.perf_counter() - start, 3), **counts), 200
+    except Exception as e:
+        logging.error(f"Error while warming up: {e}")
+        return jsonify(success=False, message=str(e)), 500
+
 # ----------------------------------------------------------------
 # File upload
 #    
@@ -347,54 +1330,27 @@ def get_folder_structure():
     if not username:
         return jsonify(success=False, message='Username is required'), 400
 
-    user_folder = os.path.join(UPLOAD_FOLDER, username)
-    if not os.path.exists(user_folder):
-        return jsonify(success=False, message='User folder does not exist'), 404
+    # Files per scientist come from the document catalog
+    documents = sorted(catalog_documents(username), key=lambda record: (record["agent_name"], record["filename"]))
 
     files = {}
-    for root, dirs, filenames in os.walk(user_folder):
-        for filename in filenames:
-            if 'Naesala' in root:
-                scientist = 'Naesala'
-            elif 'Haryk' in root:
-                scientist = 'Haryk'
-            elif 'Ayred' in root:
-                scientist = 'Ayred'
-            elif 'Hagmar' in root:
-                scientist = 'Hagmar'
-                
-            if scientist not in files:
-                files[ scientist ] = []
-            
-            files[ scientist ].append( filename )
-
-    return jsonify(success=True, files=files), 200
+    for record in documents:
+        files.setdefault(record["agent_name"], []).append(record["filename"])
+
+    details = [{
+        "scientist": record["agent_name"],
+        "filename": record["filename"],
+        "size": record.get("size"),
+        "status": record.get("status"),
+        "chunks": len(record.get("chunk_ids", [])),
+        "uploaded": record.get("uploaded"),
+        "ingested": record.get("ingested")
+    } for record in documents]
+
+    return jsonify(success=True, files=files, documents=details), 200
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    def combine_scientist_documents(username, scientist):
-        folder_path = os.path.join(UPLOAD_FOLDER, username, scientist)
-        full_text = ""
-        
-        for filename in os.listdir(folder_path):
-            filepath = os.path.join(folder_path, filename)
-            if filename.endswith(".pdf"):
-                with open(filepath, 'rb') as f:
-                    full_text += handle_pdf(f) + "\n"
-            elif filename.endswith(".doc") or filename.endswith(".docx"):
-                if filename.endswith(".docx"):
-                    full_text += handle_docx(filepath) + "\n"
-                else:
-                    with open(filepath, 'rb') as f:
-                        full_text += handle_doc(f) + "\n"
-            elif filename.endswith(".txt"):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    full_text += f.read() + "\n"
-            else:
-                continue
-        
-        return full_text.strip()
-
     if 'file' not in request.files:
         return jsonify(success=False, message='No file part'), 400
 
@@ -416,42 +1372,46 @@ def upload_file():
 
         # Save the file
         file.save(os.path.join(subfolder, file.filename))
+        catalog_document(
+            username, scientist, file.filename, status="queued", error=None,
+            size=os.path.getsize(os.path.join(subfolder, file.filename)), uploaded=time.time()
+        )
 
-        full_text = combine_scientist_documents(username, scientist)
-        
-        #print( "FULL TEXT:", full_text )
-
-        result = store_document(full_text, username, scientist)
-
-        if result:
-            
-        
-
-            embedding = get_embedding(full_text)
-
-            if embedding:
-                # Delete old embedding
-                r.table(db_embedding_table).filter({
-                    "teacher": username,
-                    "scientist": scientist
-                }).delete().run(conn)
-
-                # Insert new one
-                r.table(db_embedding_table).insert({
-                    "teacher": username,
-                    "scientist": scientist,
-                    "embedding": embedding
-                }).run(conn)
-            else:
-                return jsonify(success=False, message='Error while fetching embedding'), 400
+        # Extraction and embedding run in the background, the teacher UI polls /jobs/<job_id>
+        job = ingestion_jobs.submit(username, scientist, file.filename)
 
-            return jsonify(success=True, message='File uploaded successfully'), 200
-        else:
-            os.remove(os.path.join(subfolder, file.filename))
-            return jsonify(success=False, message='Error while uploading document. Probably the document is to big. Try a smaller one.'), 400
+        return jsonify(success=True, message='File uploaded, processing started', job_id=job.id), 202
     else:
         return jsonify(success=False, message='Invalid request'), 400
 
+# ----------------------------------------------------------------
+# Ingestion job status (GET)
+#    Endpoint: /jobs/<job_id>
+#    Endpoint: /jobs?username=<teacher>
+#    status is one of queued, running, done, failed
+# ----------------------------------------------------------------
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # Jobs of other worker processes are read from the jobs table
+    job = ingestion_jobs.get(job_id)
+    record = job.to_dict() if job else db_pool.run(r.table(db_jobs_table).get(job_id))
+    if record is None:
+        return jsonify(success=False, message='Job does not exist'), 404
+    record.pop("worker", None)
+    return jsonify(success=True, job=record), 200
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    username = request.args.get('username')
+    jobs = {job.id: job.to_dict() for job in ingestion_jobs.list(username)}
+    query = r.table(db_jobs_table)
+    if username:
+        query = query.filter({"teacher": username})
+    for record in db_pool.run(query):
+        record.pop("worker", None)
+        jobs.setdefault(record["id"], record)
+    return jsonify(success=True, jobs=sorted(jobs.values(), key=lambda job: job["created"])), 200
+
 @app.route('/delete-file', methods=['POST'])
 def delete_file():
     data = request.json
@@ -461,11 +1421,13 @@ def delete_file():
     if not username or not filename:
         return jsonify(success=False, message='Username and filename are required'), 400
 
-    file_path = os.path.join(UPLOAD_FOLDER, username, filename)
-    if not os.path.exists(file_path):
+    # filename is <scientist>/<file name>
+    scientist, _, name = filename.partition('/')
+    if not scientist or not name or '/' in name or '..' in (scientist, name):
         return jsonify(success=False, message='File does not exist'), 404
 
-    os.remove(file_path)
+    if not delete_document(username, scientist, name):
+        return jsonify(success=False, message='File does not exist'), 404
     return jsonify(success=True, message='File deleted successfully'), 200
     
 # ----------------------------------------------------------------
@@ -484,16 +1446,16 @@ def register():
         return jsonify(success=False, message='Username and password are required'), 400
 
     # Check if the username already exists
-    existing_user = r.table('users').filter({'username': username}).run(conn)
+    existing_user = db_pool.run(r.table('users').get_all(username, index='username'))
     if list(existing_user):
         return jsonify(success=False, message='Username already exists'), 400
 
     # Insert the new user into the database
-    r.table('users').insert({
+    db_pool.run(r.table('users').insert({
         'username': username,
         'password': password,  # Password is already hashed on the frontend
         'permission': permission,
-    }).run(conn)
+    }))
 
     # Create folder structure for the user
     base_folder = os.path.join('lecture_materials')
@@ -524,7 +1486,7 @@ def login():
         return jsonify(success=False, message='Username and password are required'), 400
 
     # Check if the username and password match
-    user = r.table('users').filter({'username': username, 'password': password}).run(conn)
+    user = db_pool.run(r.table('users').get_all(username, index='username').filter({'password': password}))
     user = list(user)
 
     if not user:
@@ -550,12 +1512,12 @@ def regucenik():
         return jsonify(success=False, message='Obavezno unesi korisničko ime i lozinku!'), 400
 
     # Check if the username already exists
-    existing_user = r.table('users').filter({'username': username}).run(conn)
+    existing_user = db_pool.run(r.table('users').get_all(username, index='username'))
     if list(existing_user):
         return jsonify(success=False, message='Korisničko ime već postoji!'), 400
 
     # Insert the new user into the database
-    r.table('users').insert({
+    db_pool.run(r.table('users').insert({
         'username': username,
         'password': password,  # Password is already hashed on the frontend
         'teacher': teacher,
@@ -584,15 +1546,472 @@ def regucenik():
             'skills': [],
             'weapons': { }
         },
-    }).run(conn)
+    }))
 
     return jsonify(success=True, message='Registration successful'), 200
 
+# ----------------------------------------------------------------
+# Asynchronous serving (ASGI)
+#    python3 openai-server.py --asgi
+#    /query and /query-stream are served by coroutines on an asyncio
+#    RethinkDB connection, so waiting on the database does not hold a
+#    thread. OpenAI calls go through the same limited clients as the
+#    Flask routes (coalescing, rate limits, retries), on a thread pool
+#    large enough for the calls those clients let through or queue.
+#    A streamed reply is read whole by one thread of that pool, which
+#    holds the stream's chat client slot and hands the tokens over
+#    through a queue; fewer streams than threads are admitted, so the
+#    streams holding slots always have their threads. FAISS searches
+#    run in a small thread pool. Every other route is handed over to
+#    the Flask app on a pool of its own threads (a2wsgi), so static
+#    game files, logins and uploads do not wait behind each other or
+#    behind slow routes like /warm-up.
+# ----------------------------------------------------------------
+ASYNC_MAX_INFLIGHT = 500        # /query requests handled at the same time
+ASYNC_OPENAI_THREADS = 128      # threads waiting on (or queued for) OpenAI calls
+ASYNC_MAX_STREAMS = 96          # replies streamed at the same time, each on one of those threads
+ASYNC_SEARCH_THREADS = 4
+ASYNC_FLASK_THREADS = 32        # Flask requests handled at the same time
+
+async_inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+async_streams = asyncio.Semaphore(ASYNC_MAX_STREAMS)
+search_executor = ThreadPoolExecutor(max_workers=ASYNC_SEARCH_THREADS)
+openai_executor = ThreadPoolExecutor(max_workers=ASYNC_OPENAI_THREADS)
+
+# The asyncio driver multiplexes concurrent queries over one connection
+r_async = RethinkDB()
+r_async.set_loop_type("asyncio")
+async_db_conn = None
+async_db_lock = asyncio.Lock()
+
+async def async_db_run(query):
+    global async_db_conn
+    async with async_db_lock:
+        if async_db_conn is None or not async_db_conn.is_open():
+            async_db_conn = await r_async.connect(host=db_host, port=db_port, db=db_name)
+
+    result = await query.run(async_db_conn)
+    if isinstance(result, Cursor):
+        result = [item async for item in result]
+    return result
+
+async def get_embedding_async(text):
+    # The embedder checks the cache (SQLite) and calls the limited embedding client
+    return await asyncio.get_running_loop().run_in_executor(openai_executor, get_embedding, text)
+
+async def fetch_chunk_texts_async(doc_ids):
+    if not doc_ids:
+        return []
+    records = await async_db_run(r.table(db_embedding_table).get_all(*doc_ids).pluck("id", "text"))
+    texts = {record["id"]: record["text"] for record in records}
+    return [texts[doc_id] for doc_id in doc_ids if doc_id in texts]
+
+async def precomputed_reply_async(index_key, user_prompt, query_embedding, trace):
+    # Rephrasings are only matched once the opening question embeddings are loaded (warm-up or a sync query)
+    question = opening_question(user_prompt, query_embedding, opening_vectors)
+    if question is None:
+        return None
+    with trace.stage("precomputed"):
+        record = await async_db_run(r.table(db_summaries_table).get(summary_id(*index_key)))
+    return stored_answer(record, question)
+
+async def prepare_query_async(username, agent_name, data, trace):
+    """Same steps as prepare_query, without blocking the event loop."""
+    with trace.stage("teacher_lookup"):
+        if not users_index_ready.is_set():
+            await asyncio.get_running_loop().run_in_executor(search_executor, ensure_users_index)
+        user_record = await async_db_run(r.table("users").get_all(username, index="username"))
+    if not user_record:
+        return 404, {"status": "error", "response": "Student user not found."}
+
+    teacher = user_record[0].get("teacher")
+    if not teacher:
+        return 400, {"status": "error", "response": "Teacher not assigned to student."}
+
+    user_prompt = data.get("prompt", "").strip()
+    if not user_prompt:
+        return 400, {"status": "error", "response": "Prompt is required."}
+
+    index_key = (teacher, agent_name)
+    if index_key not in document_indexes:
+        return 404, {"status": "error", "response": "No documents found for this agent."}
+
+    query = {
+        "teacher": teacher,
+        "index_key": index_key,
+        "conv_key": (teacher, username, agent_name),
+        "user_prompt": user_prompt,
+        "embedding": None,
+        "cached_reply": None,
+        "prompt": None,
+        "trace": trace
+    }
+    query["cached_reply"] = await precomputed_reply_async(index_key, user_prompt, None, trace)
+    if query["cached_reply"] is not None:
+        metrics.increment("retrieval_total", path="precomputed")
+        return None, query
+
+    loop = asyncio.get_running_loop()
+    with trace.stage("lexical_search"):
+        lexical_hits, confidence = await loop.run_in_executor(
+            search_executor, lexical_index.search, index_key, user_prompt, RETRIEVAL_CANDIDATES
+        )
+    query_embedding = None
+    if confidence < LEXICAL_FAST_PATH_CONFIDENCE:
+        with trace.stage("embedding"):
+            query_embedding = await get_embedding_async(user_prompt)
+        if query_embedding is None and not lexical_hits:
+            return 500, {"status": "error", "response": "Failed to get embedding."}
+    metrics.increment("retrieval_total", path=retrieval_path(confidence, query_embedding))
+    query["embedding"] = query_embedding
+
+    if query_embedding is not None:
+        query["cached_reply"] = await precomputed_reply_async(index_key, user_prompt, query_embedding, trace)
+        if query["cached_reply"] is None:
+            with trace.stage("answer_cache"):
+                query["cached_reply"] = answer_cache.lookup(index_key, query_embedding)
+    if query["cached_reply"] is not None:
+        return None, query
+
+    vector_hits = []
+    if query_embedding is not None:
+        with trace.stage("vector_search"):
+            vector_hits = await loop.run_in_executor(
+                search_executor, document_indexes.search, index_key, query_embedding, RETRIEVAL_CANDIDATES
+            )
+    hits = merge_hits(vector_hits, lexical_hits, RETRIEVAL_TOP_K)
+
+    with trace.stage("chunk_fetch"):
+        context_chunks = await fetch_chunk_texts_async([doc_id for doc_id, _ in hits])
+    if not context_chunks:
+        return 404, {"status": "error", "response": "No relevant document chunks found."}
+
+    with trace.stage("prompt_assembly"):
+        query["prompt"] = build_prompt(teacher, agent_name, context_chunks, user_prompt)
+        history = await loop.run_in_executor(search_executor, conversations.window, query["conv_key"], CONVERSATION_WINDOW_TOKENS)
+        query["messages"] = history + [{"role": "user", "content": query["prompt"]}]
+    return None, query
+
+async def query_agent_async(username, agent_name, data):
+    """Returns (HTTP status, JSON payload) like query_agent."""
+    trace = query_trace(username, agent_name)
+    try:
+        status, query = await prepare_query_async(username, agent_name, data, trace)
+        if status is not None:
+            trace.finish(str(status))
+            return status, query
+
+        assistant_reply = query["cached_reply"]
+        if assistant_reply is None:
+            with trace.stage("llm"):
+                assistant_reply = await asyncio.get_running_loop().run_in_executor(
+                    openai_executor, limited_chat.complete, query["messages"]
+                )
+
+        # Conversation loads and write-through inserts are blocking database calls
+        await asyncio.get_running_loop().run_in_executor(search_executor, finish_query, query, assistant_reply)
+        trace.finish()
+        return 200, {"status": "success", "response": assistant_reply}
+
+    except openai.RateLimitError as e:
+        trace.finish("503")
+        return 503, {"status": "error", "response": str(e)}
+
+    except Exception as e:
+        trace.finish("500")
+        return 500, {"status": "error", "response": str(e)}
+
+def pump_stream(messages, loop, queue, stop):
+    """Read a chat stream on this thread and put ("token", text), then ("done", None) or ("error", e) on the queue."""
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass    # the event loop is closed
+
+    try:
+        tokens = limited_chat.stream(messages)
+        try:
+            for token in tokens:
+                if stop.is_set():
+                    break
+                put(("token", token))
+        finally:
+            # Releases the chat client slot
+            tokens.close()
+        put(("done", None))
+    except Exception as e:
+        put(("error", e))
+
+async def stream_reply_async(query, send):
+    async def send_event(event, payload):
+        await send({"type": "http.response.body", "body": sse_event(event, payload).encode("utf-8"), "more_body": True})
+
+    trace = query["trace"]
+    try:
+        if query["cached_reply"] is not None:
+            await send_event("token", {"token": query["cached_reply"]})
+            assistant_reply = query["cached_reply"]
+        else:
+            parts = []
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+            stop = threading.Event()
+            with trace.stage("llm"):
+                # The admission is given back once the thread is done, not when the client goes away
+                await async_streams.acquire()
+                pump = loop.run_in_executor(openai_executor, pump_stream, query["messages"], loop, queue, stop)
+                pump.add_done_callback(lambda _: async_streams.release())
+                try:
+                    while True:
+                        kind, value = await queue.get()
+                        if kind == "error":
+                            raise value
+                        if kind == "done":
+                            break
+                        if not parts:
+                            metrics.observe("query_first_token_seconds", time.perf_counter() - trace.start)
+                        parts.append(value)
+                        await send_event("token", {"token": value})
+                finally:
+                    stop.set()
+            assistant_reply = "".join(parts)
+
+        await asyncio.get_running_loop().run_in_executor(search_executor, finish_query, query, assistant_reply)
+        trace.finish()
+        await send_event("done", {"status": "success", "response": assistant_reply})
+
+    except Exception as e:
+        logging.error(f"Error while streaming reply: {e}")
+        trace.finish("500")
+        await send_event("error", {"status": "error", "response": str(e)})
+
+    await send({"type": "http.response.body", "body": b""})
+
+async def query_agent_stream_async(username, agent_name, data, send):
+    trace = query_trace(username, agent_name)
+    try:
+        status, query = await prepare_query_async(username, agent_name, data, trace)
+    except Exception as e:
+        status, query = 500, {"status": "error", "response": str(e)}
+    if status is not None:
+        trace.finish(str(status))
+        return await send_json(send, status, query)
+
+    headers = [(b"content-type", b"text/event-stream")]
+    headers += [(name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await stream_reply_async(query, send)
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + list(headers)
+    })
+    await send({"type": "http.response.body", "body": body})
+
+flask_asgi = WSGIMiddleware(app, workers=ASYNC_FLASK_THREADS)
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "http" and scope["method"] == "POST":
+        endpoint, _, path = scope["path"].lstrip("/").partition("/")
+        if endpoint in ("query", "query-stream"):
+            username, _, agent_name = path.partition("/")
+            try:
+                data = json.loads(await read_body(receive) or b"{}")
+            except ValueError:
+                return await send_json(send, 400, {"status": "error", "response": "Invalid JSON body."})
+
+            async with async_inflight:
+                if endpoint == "query-stream":
+                    return await query_agent_stream_async(username, agent_name, data, send)
+                status, payload = await query_agent_async(username, agent_name, data)
+            headers = [(b"retry-after", str(RATE_LIMIT_RETRY_AFTER).encode())] if status == 503 else []
+            return await send_json(send, status, payload, headers)
+
+    return await flask_asgi(scope, receive, send)
+
+# ----------------------------------------------------------------
+# Worker processes
+#    Several processes can serve the same database and snapshot
+#    folder (see server_app.py). Each one memory-maps the index
+#    snapshots, so the vectors are in memory once for all of them,
+#    and follows changefeeds of the embeddings and conversations
+#    tables: chunks stored or deleted by one worker are applied to
+#    the indexes of all others, and a conversation changed by one
+#    worker is reloaded by the others. Conversations are written
+#    through on every turn. The worker holding the writer lock is
+#    the only one saving snapshots; it saves an index changed by
+#    another worker after SNAPSHOT_DELAY quiet seconds, after which
+#    the other workers swap their private copy for the new file.
+# ----------------------------------------------------------------
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+SNAPSHOT_WRITER_LOCK = 'index_snapshots.lock'
+SNAPSHOT_DELAY = 5.0            # seconds without changes before snapshots are saved or reloaded
+CHANGEFEED_BATCH = 256
+CHANGEFEED_WAIT = 0.2           # seconds a batch may wait for more changes
+CHANGEFEED_OPEN_TIMEOUT = 30    # seconds a starting worker waits for its feeds
+snapshot_writer_lock = None
+changed_indexes = {}            # (teacher, agent) -> time of the last change from the feed
+next_snapshot_check = 0.0
+
+def acquire_snapshot_writer():
+    global snapshot_writer_lock
+    if snapshot_writer_lock is None:
+        lock_file = open(SNAPSHOT_WRITER_LOCK, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        snapshot_writer_lock = lock_file
+        print(f"Worker {WORKER_ID} writes the index snapshots.")
+    return True
+
+def connect_changefeed():
+    return r.connect(host=db_host, port=db_port, db=db_name)
+
+def apply_embedding_changes(changes):
+    """Bring the local vector and lexical indexes up to date with a batch of the embeddings changefeed."""
+    added = defaultdict(dict)
+    removed = defaultdict(set)
+    for change in changes:
+        old, new = change.get("old_val"), change.get("new_val")
+        if old and old.get("agent_name") and not new:
+            key = (old["teacher"], old["agent_name"])
+            removed[key].add(old["id"])
+            added[key].pop(old["id"], None)
+        if new and new.get("agent_name"):
+            key = (new["teacher"], new["agent_name"])
+            added[key][new["id"]] = new
+            removed[key].discard(new["id"])
+
+    now = time.time()
+    for key in set(added) | set(removed):
+        # Changes made by this worker come back through the feed as well and are already applied
+        doc_ids = list(removed[key])
+        applied = document_indexes.remove(key, doc_ids) if doc_ids else 0
+        lexical_index.remove(key, doc_ids)
+
+        missing = document_indexes.missing(key, list(added[key]))
+        records = [added[key][doc_id] for doc_id in missing]
+        if records:
+            vectors = [decode_vector(record["embedding"], record.get("vector_format")) for record in records]
+            document_indexes.add_many(key, missing, vectors)
+            lexical_index.add_many(key, missing, [record.get("text", "") for record in records])
+
+        if applied or records:
+            answer_cache.invalidate(key)
+        if applied or records or not document_indexes.writable:
+            changed_indexes[key] = now
+    metrics.increment("changefeed_changes_total", len(changes), table=db_embedding_table)
+
+def apply_conversation_changes(changes):
+    for change in changes:
+        record = change.get("new_val") or change.get("old_val")
+        if record and record.get("writer") != WORKER_ID:
+            conversations.discard((record["teacher"], record["username"], record["agent_name"]))
+    metrics.increment("changefeed_changes_total", len(changes), table=db_conversation_table)
+
+def resync_indexes():
+    # Changes made while the feed was down are not replayed, compare with the database instead
+    for key in sync_indexes():
+        changed_indexes[key] = time.time()
+
+def settle_changed_indexes():
+    """The writer saves the indexes changed through the feed, the other workers map the saved files."""
+    global next_snapshot_check
+    now = time.time()
+    if now < next_snapshot_check:
+        return
+    next_snapshot_check = now + SNAPSHOT_DELAY
+
+    if not document_indexes.writable:
+        document_indexes.writable = acquire_snapshot_writer()
+    for key, changed in list(changed_indexes.items()):
+        if now - changed < SNAPSHOT_DELAY:
+            continue
+        if document_indexes.writable:
+            document_indexes.save_snapshot(key)
+            del changed_indexes[key]
+        elif document_indexes.reload_snapshot(key) or key not in document_indexes:
+            del changed_indexes[key]
+
+embedding_feed = ChangefeedFollower(
+    "embeddings", connect_changefeed, r.table(db_embedding_table).changes(), apply_embedding_changes,
+    on_idle=settle_changed_indexes, on_reconnect=resync_indexes,
+    batch_size=CHANGEFEED_BATCH, batch_wait=CHANGEFEED_WAIT
+)
+conversation_feed = ChangefeedFollower(
+    "conversations", connect_changefeed, r.table(db_conversation_table).changes(), apply_conversation_changes,
+    batch_size=CHANGEFEED_BATCH, batch_wait=CHANGEFEED_WAIT
+)
+
+def start_worker():
+    """Startup of one of several worker processes."""
+    document_indexes.writable = acquire_snapshot_writer()
+    if document_indexes.writable:
+        setup_database()
+        backfill_catalog()
+    conversations.write_through = True
+
+    # Feeds are opened before the indexes are loaded, so nothing written
+    # in between is missed; their changes are applied once loading is done
+    for feed in (embedding_feed, conversation_feed):
+        feed.start()
+    for feed in (embedding_feed, conversation_feed):
+        if not feed.opened.wait(CHANGEFEED_OPEN_TIMEOUT):
+            print(f"Changefeed {feed.name} is not open yet, changes of other workers are applied once it is.")
+
+    load_indexes()
+    for feed in (embedding_feed, conversation_feed):
+        feed.resume()
+    try:
+        recover_ingestion_jobs(requeue_catalog=document_indexes.writable)
+    except Exception as e:
+        logging.error(f"Error while recovering interrupted ingestion jobs: {e}")
+
+    # Only the snapshot writer hashes and compresses the game files, the others use what it wrote
+    if document_indexes.writable:
+        threading.Thread(target=prepare_static_assets, daemon=True).start()
+    else:
+        static_assets.load()
+    threading.Thread(target=flush_conversations_periodically, daemon=True).start()
+    atexit.register(conversations.flush)
+
 # ----------------------------------------------------------------
 # Run the server
+#    python3 openai-server.py               Flask development server
+#    python3 openai-server.py --asgi        asynchronous server (uvicorn)
+#    python3 openai-server.py --workers 4   uvicorn with 4 worker processes
 # ----------------------------------------------------------------
 if __name__ == "__main__":
     setup_database()
-    load_embeddings_from_database()
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    backfill_catalog()
+    workers = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else 1
+    if workers > 1:
+        # Every worker process imports server_app.py, which starts it; the OpenAI limits are split among them
+        os.environ["SERVER_WORKERS"] = str(workers)
+        uvicorn.run("server_app:asgi_app", host="0.0.0.0", port=5000, workers=workers,
+                    lifespan="off", app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        load_indexes()
+        recover_ingestion_jobs(requeue_catalog=True)
+        threading.Thread(target=prepare_static_assets, daemon=True).start()
+        threading.Thread(target=flush_conversations_periodically, daemon=True).start()
+        atexit.register(conversations.flush)
+        if "--asgi" in sys.argv:
+            uvicorn.run(asgi_app, host="0.0.0.0", port=5000, lifespan="off")
+        else:
+            app.run(debug=True, host="0.0.0.0", port=5000)
 
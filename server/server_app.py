@@ -0,0 +1,27 @@
+import os
+import importlib.util
+
+# ----------------------------------------------------------------
+# Entry point of the worker processes
+#    openai-server.py cannot be imported by module name because of
+#    the dash, so WSGI/ASGI servers import this module instead. It
+#    loads the server and starts it as one of several workers that
+#    share the index snapshots (see "Worker processes" there).
+#    Each worker must serve the Flask routes on several threads, or
+#    every game file it serves waits behind the one before it: asgi_app
+#    runs them on ASYNC_FLASK_THREADS threads, with gunicorn use the
+#    gthread worker (--threads).
+#
+#    python3 openai-server.py --workers 4
+#    SERVER_WORKERS=4 uvicorn server_app:asgi_app --workers 4 --port 5000
+#    SERVER_WORKERS=4 gunicorn -w 4 --threads 16 -b 0.0.0.0:5000 server_app:app    (without --preload)
+# ----------------------------------------------------------------
+spec = importlib.util.spec_from_file_location(
+    "openai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai-server.py")
+)
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+server.start_worker()
+
+app = server.app
+asgi_app = server.asgi_app
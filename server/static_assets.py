@@ -0,0 +1,361 @@
+import os
+import re
+import gzip
+import json
+import stat
+import hashlib
+import tempfile
+import posixpath
+import mimetypes
+import threading
+from collections import OrderedDict
+from flask import Response, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ----------------------------------------------------------------
+# Static game assets
+#    A manifest maps every file under the game folder to a content
+#    hash; it is saved between runs, so only new or changed files
+#    are hashed again at startup. Responses carry the hash as ETag
+#    and accept byte ranges (audio seeking). Requests that name the
+#    current hash (?v=<hash>) are cached by browsers for a year;
+#    HTML pages are rewritten to link their scripts, stylesheets
+#    and images that way. JS, JSON, CSS and HTML files are stored
+#    compressed with gzip and brotli (when installed) next to the
+#    manifest. Small files and their compressed variants are kept
+#    in an LRU cache in memory. With several worker processes only
+#    one builds the manifest and the compressed files, the others
+#    load() what it wrote and pick up variants written later.
+# ----------------------------------------------------------------
+COMPRESSIBLE_EXTENSIONS = (".js", ".json", ".css", ".html", ".svg", ".txt", ".map")
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+MIN_COMPRESS_SIZE = 1024
+IMMUTABLE = "public, max-age=31536000, immutable"
+ASSET_LINK = re.compile(r'(\b(?:src|href)=")([^"#?:]+)(")')
+
+def content_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()[:20]
+
+def write_atomic(path, data):
+    # A unique temporary file per writer, readers and other writers never see half a file
+    folder, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder or ".", prefix="." + name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class AssetManifest:
+    def __init__(self, root, manifest_file, excluded=("server",)):
+        self.root = root
+        self.manifest_file = manifest_file
+        self.excluded = excluded
+        self.entries = {}       # relative path -> {"hash", "size", "mtime"}
+        self.generation = 0     # increases whenever a file changes
+        self.lock = threading.Lock()
+
+    def visible(self, relpath):
+        parts = relpath.split("/")
+        return parts[0] not in self.excluded and not any(part.startswith(".") for part in parts)
+
+    def build(self):
+        """Hash every file under root, reusing the saved hash of unchanged files."""
+        previous = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+
+        entries = {}
+        hashed = 0
+        for folder, dirnames, filenames in os.walk(self.root):
+            relfolder = os.path.relpath(folder, self.root).replace(os.sep, "/")
+            relfolder = "" if relfolder == "." else relfolder + "/"
+            dirnames[:] = [name for name in dirnames if self.visible(relfolder + name)]
+            for filename in filenames:
+                relpath = relfolder + filename
+                if not self.visible(relpath):
+                    continue
+                info = os.stat(os.path.join(folder, filename))
+                entry = previous.get(relpath)
+                if not entry or entry["size"] != info.st_size or entry["mtime"] != info.st_mtime_ns:
+                    entry = {"hash": content_hash(os.path.join(folder, filename)), "size": info.st_size, "mtime": info.st_mtime_ns}
+                    hashed += 1
+                entries[relpath] = entry
+
+        with self.lock:
+            self.entries = entries
+            self.generation += 1
+        self.save()
+        return len(entries), hashed
+
+    def load(self):
+        """Read the saved manifest without hashing anything, returns the number of entries."""
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        with self.lock:
+            self.entries = entries
+            self.generation += 1
+        return len(entries)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        write_atomic(self.manifest_file, data.encode('utf-8'))
+
+    def entry(self, relpath):
+        """Manifest entry of the file, refreshed when the file changed since it was hashed."""
+        if not self.visible(relpath):
+            return None
+        try:
+            info = os.stat(os.path.join(self.root, relpath))
+        except OSError:
+            info = None
+
+        with self.lock:
+            entry = self.entries.get(relpath)
+            if info is None or not stat.S_ISREG(info.st_mode):
+                if self.entries.pop(relpath, None):
+                    self.generation += 1
+                return None
+            if entry and entry["size"] == info.st_size and entry["mtime"] == info.st_mtime_ns:
+                return entry
+
+        entry = {"hash": content_hash(os.path.join(self.root, relpath)), "size": info.st_size, "mtime": info.st_mtime_ns}
+        with self.lock:
+            self.entries[relpath] = entry
+            self.generation += 1
+        return entry
+
+    def hashes(self):
+        with self.lock:
+            return {entry["hash"] for entry in self.entries.values()}
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+
+class StaticAssets:
+    def __init__(self, root, manifest_file, cache_folder, max_age=3600,
+                 hot_cache_bytes=64 << 20, hot_file_limit=1 << 20, excluded=("server",)):
+        self.root = root
+        self.cache_folder = cache_folder
+        self.max_age = max_age
+        self.hot_cache_bytes = hot_cache_bytes
+        self.hot_file_limit = hot_file_limit
+        self.manifest = AssetManifest(root, manifest_file, excluded)
+        self.variants = {}          # (hash, encoding) -> size of the compressed file
+        self.hot = OrderedDict()    # key -> (etag, bytes)
+        self.hot_size = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hot_hits = 0
+        self.not_modified = 0
+        self.compressed = 0
+
+    def build(self):
+        return self.manifest.build()
+
+    def load(self):
+        """Use the manifest and compressed files another process wrote, returns the number of files."""
+        files = self.manifest.load()
+        for relpath, entry in self.manifest.items():
+            for encoding in ENCODINGS:
+                self.find_variant(entry["hash"], encoding)
+        return files
+
+    def find_variant(self, file_hash, encoding):
+        path = self.variant_path(file_hash, encoding)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        with self.lock:
+            self.variants[(file_hash, encoding)] = size
+        return size
+
+    def variant_path(self, file_hash, encoding):
+        return os.path.join(self.cache_folder, file_hash + ENCODING_SUFFIXES[encoding])
+
+    def precompress(self):
+        """Write the compressed variants of every compressible file and drop the outdated ones."""
+        os.makedirs(self.cache_folder, exist_ok=True)
+        written = 0
+        for relpath, entry in self.manifest.items():
+            if not relpath.lower().endswith(COMPRESSIBLE_EXTENSIONS) or entry["size"] < MIN_COMPRESS_SIZE:
+                continue
+            for encoding in ENCODINGS:
+                path = self.variant_path(entry["hash"], encoding)
+                if not os.path.exists(path):
+                    with open(os.path.join(self.root, relpath), 'rb') as f:
+                        write_atomic(path, compress(f.read(), encoding))
+                    written += 1
+                with self.lock:
+                    self.variants[(entry["hash"], encoding)] = os.path.getsize(path)
+
+        current = self.manifest.hashes()
+        for filename in os.listdir(self.cache_folder):
+            if filename.split(".")[0] not in current:
+                os.remove(os.path.join(self.cache_folder, filename))
+        return written
+
+    def choose_encoding(self, entry, request):
+        if "Range" in request.headers:
+            return None
+        for encoding in ENCODINGS:
+            if not request.accept_encodings[encoding]:
+                continue
+            with self.lock:
+                size = self.variants.get((entry["hash"], encoding))
+            if size is None and entry["size"] >= MIN_COMPRESS_SIZE:
+                # Possibly written since by the process that precompresses
+                size = self.find_variant(entry["hash"], encoding)
+            if size is not None and size < entry["size"]:
+                return encoding
+        return None
+
+    def hot_get(self, key):
+        with self.lock:
+            value = self.hot.get(key)
+            if value is not None:
+                self.hot.move_to_end(key)
+                self.hot_hits += 1
+            return value
+
+    def hot_put(self, key, value):
+        with self.lock:
+            if key in self.hot:
+                return
+            self.hot[key] = value
+            self.hot_size += len(value[1])
+            while self.hot_size > self.hot_cache_bytes:
+                _, (_, data) = self.hot.popitem(last=False)
+                self.hot_size -= len(data)
+
+    def versioned_html(self, relpath, data):
+        """Link the page's assets by content hash, so browsers may cache them for good."""
+        folder = posixpath.dirname(relpath)
+
+        def version(match):
+            link = match.group(2)
+            target = link.lstrip("/") if link.startswith("/") else posixpath.normpath(posixpath.join(folder, link))
+            entry = self.manifest.entry(target)
+            if entry is None:
+                return match.group(0)
+            return f"{match.group(1)}{link}?v={entry['hash']}{match.group(3)}"
+
+        return ASSET_LINK.sub(version, data.decode("utf-8")).encode("utf-8")
+
+    def html_body(self, relpath, entry, encoding):
+        key = ("html", relpath, entry["hash"], self.manifest.generation, encoding)
+        cached = self.hot_get(key)
+        if cached is not None:
+            return cached
+
+        with open(os.path.join(self.root, relpath), 'rb') as f:
+            data = self.versioned_html(relpath, f.read())
+        etag = hashlib.sha256(data).hexdigest()[:20] + (f"-{encoding}" if encoding else "")
+        if encoding:
+            data = compress(data, encoding)
+        self.hot_put(key, (etag, data))
+        return etag, data
+
+    def serve(self, filename, request):
+        """Response for the requested file, or None when there is no such asset."""
+        full_path = safe_join(self.root, filename)
+        if full_path is None:
+            return None
+        relpath = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+        entry = self.manifest.entry(relpath)
+        if entry is None:
+            return None
+
+        with self.lock:
+            self.requests += 1
+        mimetype = mimetypes.guess_type(relpath)[0] or "application/octet-stream"
+        is_html = relpath.lower().endswith(".html")
+        compressible = relpath.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+        if is_html:
+            encoding = next((encoding for encoding in ENCODINGS if request.accept_encodings[encoding]), None)
+            if "Range" in request.headers:
+                encoding = None
+            etag, data = self.html_body(relpath, entry, encoding)
+            response = self.memory_response(data, mimetype, etag, request)
+            cache_control = "no-cache"
+        else:
+            encoding = self.choose_encoding(entry, request) if compressible else None
+            etag = entry["hash"] + (f"-{encoding}" if encoding else "")
+            path = self.variant_path(entry["hash"], encoding) if encoding else os.path.join(self.root, relpath)
+            size = self.variants[(entry["hash"], encoding)] if encoding else entry["size"]
+
+            if size <= self.hot_file_limit:
+                key = ("file", entry["hash"], encoding)
+                cached = self.hot_get(key)
+                if cached is None:
+                    with open(path, 'rb') as f:
+                        cached = (etag, f.read())
+                    self.hot_put(key, cached)
+                response = self.memory_response(cached[1], mimetype, etag, request)
+            else:
+                response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=None)
+
+            if request.args.get("v") == entry["hash"]:
+                cache_control = IMMUTABLE
+            else:
+                cache_control = f"public, max-age={self.max_age}"
+
+        response.headers["Cache-Control"] = cache_control
+        response.headers.pop("Expires", None)
+        if compressible:
+            response.vary.add("Accept-Encoding")
+        if encoding and response.status_code != 304:
+            response.headers["Content-Encoding"] = encoding
+
+        with self.lock:
+            if response.status_code == 304:
+                self.not_modified += 1
+            elif encoding:
+                self.compressed += 1
+        return response
+
+    def memory_response(self, data, mimetype, etag, request):
+        response = Response(data, mimetype=mimetype)
+        response.set_etag(etag)
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.manifest.entries),
+                "compressed_variants": len(self.variants),
+                "brotli": brotli is not None,
+                "requests": self.requests,
+                "hot_entries": len(self.hot),
+                "hot_bytes": self.hot_size,
+                "hot_hits": self.hot_hits,
+                "not_modified": self.not_modified,
+                "compressed_responses": self.compressed
+            }
@@ -0,0 +1,151 @@
+import time
+import threading
+import numpy as np
+import openai
+import pytest
+from chat import FakeChatBackend, OpenAIChatBackend
+from embeddings import FakeEmbeddingBackend, OpenAIEmbeddingBackend
+from fake_openai import FakeOpenAI, serve
+from upstream import LimitedChatBackend, LimitedEmbeddingBackend, TokenBucket, UpstreamClient, request_key, retry_after
+
+RETRY_ON = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+DIMENSIONS = 8
+
+
+def count_tokens(text):
+    return len(text.split())
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeOpenAI(dimensions=DIMENSIONS, latency=0.05, retry_after=0.1)
+    server = serve(fake, port=0)
+    monkeypatch.setattr(openai, "base_url", f"http://127.0.0.1:{server.server_port}/v1/")
+    monkeypatch.setattr(openai, "api_key", "fake")
+    monkeypatch.setattr(openai, "max_retries", 0)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+def client(**options):
+    options.setdefault("base_delay", 0.01)
+    return UpstreamClient("test", retry_on=RETRY_ON, **options)
+
+def embedder(upstream):
+    return LimitedEmbeddingBackend(OpenAIEmbeddingBackend("text-embedding-3-small", DIMENSIONS), upstream, count_tokens)
+
+def fail_first(fake, statuses):
+    """Answer the next requests with the given error statuses, then as usual."""
+    admit = fake.admit
+    statuses = list(statuses)
+
+    def patched():
+        with fake.lock:
+            if statuses:
+                return statuses.pop(0)
+        return admit()
+    fake.admit = patched
+
+
+def test_embeddings_match_the_fake_backend(fake):
+    upstream = client()
+    result = embedder(upstream).embed(["comet", "lens"])
+
+    expected = FakeEmbeddingBackend(DIMENSIONS).embed(["comet", "lens"])
+    assert np.allclose(result, expected, atol=1e-6)
+    assert upstream.stats()["calls"] == 1
+
+def test_identical_calls_in_flight_are_coalesced(fake):
+    fake.latency = 0.3
+    upstream = client()
+    backend = embedder(upstream)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(backend.embed(["same text"]))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fake.stats()["embeddings"] == 1
+    assert upstream.stats()["coalesced"] == 4
+    assert all(result == results[0] for result in results)
+
+def test_rate_limited_calls_wait_for_retry_after(fake):
+    fake.retry_after = 0.3
+    fail_first(fake, [429, 429])
+    upstream = client(base_delay=5.0)
+
+    start = time.monotonic()
+    assert len(embedder(upstream).embed(["comet"])) == 1
+    assert time.monotonic() - start >= 0.6
+
+    stats = upstream.stats()
+    assert (stats["calls"], stats["retries"], stats["rate_limited"], stats["failures"]) == (3, 2, 2, 0)
+
+def test_server_errors_fail_once_retries_are_used_up(fake):
+    fail_first(fake, [500] * 3)
+    upstream = client(retries=2)
+
+    with pytest.raises(openai.InternalServerError):
+        embedder(upstream).embed(["comet"])
+    stats = upstream.stats()
+    assert (stats["calls"], stats["retries"], stats["failures"]) == (3, 2, 1)
+    assert fake.stats()["embeddings"] == 0
+
+def test_calls_in_flight_are_limited(fake):
+    fake.max_concurrency = 2
+    fake.latency = 0.1
+    upstream = client(max_concurrency=2)
+    backend = embedder(upstream)
+
+    threads = [threading.Thread(target=backend.embed, args=([f"text {number}"],)) for number in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The fake answers 429 as soon as a third request is in flight
+    assert fake.stats()["rate_limited"] == 0
+    assert fake.stats()["embeddings"] == 6
+    assert upstream.stats()["max_waiting"] >= 1
+
+def test_chat_streams_are_retried_before_the_first_token(fake):
+    fail_first(fake, [429])
+    upstream = client()
+    chat = LimitedChatBackend(OpenAIChatBackend("gpt-4o-mini"), upstream, count_tokens)
+    messages = [{"role": "user", "content": "tell me about the comet lens"}]
+
+    assert "".join(chat.stream(messages)) == "".join(FakeChatBackend().tokens(messages))
+    assert chat.complete(messages) == "".join(FakeChatBackend().tokens(messages))
+    assert upstream.stats()["retries"] == 1
+
+
+def test_token_bucket_spreads_requests_over_time():
+    bucket = TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # Two tokens are there at once, the other four come at 20 per second
+    assert 0.15 <= time.monotonic() - start < 1.0
+
+def test_request_key_ignores_dict_order():
+    assert request_key("chat", {"a": 1, "b": 2}) == request_key("chat", {"b": 2, "a": 1})
+    assert request_key("chat", ["x"]) != request_key("embeddings", ["x"])
+
+@pytest.mark.parametrize("headers, seconds", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "2"}, 2.0),
+    ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0.0),
+    ({}, None),
+])
+def test_retry_after_reads_the_response_headers(headers, seconds):
+    class Response:
+        pass
+
+    class Error(Exception):
+        pass
+
+    error = Error()
+    error.response = Response()
+    error.response.headers = headers
+    assert retry_after(error) == seconds
@@ -0,0 +1,234 @@
+import os
+import threading
+import numpy as np
+import pytest
+from vector_index import AgentIndex, IndexManager, IndexPolicy, decode_vector, encode_vector
+
+DIMENSION = 16
+KEY = ("teacher", "agent")
+
+
+def vectors(count, seed=0):
+    data = np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+def ids(count, prefix="d"):
+    return [f"{prefix}{number}" for number in range(count)]
+
+def manager(tmp_path=None, **policy):
+    return IndexManager(DIMENSION, IndexPolicy(**policy),
+                        snapshot_folder=str(tmp_path / "snapshots") if tmp_path else None)
+
+
+@pytest.mark.parametrize("vector_format", ["float32", "float16", "json"])
+def test_encoded_vectors_decode_to_float32(vector_format):
+    vector = vectors(1)[0]
+    decoded = decode_vector(encode_vector(vector, vector_format), vector_format)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, vector, atol=1e-3)
+
+
+# Delta updates
+
+def test_add_many_replaces_vectors_with_the_same_id():
+    indexes = manager()
+    data = vectors(10)
+    indexes.add_many(KEY, ids(10), data)
+    indexes.add_many(KEY, ["d3"], vectors(1, seed=1))
+
+    assert indexes.size(KEY) == 10
+    assert indexes.search(KEY, vectors(1, seed=1)[0], 1)[0][0] == "d3"
+    assert indexes.indexes[KEY].removed == 1
+    # Nothing holds the old vector anymore
+    assert indexes.search(KEY, data[3], 1)[0][1] > 1e-3
+
+def test_missing_and_stale_keys_compare_with_the_database():
+    indexes = manager()
+    indexes.add_many(KEY, ids(5), vectors(5))
+
+    assert indexes.missing(KEY, ["d1", "x"]) == ["x"]
+    assert indexes.stale_keys({KEY: set(ids(5))}) == []
+    assert indexes.stale_keys({KEY: set(ids(4))}) == [KEY]
+    assert set(indexes.stale_keys({KEY: set(ids(5)), ("teacher", "other"): {"y"}})) == {("teacher", "other")}
+
+def test_removing_every_vector_drops_the_index():
+    indexes = manager()
+    indexes.add_many(KEY, ids(3), vectors(3))
+
+    assert indexes.remove(KEY, ids(3) + ["unknown"]) == 3
+    assert KEY not in indexes
+    assert indexes.search(KEY, vectors(1)[0], 3) == []
+    assert indexes.centroid(KEY) is None
+
+
+# Tombstones
+
+def test_removed_vectors_are_skipped_without_losing_live_hits():
+    agent_index = AgentIndex(DIMENSION, "HNSW8,Flat")
+    data = vectors(50)
+    agent_index.add(ids(50), data)
+    agent_index.remove(ids(40))
+
+    assert agent_index.removed == 40
+    hits = agent_index.search(data[:1], 5)
+    assert len(hits) == 5
+    assert all(doc_id not in ids(40) for doc_id, _ in hits)
+
+def test_centroid_only_counts_live_vectors():
+    indexes = manager()
+    data = vectors(6)
+    indexes.add_many(KEY, ids(6), data)
+    indexes.remove(KEY, ids(3))
+
+    expected = data[3:].mean(axis=0)
+    assert np.allclose(indexes.centroid(KEY), expected / np.linalg.norm(expected), atol=1e-5)
+
+
+# Compaction and tier rebuilds
+
+def test_tombstones_are_compacted():
+    indexes = manager()
+    indexes.compact_ratio = 0.25
+    indexes.add_many(KEY, ids(20), vectors(20))
+    indexes.remove(KEY, ids(4))
+    assert indexes.indexes[KEY].removed == 4
+
+    indexes.remove(KEY, ["d4", "d5"])
+    agent_index = indexes.indexes[KEY]
+    assert agent_index.removed == 0
+    assert sorted(agent_index.positions) == sorted(ids(20)[6:])
+
+def test_growing_agent_moves_to_the_next_tier():
+    indexes = manager(flat_below=50, ivf_from=200, hnsw_m=8)
+    data = vectors(300)
+    indexes.add_many(KEY, ids(40), data[:40])
+    assert indexes.indexes[KEY].index_type == "Flat"
+
+    indexes.add_many(KEY, ids(300)[40:100], data[40:100])
+    assert indexes.indexes[KEY].index_type == "HNSW8,Flat"
+
+    indexes.add_many(KEY, ids(300)[100:], data[100:])
+    agent_index = indexes.indexes[KEY]
+    assert agent_index.index_type.startswith("IVF")
+    assert len(agent_index) == 300
+    assert indexes.search(KEY, data[123], 1)[0][0] == "d123"
+
+def test_changes_during_a_rebuild_are_replayed_on_the_new_index():
+    indexes = manager(flat_below=50, hnsw_m=8)
+    data = vectors(60)
+    indexes.add_many(KEY, ids(49), data[:49])
+    old = indexes.indexes[KEY]
+
+    building = threading.Event()
+    proceed = threading.Event()
+    add = AgentIndex.add
+
+    def slow_add(self, doc_ids, embeddings):
+        if self is not old and self.journal is None and len(doc_ids) > 1:
+            building.set()
+            proceed.wait(5)
+        return add(self, doc_ids, embeddings)
+
+    AgentIndex.add = slow_add
+    try:
+        rebuild = threading.Thread(target=indexes.add_many, args=(KEY, ["d49"], data[49:50]))
+        rebuild.start()
+        assert building.wait(5)
+        # Neither searches nor changes wait for the build
+        assert indexes.search(KEY, data[7], 1)[0][0] == "d7"
+        indexes.add_many(KEY, ["late"], data[50:51])
+        indexes.remove(KEY, ["d7"])
+        proceed.set()
+        rebuild.join(5)
+    finally:
+        AgentIndex.add = add
+
+    agent_index = indexes.indexes[KEY]
+    assert agent_index is not old
+    assert agent_index.index_type == "HNSW8,Flat"
+    assert agent_index.journal is None
+    assert set(agent_index.positions) == set(ids(50)) - {"d7"} | {"late"}
+    assert indexes.search(KEY, data[50], 1)[0][0] == "late"
+
+def test_rebuild_is_dropped_when_the_index_was_replaced_meanwhile():
+    indexes = manager()
+    indexes.add_many(KEY, ids(10), vectors(10))
+    old = indexes.indexes[KEY]
+    doc_ids, embeddings = old.vectors()
+    old.journal = []
+    indexes.rebuild_key(KEY, [{"id": doc_id, "teacher": KEY[0], "agent_name": KEY[1], "embedding": embedding.tolist()}
+                              for doc_id, embedding in zip(doc_ids[:5], embeddings[:5])])
+    old.journal = None
+
+    assert indexes.rebuild_index(KEY, old, "Flat") is False
+    assert indexes.size(KEY) == 5
+
+
+# Snapshots
+
+def test_snapshots_are_memory_mapped_and_copied_on_the_first_add(tmp_path):
+    indexes = manager(tmp_path)
+    data = vectors(30)
+    indexes.add_many(KEY, ids(20), data[:20])
+    indexes.remove(KEY, ["d0"])
+    indexes.save_snapshot(KEY)
+
+    loaded = manager(tmp_path)
+    assert loaded.load_snapshots() == 1
+    agent_index = loaded.indexes[KEY]
+    assert agent_index.mapped
+    assert agent_index.removed == 1
+    assert loaded.search(KEY, data[5], 1)[0][0] == "d5"
+
+    loaded.add_many(KEY, ids(30)[20:], data[20:])
+    assert not loaded.indexes[KEY].mapped
+    assert loaded.size(KEY) == 29
+    assert loaded.search(KEY, data[25], 1)[0][0] == "d25"
+
+def test_snapshot_versions_replace_each_other(tmp_path):
+    indexes = manager(tmp_path)
+    indexes.add_many(KEY, ids(5), vectors(5))
+    indexes.save_snapshot(KEY)
+    indexes.add_many(KEY, ["d5"], vectors(1, seed=1))
+    indexes.save_snapshot(KEY)
+
+    folder = indexes._snapshot_path(KEY)
+    assert sorted(os.listdir(folder)) == ["ids-v2.json", "index-v2.faiss", "manifest.json"]
+    loaded = manager(tmp_path)
+    loaded.load_snapshots()
+    assert loaded.size(KEY) == 6
+
+def test_snapshots_of_another_policy_are_ignored(tmp_path):
+    indexes = manager(tmp_path)
+    indexes.add_many(KEY, ids(5), vectors(5))
+    indexes.save_snapshot(KEY)
+
+    assert manager(tmp_path, storage="SQ8").load_snapshots() == 0
+
+def test_snapshot_of_a_removed_index_is_dropped(tmp_path):
+    indexes = manager(tmp_path)
+    indexes.add_many(KEY, ids(5), vectors(5))
+    indexes.save_snapshot(KEY)
+    indexes.remove(KEY, ids(5))
+    indexes.save_snapshot(KEY)
+
+    assert manager(tmp_path).load_snapshots() == 0
+
+def test_reload_snapshot_only_swaps_in_the_same_documents(tmp_path):
+    indexes = manager(tmp_path)
+    indexes.add_many(KEY, ids(5), vectors(5))
+    indexes.save_snapshot(KEY)
+
+    assert indexes.reload_snapshot(KEY)
+    assert indexes.indexes[KEY].mapped
+    indexes.add_many(KEY, ["d5"], vectors(1, seed=1))
+    assert not indexes.reload_snapshot(KEY)
+    assert indexes.size(KEY) == 6
+
+def test_read_only_managers_do_not_write_snapshots(tmp_path):
+    indexes = manager(tmp_path)
+    indexes.writable = False
+    indexes.add_many(KEY, ids(5), vectors(5))
+    indexes.save_snapshot(KEY)
+
+    assert not os.path.exists(tmp_path / "snapshots")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+from vector_index import AgentIndex, IndexManager, index_tier
+
+# ----------------------------------------------------------------
+# Offline index tuning
+#    Reads the index snapshots written by the server and reports,
+#    per agent, the recall@k against exact search and the latency
+#    per query for a range of efSearch (HNSW) or nprobe (IVF)
+#    values. Queries are stored vectors with a little noise added.
+#    The smallest value reaching --target recall is recommended;
+#    --save writes the recommendations to the tuning file that
+#    the server reads at startup.
+#
+#    python3 tune_indexes.py
+#    python3 tune_indexes.py --target 0.98 --save
+# ----------------------------------------------------------------
+EF_SEARCH_VALUES = (8, 16, 32, 64, 128, 256)
+NPROBE_VALUES = (1, 2, 4, 8, 16, 32, 64, 128)
+
+def load_agent_indexes(snapshot_folder):
+    agents = {}
+    for name in sorted(os.listdir(snapshot_folder)):
+        folder = os.path.join(snapshot_folder, name)
+        manifest = IndexManager._read_manifest(folder)
+        if not manifest or "target_type" not in manifest:
+            continue
+        index = faiss.read_index(os.path.join(folder, manifest["index"]))
+        with open(os.path.join(folder, manifest["ids"]), 'r', encoding='utf-8') as f:
+            doc_ids = json.load(f)
+        agents[(manifest["teacher"], manifest["agent_name"])] = AgentIndex.from_index(
+            index, doc_ids, manifest["index_type"], manifest["target_type"], manifest["trained_size"]
+        )
+    return agents
+
+def measure(agent_index, queries, expected, k):
+    start = time.perf_counter()
+    found = [[doc_id for doc_id, _ in agent_index.search(query.reshape(1, -1), k)] for query in queries]
+    elapsed = time.perf_counter() - start
+    recall = np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)])
+    return recall, 1000 * elapsed / len(queries)
+
+def tune(agent_index, queries_count, k, target, noise, rng):
+    doc_ids, vectors = agent_index.vectors()
+    sample = vectors[rng.choice(len(vectors), min(queries_count, len(vectors)), replace=False)]
+    queries = (sample + noise * rng.standard_normal(sample.shape)).astype(np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, positions = exact.search(queries, k)
+    expected = [[doc_ids[position] for position in row if position >= 0] for row in positions]
+
+    tier = index_tier(agent_index.index_type)
+    if tier == "hnsw":
+        name, values = "ef_search", EF_SEARCH_VALUES
+    elif tier == "ivf":
+        name, values = "nprobe", NPROBE_VALUES
+    else:
+        name, values = None, (None,)
+
+    rows = []
+    for value in values:
+        if name == "ef_search":
+            agent_index.index.hnsw.efSearch = value
+        elif name == "nprobe":
+            faiss.extract_index_ivf(agent_index.index).nprobe = value
+        recall, latency = measure(agent_index, queries, expected, k)
+        rows.append((value, recall, latency))
+
+    best = next((value for value, recall, _ in rows if recall >= target), values[-1])
+    return name, rows, best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report recall@k and latency of every agent index for its search parameters.")
+    parser.add_argument("--snapshots", default="index_snapshots")
+    parser.add_argument("--tuning-file", default="index_tuning.json")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--target", type=float, default=0.95, help="recall@k to reach")
+    parser.add_argument("--noise", type=float, default=0.01, help="noise added to the query vectors")
+    parser.add_argument("--save", action="store_true", help="write the recommended parameters to the tuning file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    recommendations = []
+    for (teacher, agent_name), agent_index in load_agent_indexes(args.snapshots).items():
+        if not len(agent_index):
+            continue
+
+        name, rows, best = tune(agent_index, args.queries, args.k, args.target, args.noise, rng)
+        print(f"{teacher}/{agent_name}: {len(agent_index)} vectors, {agent_index.index_type}")
+        for value, recall, latency in rows:
+            label = f"{name}={value}" if name else "exact"
+            marker = "  <- recommended" if name and value == best else ""
+            print(f"    {label:>14}  recall@{args.k} {recall:6.3f}  {latency:8.3f} ms/query{marker}")
+
+        if name:
+            recommendations.append({"teacher": teacher, "agent_name": agent_name, name: best})
+
+    if args.save:
+        with open(args.tuning_file, 'w', encoding='utf-8') as f:
+            json.dump(recommendations, f, indent=2)
+        print(f"Saved search parameters of {len(recommendations)} agents to {args.tuning_file}")
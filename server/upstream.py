@@ -0,0 +1,243 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+
+# ----------------------------------------------------------------
+# Upstream API client layer
+#    Every call to an upstream API (embeddings, chat) goes through
+#    an UpstreamClient: at most max_concurrency calls in flight,
+#    token buckets for requests per second and tokens per minute,
+#    and retries of transient errors with jittered exponential
+#    backoff (or the server's Retry-After). Calls given a key are
+#    coalesced: while one is in flight, identical calls wait for
+#    its result instead of sending their own request. Streams get
+#    the same limits, but are retried only before the first item.
+# ----------------------------------------------------------------
+def request_key(kind, payload):
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return kind + ":" + hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def retry_after(error):
+    """Seconds the server asked us to wait, from the error's response headers."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate            # tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Block until amount tokens are available and take them."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}     # key -> [done event, result, error]
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = function()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+
+class UpstreamClient:
+    def __init__(self, name, max_concurrency=16, requests_per_second=None, tokens_per_minute=None,
+                 retries=4, base_delay=0.5, max_delay=30.0, retry_on=()):
+        self.name = name
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_second, max(1, requests_per_second)) if requests_per_second else None
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.single_flight = SingleFlight()
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.wait_seconds = 0.0
+        self.retried = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    def acquire(self, cost):
+        start = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            self.slots.acquire()
+            if self.request_bucket:
+                self.request_bucket.acquire(1)
+            if self.token_bucket:
+                self.token_bucket.acquire(cost)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                self.wait_seconds += time.perf_counter() - start
+        with self.lock:
+            self.in_flight += 1
+            self.calls += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def backoff(self, attempt, error):
+        """Delay before the next attempt, or None when the error is not worth retrying."""
+        if getattr(error, "status_code", None) == 429:
+            with self.lock:
+                self.rate_limited += 1
+        if attempt >= self.retries:
+            with self.lock:
+                self.failures += 1
+            return None
+        with self.lock:
+            self.retried += 1
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter, so callers that failed together do not retry together
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    def call(self, function, *args, key=None, cost=1):
+        if key is None:
+            return self.attempt(function, args, cost)
+        return self.single_flight.do(key, lambda: self.attempt(function, args, cost))
+
+    def attempt(self, function, args, cost):
+        attempt = 0
+        while True:
+            self.acquire(cost)
+            try:
+                return function(*args)
+            except self.retry_on as e:
+                delay = self.backoff(attempt, e)
+                if delay is None:
+                    raise
+            finally:
+                self.release()
+            time.sleep(delay)
+            attempt += 1
+
+    def stream(self, function, *args, cost=1):
+        attempt = 0
+        while True:
+            self.acquire(cost)
+            started = False
+            try:
+                for item in function(*args):
+                    started = True
+                    yield item
+                return
+            except self.retry_on as e:
+                delay = None if started else self.backoff(attempt, e)
+                if delay is None:
+                    raise
+            finally:
+                self.release()
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "calls": self.calls,
+                "coalesced": self.single_flight.coalesced,
+                "retries": self.retried,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "wait_seconds": round(self.wait_seconds, 3)
+            }
+
+# ----------------------------------------------------------------
+# Limited backends
+#    Wrap an embedding or chat backend so its requests go through
+#    an UpstreamClient. Identical embedding batches and identical
+#    chat conversations in flight share one request; streamed
+#    replies are never shared.
+# ----------------------------------------------------------------
+class LimitedEmbeddingBackend:
+    def __init__(self, backend, client, count_tokens):
+        self.backend = backend
+        self.client = client
+        self.count_tokens = count_tokens
+
+    def embed(self, texts):
+        cost = sum(self.count_tokens(text) for text in texts)
+        return self.client.call(self.backend.embed, texts, key=request_key("embeddings", texts), cost=cost)
+
+
+class LimitedChatBackend:
+    def __init__(self, backend, client, count_tokens):
+        self.backend = backend
+        self.client = client
+        self.count_tokens = count_tokens
+
+    def cost(self, messages):
+        return sum(self.count_tokens(message["content"]) for message in messages)
+
+    def complete(self, messages):
+        return self.client.call(self.backend.complete, messages, key=request_key("chat", messages), cost=self.cost(messages))
+
+    def stream(self, messages):
+        return self.client.stream(self.backend.stream, messages, cost=self.cost(messages))
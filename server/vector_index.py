@@ -0,0 +1,622 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import faiss
+
+# Bump when the snapshot layout changes, older snapshots are then ignored
+SNAPSHOT_FORMAT = 3
+
+# ----------------------------------------------------------------
+# Stored vector format
+#    Embeddings are stored in the database as binary float32 or
+#    float16 blobs ("float32", "float16") or, as before, as JSON
+#    lists of floats ("json"). The format is recorded next to the
+#    vector so records written in older formats stay readable.
+# ----------------------------------------------------------------
+VECTOR_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+def encode_vector(embedding, vector_format="float32"):
+    if vector_format == "json":
+        return [float(value) for value in embedding]
+    return np.asarray(embedding, dtype=VECTOR_DTYPES[vector_format]).tobytes()
+
+def decode_vector(value, vector_format=None):
+    """float32 array of a stored vector; lists are read as JSON vectors."""
+    if isinstance(value, (bytes, bytearray)):
+        return np.frombuffer(value, dtype=VECTOR_DTYPES[vector_format or "float32"]).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def index_bytes(index):
+    """Size of an index in memory, measured as its serialized size."""
+    return faiss.serialize_index(index).nbytes
+
+# ----------------------------------------------------------------
+# Index policy
+#    The index of an agent is chosen by the number of its vectors:
+#    exact search below flat_below vectors, an HNSW graph up to
+#    ivf_from vectors and an inverted file (IVF) above that. storage
+#    is how vectors are kept in any of them: "Flat" keeps full
+#    vectors, "SQfp16", "SQ8" and "PQ<m>" scalar or product quantize
+#    them. ef_search (HNSW) and nprobe (IVF) trade recall for speed
+#    and can be overridden per agent, see tune_indexes.py.
+# ----------------------------------------------------------------
+TIERS = ("flat", "hnsw", "ivf")
+
+def index_tier(index_type):
+    if index_type.startswith("HNSW"):
+        return "hnsw"
+    if index_type.startswith("IVF"):
+        return "ivf"
+    return "flat"
+
+class IndexPolicy:
+    def __init__(self, storage="Flat", flat_below=1000, ivf_from=50000, hnsw_m=32,
+                 ef_search=64, nprobe=16, overrides=None):
+        self.storage = storage
+        self.flat_below = flat_below
+        self.ivf_from = ivf_from
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.overrides = overrides or {}    # (teacher, agent) -> {"ef_search": ..., "nprobe": ...}
+
+    def tier(self, count):
+        if count < self.flat_below:
+            return "flat"
+        if count < self.ivf_from:
+            return "hnsw"
+        return "ivf"
+
+    def index_type(self, count):
+        tier = self.tier(count)
+        if tier == "flat":
+            return self.storage
+        if tier == "hnsw":
+            return f"HNSW{self.hnsw_m},{self.storage}"
+        # Usual rule of thumb: about 4 * sqrt(n) inverted lists
+        return f"IVF{int(4 * np.sqrt(count))},{self.storage}"
+
+    def search_parameters(self, key):
+        parameters = {"ef_search": self.ef_search, "nprobe": self.nprobe}
+        parameters.update(self.overrides.get(key, {}))
+        return parameters
+
+    def configure(self, index, key):
+        parameters = self.search_parameters(key)
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = parameters["ef_search"]
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = parameters["nprobe"]
+
+    def load_overrides(self, path):
+        """Read per-agent search parameters written by tune_indexes.py."""
+        if not path or not os.path.isfile(path):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        self.overrides = {
+            (record["teacher"], record["agent_name"]): {
+                name: record[name] for name in ("ef_search", "nprobe") if name in record
+            } for record in records
+        }
+        return len(self.overrides)
+
+    def signature(self):
+        # Snapshots built under another policy are rebuilt
+        return {"storage": self.storage, "flat_below": self.flat_below, "ivf_from": self.ivf_from, "hnsw_m": self.hnsw_m}
+
+# ----------------------------------------------------------------
+# Per (teacher, agent) FAISS indexes
+#    Vectors are addressed by their RethinkDB document id. HNSW
+#    graphs cannot delete vectors, so removed or replaced entries
+#    are tombstoned and skipped at search time; the index is
+#    compacted once tombstones make up too large a share of it, and
+#    rebuilt as another index type once the agent outgrows its tier.
+#    The replacement is built outside the agent's lock, so searches
+#    keep using the old index; changes made meanwhile are journaled
+#    and replayed on the new one before it is swapped in.
+#    Quantizers and IVF lists are trained on the first vectors
+#    added; an agent with too few vectors to train on keeps full
+#    vectors and tries again once it has doubled in size.
+# ----------------------------------------------------------------
+def make_index(dimension, index_type):
+    index = faiss.index_factory(dimension, index_type)
+    storage = faiss.downcast_index(index.storage) if hasattr(index, "storage") else index
+    if isinstance(storage, faiss.IndexPQ):
+        # Polysemous training is only useful for Hamming filtering and takes minutes
+        storage.do_polysemous_training = False
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Vectors of an IVF index can only be reconstructed through a direct map
+        ivf.set_direct_map_type(faiss.DirectMap.Array)
+    return index
+
+def fallback_index_type(index_type):
+    return ",".join(index_type.split(",")[:-1] + ["Flat"])
+
+class AgentIndex:
+    def __init__(self, dimension, index_type="Flat"):
+        self.dimension = dimension
+        self.index = make_index(dimension, index_type)
+        self.index_type = index_type    # type of self.index
+        self.target_type = index_type   # type asked for, differs after a failed training
+        self.trained_size = 0           # vectors the index was trained on
+        self.mapped = False             # self.index is a read-only view of a snapshot file
+        self.journal = None             # changes made while a replacement is built, see IndexManager.rebuild_index
+        self.doc_ids = []       # FAISS position -> document id (None when removed)
+        self.positions = {}     # document id -> FAISS position
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def removed(self):
+        return len(self.doc_ids) - len(self.positions)
+
+    def _train(self, embeddings):
+        self.trained_size = len(embeddings)
+        try:
+            self.index.train(embeddings)
+        except RuntimeError:
+            # Not enough vectors for the quantizer (e.g. fewer than 256 for PQ)
+            self.index_type = fallback_index_type(self.index_type)
+            self.index = make_index(self.dimension, self.index_type)
+
+    def own(self):
+        # A memory-mapped index cannot grow, it is copied into private memory on the first add
+        if self.mapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.mapped = False
+
+    def add(self, doc_ids, embeddings):
+        self.remove(doc_ids)
+        if self.journal is not None:
+            self.journal.append(("add", doc_ids, embeddings))
+        self.own()
+        if not self.doc_ids:
+            self._train(embeddings)
+        start = len(self.doc_ids)
+        self.index.add(embeddings)
+        for offset, doc_id in enumerate(doc_ids):
+            self.doc_ids.append(doc_id)
+            self.positions[doc_id] = start + offset
+
+    def remove(self, doc_ids):
+        if self.journal is not None:
+            self.journal.append(("remove", doc_ids, None))
+        removed = 0
+        for doc_id in doc_ids:
+            position = self.positions.pop(doc_id, None)
+            if position is not None:
+                self.doc_ids[position] = None
+                removed += 1
+        return removed
+
+    def search(self, embedding, k):
+        if not self.positions:
+            return []
+
+        # Over-fetch so tombstoned positions do not push live hits out of the top-k
+        fetch = min(len(self.doc_ids), k + self.removed)
+        D, I = self.index.search(embedding, fetch)
+
+        hits = []
+        for distance, position in zip(D[0], I[0]):
+            if 0 <= position < len(self.doc_ids) and self.doc_ids[position] is not None:
+                hits.append((self.doc_ids[position], float(distance)))
+                if len(hits) == k:
+                    break
+        return hits
+
+    def vectors(self):
+        live = [(doc_id, position) for doc_id, position in self.positions.items()]
+        if not live:
+            return [], np.empty((0, self.dimension), dtype=np.float32)
+        embeddings = self.index.reconstruct_batch(np.array([position for _, position in live], dtype=np.int64))
+        return [doc_id for doc_id, _ in live], embeddings
+
+    def mean(self, block=4096):
+        # Block by block, a memory-mapped index must not be copied whole into private memory
+        positions = np.fromiter(self.positions.values(), dtype=np.int64, count=len(self.positions))
+        total = np.zeros(self.dimension, dtype=np.float64)
+        for start in range(0, len(positions), block):
+            total += self.index.reconstruct_batch(positions[start:start + block]).sum(axis=0)
+        return total / max(1, len(positions))
+
+    @classmethod
+    def from_index(cls, index, doc_ids, index_type, target_type, trained_size, mapped=False):
+        agent_index = cls(index.d)
+        agent_index.index = index
+        agent_index.mapped = mapped
+        agent_index.index_type = index_type
+        agent_index.target_type = target_type
+        agent_index.trained_size = trained_size
+        agent_index.doc_ids = list(doc_ids)
+        agent_index.positions = {doc_id: position for position, doc_id in enumerate(doc_ids) if doc_id is not None}
+        return agent_index
+
+    def replay(self, journal):
+        for operation, doc_ids, embeddings in journal:
+            if operation == "add":
+                self.add(doc_ids, embeddings)
+            else:
+                self.remove(doc_ids)
+
+
+class IndexManager:
+    def __init__(self, dimension, policy=None, compact_ratio=0.25, snapshot_folder=None):
+        self.dimension = dimension
+        self.policy = policy or IndexPolicy()
+        self.compact_ratio = compact_ratio
+        self.snapshot_folder = snapshot_folder
+        self.writable = True    # only one process may write the snapshots of a folder
+        self.indexes = {}
+        self.key_locks = {}     # (teacher, agent) -> lock held while its index is searched or changed
+        self.lock = threading.RLock()   # guards the two dicts, never held during FAISS work
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.RLock())
+
+    def _get(self, key):
+        with self.lock:
+            return self.indexes.get(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.indexes and len(self.indexes[key]) > 0
+
+    def keys(self):
+        with self.lock:
+            return list(self.indexes.keys())
+
+    def size(self, key):
+        with self.lock:
+            return len(self.indexes[key]) if key in self.indexes else 0
+
+    def sizes(self):
+        with self.lock:
+            return {key: len(agent_index) for key, agent_index in self.indexes.items()}
+
+    def missing(self, key, doc_ids):
+        """The given document ids that the (teacher, agent) index does not hold."""
+        with self.lock:
+            positions = self.indexes[key].positions if key in self.indexes else {}
+            return [doc_id for doc_id in doc_ids if doc_id not in positions]
+
+    def add(self, key, doc_id, embedding):
+        self.add_many(key, [doc_id], [embedding])
+
+    def add_many(self, key, doc_ids, embeddings):
+        """Add vectors to the (teacher, agent) index, replacing any with the same document id."""
+        if not doc_ids:
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(doc_ids), self.dimension)
+        with self._key_lock(key):
+            with self.lock:
+                agent_index = self.indexes.get(key)
+                if agent_index is None:
+                    agent_index = self.indexes[key] = self._new_index(key, len(doc_ids))
+            agent_index.add(list(doc_ids), embeddings)
+            index_type = self._rebuild_type(agent_index)
+        if index_type:
+            self.rebuild_index(key, agent_index, index_type)
+
+    def remove(self, key, doc_ids):
+        with self._key_lock(key):
+            agent_index = self._get(key)
+            if agent_index is None:
+                return 0
+            removed = agent_index.remove(doc_ids)
+            index_type = None
+            if not agent_index:
+                with self.lock:
+                    self.indexes.pop(key, None)
+            else:
+                index_type = self._rebuild_type(agent_index)
+        if index_type:
+            self.rebuild_index(key, agent_index, index_type)
+        return removed
+
+    def centroid(self, key):
+        """Normalized mean of all vectors of the (teacher, agent), as a plain list."""
+        with self._key_lock(key):
+            agent_index = self._get(key)
+            if agent_index is None:
+                return None
+            mean = agent_index.mean()
+        norm = np.linalg.norm(mean)
+        return (mean / norm if norm else mean).tolist()
+
+    def search(self, key, embedding, k):
+        """Return up to k (document id, distance) pairs nearest to the embedding."""
+        query = np.asarray([embedding], dtype=np.float32)
+        # Searches of different agents run in parallel, FAISS releases the GIL
+        with self._key_lock(key):
+            agent_index = self._get(key)
+            if agent_index is None:
+                return []
+            return agent_index.search(query, k)
+
+    def _new_index(self, key, count):
+        agent_index = AgentIndex(self.dimension, self.policy.index_type(count))
+        self.policy.configure(agent_index.index, key)
+        return agent_index
+
+    def _rebuild_type(self, agent_index):
+        """Index type the agent's index should be rebuilt as, or None. Called with the key lock held."""
+        if agent_index.journal is not None:
+            return None     # already being rebuilt
+        count = len(agent_index)
+        tier = index_tier(agent_index.target_type)
+
+        rebuild = (
+            # tombstones make up too large a share of the index
+            (agent_index.removed and agent_index.removed > self.compact_ratio * len(agent_index.doc_ids))
+            # the agent outgrew its tier (indexes only move down when compacted)
+            or TIERS.index(self.policy.tier(count)) > TIERS.index(tier)
+            # training failed before, or the IVF lists were sized for far fewer vectors
+            or (agent_index.index_type != agent_index.target_type and count >= 2 * agent_index.trained_size)
+            or (tier == "ivf" and count >= 4 * agent_index.trained_size)
+        )
+        return self.policy.index_type(count) if rebuild else None
+
+    def rebuild_index(self, key, agent_index, index_type):
+        """Replace the agent's index by a compacted one of the given type.
+
+        Only reading the vectors and swapping the indexes hold the key lock;
+        training and adding (minutes for a large IVF index) run without it,
+        so the agent keeps answering. Changes made in the meantime go to the
+        old index and its journal, and are replayed on the new one.
+        """
+        with self._key_lock(key):
+            if self._get(key) is not agent_index or agent_index.journal is not None:
+                return False
+            doc_ids, embeddings = agent_index.vectors()
+            agent_index.journal = []
+
+        try:
+            # Quantized vectors are reconstructed approximately, the quantizer is retrained on them
+            fresh = AgentIndex(self.dimension, index_type)
+            if doc_ids:
+                fresh.add(doc_ids, embeddings)
+            self.policy.configure(fresh.index, key)
+        except Exception:
+            with self._key_lock(key):
+                agent_index.journal = None
+            raise
+
+        with self._key_lock(key):
+            journal, agent_index.journal = agent_index.journal, None
+            if self._get(key) is not agent_index:
+                # Replaced meanwhile (snapshot reload, rebuild from the database)
+                return False
+            fresh.replay(journal)
+            with self.lock:
+                self.indexes[key] = fresh
+        return True
+
+    def stats(self):
+        with self.lock:
+            tiers = {tier: 0 for tier in TIERS}
+            for agent_index in self.indexes.values():
+                tiers[index_tier(agent_index.index_type)] += 1
+            return {
+                "agents": len(self.indexes),
+                "vectors": sum(len(agent_index) for agent_index in self.indexes.values()),
+                "tiers": tiers
+            }
+
+    def _build(self, key, doc_ids, embeddings):
+        agent_index = self._new_index(key, len(doc_ids))
+        agent_index.add(doc_ids, np.asarray(embeddings, dtype=np.float32))
+        return agent_index
+
+    def _group(self, documents):
+        grouped = {}
+        mismatched = 0
+        for doc in documents:
+            teacher = doc.get("teacher")
+            agent_name = doc.get("agent_name")
+            embedding = doc.get("embedding")
+            doc_id = doc.get("id")
+
+            if not all([teacher, agent_name, doc_id]) or embedding is None or len(embedding) == 0:
+                continue
+
+            embedding = decode_vector(embedding, doc.get("vector_format"))
+            if len(embedding) != self.dimension:
+                mismatched += 1
+                continue
+
+            ids, vectors = grouped.setdefault((teacher, agent_name), ([], []))
+            ids.append(doc_id)
+            vectors.append(embedding)
+
+        if mismatched:
+            print(f"Skipped {mismatched} stored vectors that do not have {self.dimension} dimensions, re-upload their files.")
+        return grouped
+
+    def rebuild(self, documents):
+        """Full rebuild from database records; only meant for startup or explicit maintenance."""
+        grouped = self._group(documents)
+        indexes = {key: self._build(key, ids, vectors) for key, (ids, vectors) in grouped.items()}
+
+        with self.lock:
+            self.indexes = indexes
+
+        return sum(len(ids) for ids, _ in grouped.values())
+
+    def rebuild_key(self, key, documents):
+        """Rebuild a single (teacher, agent) index from its database records."""
+        ids, vectors = self._group(documents).get(key, ([], []))
+        fresh = self._build(key, ids, vectors) if ids else None
+        with self._key_lock(key), self.lock:
+            if fresh is not None:
+                self.indexes[key] = fresh
+            else:
+                self.indexes.pop(key, None)
+        return len(ids)
+
+    # ------------------------------------------------------------
+    # Snapshots
+    #    <snapshot_folder>/<key hash>/manifest.json points to the
+    #    current index-v<N>.faiss and ids-v<N>.json pair. A new
+    #    version is written next to the old one and the manifest
+    #    is swapped atomically, so a crash never leaves a torn
+    #    snapshot behind. Loaded indexes are read-only views of the
+    #    memory-mapped file (IO_FLAG_MMAP_IFC), whose pages live in
+    #    the page cache and are shared by every process that maps
+    #    it; an index is copied into private memory when vectors
+    #    are added to it.
+    # ------------------------------------------------------------
+    def _snapshot_path(self, key):
+        name = hashlib.sha1("/".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.snapshot_folder, name)
+
+    def save_snapshot(self, key):
+        if not self.snapshot_folder or not self.writable:
+            return
+
+        folder = self._snapshot_path(key)
+        with self._key_lock(key):
+            agent_index = self._get(key)
+            if agent_index is not None:
+                data = faiss.serialize_index(agent_index.index)
+                doc_ids = list(agent_index.doc_ids)
+                index_type, target_type = agent_index.index_type, agent_index.target_type
+                trained_size = agent_index.trained_size
+
+        if agent_index is None:
+            manifest_path = os.path.join(folder, "manifest.json")
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            return
+
+        os.makedirs(folder, exist_ok=True)
+        manifest = self._read_manifest(folder) or {}
+        version = manifest.get("version", 0) + 1
+
+        index_file = f"index-v{version}.faiss"
+        ids_file = f"ids-v{version}.json"
+        data.tofile(os.path.join(folder, index_file))
+        with open(os.path.join(folder, ids_file), 'w', encoding='utf-8') as f:
+            json.dump(doc_ids, f)
+
+        self._write_json(os.path.join(folder, "manifest.json"), {
+            "format": SNAPSHOT_FORMAT,
+            "version": version,
+            "teacher": key[0],
+            "agent_name": key[1],
+            "dimension": self.dimension,
+            "policy": self.policy.signature(),
+            "index_type": index_type,
+            "target_type": target_type,
+            "trained_size": trained_size,
+            "count": len(doc_ids) - doc_ids.count(None),
+            "index": index_file,
+            "ids": ids_file
+        })
+
+        for filename in os.listdir(folder):
+            if filename not in ("manifest.json", index_file, ids_file):
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except OSError:
+                    pass
+
+    def save_all_snapshots(self):
+        for key in self.keys():
+            self.save_snapshot(key)
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_manifest(folder):
+        try:
+            with open(os.path.join(folder, "manifest.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_snapshots(self):
+        """Memory-map every valid snapshot, returns the number of indexes loaded."""
+        if not self.snapshot_folder or not os.path.isdir(self.snapshot_folder):
+            return 0
+
+        indexes = {}
+        for name in os.listdir(self.snapshot_folder):
+            loaded = self._load_snapshot(os.path.join(self.snapshot_folder, name))
+            if loaded is not None:
+                key, agent_index = loaded
+                indexes[key] = agent_index
+
+        with self.lock:
+            self.indexes = indexes
+
+        return len(indexes)
+
+    def _load_snapshot(self, folder):
+        manifest = self._read_manifest(folder)
+        if (not manifest or manifest.get("format") != SNAPSHOT_FORMAT
+                or manifest.get("dimension") != self.dimension
+                or manifest.get("policy") != self.policy.signature()):
+            return None
+
+        try:
+            # IO_FLAG_MMAP only maps IVF lists, IO_FLAG_MMAP_IFC maps the whole file for every index type
+            index = faiss.read_index(os.path.join(folder, manifest["index"]), faiss.IO_FLAG_MMAP_IFC)
+            with open(os.path.join(folder, manifest["ids"]), 'r', encoding='utf-8') as f:
+                doc_ids = json.load(f)
+        except Exception as e:
+            print(f"Skipping broken index snapshot {os.path.basename(folder)}: {e}")
+            return None
+
+        if index.ntotal != len(doc_ids):
+            return None
+
+        key = (manifest["teacher"], manifest["agent_name"])
+        self.policy.configure(index, key)
+        return key, AgentIndex.from_index(
+            index, doc_ids, manifest["index_type"], manifest["target_type"], manifest["trained_size"], mapped=True
+        )
+
+    def reload_snapshot(self, key):
+        """Swap the in-memory index of key for its memory-mapped snapshot when both hold the same documents.
+
+        Processes sharing a snapshot folder then share the pages of the file
+        instead of each keeping a private copy of the vectors.
+        """
+        if not self.snapshot_folder:
+            return False
+        loaded = self._load_snapshot(self._snapshot_path(key))
+        if loaded is None or loaded[0] != key:
+            return False
+
+        with self._key_lock(key):
+            current = self._get(key)
+            if current is None or set(current.positions) != set(loaded[1].positions):
+                return False
+            with self.lock:
+                self.indexes[key] = loaded[1]
+        return True
+
+    def stale_keys(self, db_doc_ids):
+        """Keys whose loaded index does not hold exactly the document ids found in the database."""
+        with self.lock:
+            keys = set(self.indexes) | set(db_doc_ids)
+        stale = []
+        for key in keys:
+            with self._key_lock(key):
+                agent_index = self._get(key)
+                if agent_index is None or set(agent_index.positions) != db_doc_ids.get(key, set()):
+                    stale.append(key)
+        return stale
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import sys
+import json
+import argparse
+import urllib.request
+import urllib.error
+
+# ----------------------------------------------------------------
+# Warm-up before a class
+#    Asks the running server to prepare the agents of the given
+#    teachers: index pages are read into memory, missing agent
+#    summaries and opening answers are generated and the stored
+#    conversations are loaded. Meant to be run shortly before the
+#    teachers' classes start, e.g. from cron:
+#
+#    45 7 * * 1-5  python3 warm_up.py teacher1 teacher2
+#
+#    Summaries, the embedding cache and the index snapshot pages are
+#    shared by all worker processes; conversations are loaded by the
+#    worker that answers, --requests sends the request several times
+#    so that more workers get them.
+# ----------------------------------------------------------------
+def warm_up(server, teachers, timeout):
+    request = urllib.request.Request(
+        server.rstrip("/") + "/warm-up",
+        data=json.dumps({"teachers": teachers}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preload indexes, agent summaries and conversations for upcoming classes.")
+    parser.add_argument("teachers", nargs="+", help="usernames of the teachers with classes scheduled")
+    parser.add_argument("--server", default="http://localhost:5000")
+    parser.add_argument("--requests", type=int, default=1, help="requests to send, one per worker process")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    for _ in range(args.requests):
+        try:
+            result = warm_up(args.server, args.teachers, args.timeout)
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Warm-up failed: {e}")
+            sys.exit(1)
+        print(f"Warmed up {result['agents']} agents in {result['seconds']} s: "
+              f"{result['summaries']} summaries generated, {result['conversations']} conversations loaded.")